@@ -3,9 +3,36 @@ import sqlite3
 import re
 import asyncio
 import datetime
+import time
+import contextvars
+import hashlib
+import base64
+import json
+import functools
+import os
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, ChatJoinRequest
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, CallbackQueryHandler, filters, ChatMemberHandler, ChatJoinRequestHandler
+from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, CallbackQueryHandler, filters, ChatMemberHandler, ChatJoinRequestHandler, BaseUpdateProcessor
+from telegram.ext import TypeHandler, ApplicationHandlerStop, BaseRateLimiter
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
 from config import BOT_TOKEN, ADMIN_IDS, ARCHIVE_CHANNEL_ID, REQUIRED_CHANNELS, CODES_CHANNEL
+from config import WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, CONCURRENT_UPDATES, BOT_API_BASE_URL
+from config import FLOOD_RATE, FLOOD_BURST, DUPLICATE_CALLBACK_WINDOW, MAX_PENDING_UPDATES, MAX_PENDING_PER_USER
+from config import ACTIVITY_COALESCE_SECONDS, CALLBACK_STATE_CAPACITY, CALLBACK_STATE_TTL, CALLBACK_STATE_FLUSH_INTERVAL
+from config import RECOMMENDATIONS_INTERVAL, RECOMMENDATIONS_TOP_K, VIEWS_FLUSH_INTERVAL, FEED_ACTIVE_DAYS, FEED_TTL
+from config import METRICS_HOST, METRICS_PORT, SQL_PROFILE, SQL_SLOW_MS
+from caption_parser import CaptionParser
+from categories import GENRES, COUNTRIES, YEARS, QUALITIES, LANGUAGES
+from facet_index import FacetIndex, RANGE_PREFIX
+from recommendations import build_item_neighbors, build_user_feeds
+from content_similarity import ContentIndex
+from trending import TrendingBoard
+from metrics import registry as metrics, instrument_methods, serve as serve_metrics, LatencyWindow, RateWindow
+from sql_profiler import SqlProfiler
+from runtime_profiler import CpuProfiler, MemoryProfiler, SORT_KEYS as PROFILE_SORT_KEYS
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -13,29 +40,245 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Константы для категорий
-GENRES = [
-    "Jangari", "Drama", "Komediya","Sarguzasht", 
-    "Qorqinchli", "Tarixiy", "Klassika", "Fantastika", "Hayotiy",
-    "Triller", "Detektiv", "Hujjatli_film", "Anime", "Kriminal",
-    "Fentezi", "Afsona", "Vester", "Musiqiy"
-]
+# Момент запуска процесса: от него считаются этапы загрузки в boot_stats
+BOOT_STARTED = time.monotonic()
+boot_stats = {}  # этап -> секунды от запуска
 
-COUNTRIES = [
-    "Rossiya", "AQSH", "Turkiya", "Xitoy", "Hindiston", 
-    "Avstraliya", "Buyuk_britaniya", "Janubiy_koreya", "Ukraina",
-    "Qozogiston", "Fransiya", "Eron", "Yaponiya"
-]
+caption_parser = CaptionParser(GENRES, COUNTRIES, YEARS, QUALITIES, LANGUAGES)
 
-YEARS = [str(year) for year in range(2025, 2009, -1)]
-QUALITIES = ["1080P", "720P", "480P", "4K"]
-LANGUAGES = ["UZ", "RU", "EN", "TR", "KR", "CN"]
+# МЕТРИКИ (отдаются на METRICS_HOST:METRICS_PORT/metrics)
+HANDLER_SECONDS = metrics.histogram("bot_handler_seconds", "Время обработчика", ("handler",))
+UPDATE_SECONDS = metrics.histogram("bot_update_seconds", "Время апдейта с ожиданием очереди пользователя")
+UPDATES_TOTAL = metrics.counter("bot_updates_total", "Принятые апдейты")
+QUEUE_DEPTH = metrics.gauge("bot_queue_depth", "Апдейты в обработке и в очереди")
+DB_SECONDS = metrics.histogram("bot_db_seconds", "Время метода Database", ("method",))
+API_SECONDS = metrics.histogram("bot_api_seconds", "Время запроса к Bot API", ("method",))
+API_ERRORS = metrics.counter("bot_api_errors_total", "Ошибки Bot API", ("method", "error"))
+
+# Скользящие окна для экрана /perf: последние апдейты и события за минуту
+PERF_UPDATE_LATENCY = LatencyWindow(2048)
+PERF_UPDATES = RateWindow(60)
+PERF_API_CALLS = RateWindow(60)
+PERF_API_ERRORS = RateWindow(60)
+PERF_API_RETRY_AFTER = RateWindow(60)
+
+# Профилирование по команде админа (/cprof, /memprof); выключенное ничего не стоит
+cpu_profiler = CpuProfiler()
+memory_profiler = MemoryProfiler()
+
+def observed(handler):
+    """Замер времени обработчика PTB в bot_handler_seconds{handler=имя функции}"""
+    latency = HANDLER_SECONDS.labels(handler.__name__)
+    
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        finally:
+            latency.observe(time.perf_counter() - started)
+    return wrapper
+
+class MeteredRequests(BaseRateLimiter):
+    """Не ограничивает запросы, а только замеряет время и ошибки каждого метода Bot API"""
+    
+    def __init__(self):
+        self._latency = {}  # метод -> гистограмма
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        latency = self._latency.get(endpoint)
+        if latency is None:
+            latency = self._latency[endpoint] = API_SECONDS.labels(endpoint)
+        started = time.perf_counter()
+        PERF_API_CALLS.add()
+        try:
+            return await callback(*args, **kwargs)
+        except TelegramError as e:
+            API_ERRORS.labels(endpoint, type(e).__name__).inc()
+            PERF_API_ERRORS.add()
+            if isinstance(e, RetryAfter):
+                PERF_API_RETRY_AFTER.add()
+            raise
+        finally:
+            latency.observe(time.perf_counter() - started)
+
+# ЕДИНИЦА РАБОТЫ (одна транзакция на апдейт)
+_current_uow = contextvars.ContextVar('current_uow', default=None)
+
+async def run_in_thread(func, *args):
+    """Как asyncio.to_thread, но без контекста вызывающего.
+
+    Иначе поток, запущенный из обработчика, получил бы единицу работы апдейта
+    и писал бы через ее соединение из другого потока.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(contextvars.Context().run, func, *args))
+
+class UnitOfWork:
+    """Общее соединение апдейта: отложенные записи уходят одним commit вместе с ближайшей записью"""
+    
+    def __init__(self, db):
+        self.db = db
+        self.conn = None
+        self.pending = []
+        self.writes = 0
+        self.commits = 0
+    
+    def connection(self):
+        if self.conn is None:
+            self.conn = self.db._open()
+        return _UnitOfWorkConnection(self)
+    
+    def defer(self, sql, params):
+        """Откладывает запись до ближайшего commit или конца апдейта"""
+        self.pending.append((sql, params))
+        self.writes += 1
+    
+    def _execute_pending(self):
+        cursor = self.conn.cursor()
+        for sql, params in self.pending:
+            cursor.execute(sql, params)
+        self.pending.clear()
+    
+    def commit(self):
+        """Коммит записи метода вместе со всеми отложенными записями"""
+        self.writes += 1
+        self._execute_pending()
+        self.conn.commit()
+        self.commits += 1
+    
+    def close(self):
+        try:
+            if self.pending:
+                if self.conn is None:
+                    self.conn = self.db._open()
+                self._execute_pending()
+                self.conn.commit()
+                self.commits += 1
+        except Exception as e:
+            print(f"❌ Yozuvlarni saqlashda xato: {e}")
+        finally:
+            if self.conn is not None:
+                self.conn.close()
+
+class _UnitOfWorkConnection:
+    """Обертка над общим соединением: commit идет через единицу работы, close не закрывает соединение"""
+    
+    def __init__(self, uow):
+        self._uow = uow
+        self._conn = uow.conn
+        # Транзакцию, открытую внешним методом, вложенный метод не откатывает
+        self._outer_transaction = self._conn.in_transaction
+    
+    def cursor(self):
+        return self._conn.cursor()
+    
+    def execute(self, *args):
+        return self._conn.execute(*args)
+    
+    def commit(self):
+        self._uow.commit()
+    
+    def rollback(self):
+        self._conn.rollback()
+    
+    def close(self):
+        # Незакоммиченные изменения метода откатываются, как при закрытии обычного соединения
+        if self._conn.in_transaction and not self._outer_transaction:
+            self._conn.rollback()
 
 # БАЗА ДАННЫХ
+# Пользователи, смотревшие фильмы жанра (с повторами); параметр - значение жанра.
+# CROSS JOIN фиксирует порядок: иначе планировщик перебирает все watch_movie логи
+GENRE_VIEWERS_SQL = '''
+    SELECT l.user_id FROM movie_tags mt
+    CROSS JOIN user_activity_logs l ON l.action = 'watch_movie' AND l.details = mt.code
+    WHERE mt.tag_type = 'genre' AND mt.tag_value = ?
+'''
+
 class Database:
+    # Версия схемы хранится в PRAGMA user_version. Увеличивайте ее при любом изменении
+    # init_db/update_database - иначе существующие базы миграцию не получат
+    SCHEMA_VERSION = 7
+    
     def __init__(self, db_path="movies.db"):
         self.db_path = db_path
-        self.init_db()
+        # Счетчики единиц работы: апдейты, логические записи и реальные commit (fsync)
+        self.write_stats = Counter()
+        # Известные пользователи и время последней записи их активности - чтобы не писать лишний раз
+        self.known_users = set()
+        self.activity_window = ACTIVITY_COALESCE_SECONDS
+        self._activity_written_at = {}
+        self._pending_requests = Counter()
+        # Просмотры по (code, день UTC), еще не записанные в movie_views_daily и movies.views
+        self._pending_views = Counter()
+        # Активные каналы для проверки подписки - читаются на каждом апдейте
+        self._channels_cache = None
+        # Обращения к кэшам: (кэш, 'hit' | 'miss') -> число
+        self.cache_stats = Counter()
+        # Фильтры по категориям в памяти; загружается в warm_facets
+        self.facets = FacetIndex()
+        # Признаки фильмов для похожих по содержанию; загружается в warm_content
+        self.content = ContentIndex()
+        # Рейтинг популярных с затуханием; загружается в warm_trending
+        self.trending = TrendingBoard()
+        # warm_* строят индекс в потоке; изменения за время сборки записываются
+        # и повторяются на новом индексе перед подменой (имя индекса -> [журнал])
+        self._index_lock = threading.Lock()
+        self._index_journals = {}
+        # Профилировщик SQL: включается SQL_PROFILE=1 или командой /sqlprof on
+        self.profiler = SqlProfiler(db_path, SQL_SLOW_MS / 1000)
+        if SQL_PROFILE:
+            self.profiler.enable()
+        self.migrate()
+        self.seed_config()
+    
+    def _connect(self):
+        """Соединение для метода: общее соединение текущего апдейта или новое"""
+        uow = _current_uow.get()
+        if uow is not None and uow.db is self:
+            return uow.connection()
+        return self._open()
+    
+    def _open(self):
+        """Новое соединение; с включенным профилировщиком - с замером каждого запроса"""
+        if self.profiler.enabled:
+            return self.profiler.connect()
+        return sqlite3.connect(self.db_path)
+    
+    def _defer_write(self, sql, params):
+        """Откладывает запись в рамках апдейта; False, если единицы работы нет"""
+        uow = _current_uow.get()
+        if uow is None or uow.db is not self:
+            return False
+        uow.defer(sql, params)
+        return True
+    
+    @contextmanager
+    def unit_of_work(self):
+        """Объединяет все записи одного апдейта в минимальное число транзакций"""
+        if _current_uow.get() is not None:
+            yield _current_uow.get()
+            return
+        
+        uow = UnitOfWork(self)
+        token = _current_uow.set(uow)
+        try:
+            yield uow
+        finally:
+            _current_uow.reset(token)
+            uow.close()
+            self.write_stats['updates'] += 1
+            self.write_stats['writes'] += uow.writes
+            self.write_stats['commits'] += uow.commits
+            if uow.writes:
+                logger.debug(f"Apdeyt: {uow.writes} yozuv, {uow.commits} commit")
     
     def init_db(self):
         conn = sqlite3.connect(self.db_path)
@@ -65,7 +308,9 @@ class Database:
                 joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
                 last_activity DATETIME DEFAULT CURRENT_TIMESTAMP,
                 total_requests INTEGER DEFAULT 0,
-                is_premium BOOLEAN DEFAULT FALSE
+                is_premium BOOLEAN DEFAULT FALSE,
+                is_active BOOLEAN DEFAULT TRUE,
+                blocked_at DATETIME
             )
         ''')
         
@@ -166,6 +411,47 @@ class Database:
             )
         ''')
         
+        # Похожие фильмы: коды соседей через запятую, лучшие первыми.
+        # neighbors - по действиям пользователей, content_neighbors - по тегам и названию
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS movie_neighbors (
+                code TEXT PRIMARY KEY,
+                neighbors TEXT,
+                content_neighbors TEXT,
+                computed_at INTEGER
+            )
+        ''')
+        
+        # Лента "Siz uchun": коды фильмов через запятую, считается фоном для активных пользователей
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_feeds (
+                user_id INTEGER PRIMARY KEY,
+                codes TEXT NOT NULL,
+                expires_at INTEGER NOT NULL
+            )
+        ''')
+        
+        # Просмотры фильма по дням (день - 'YYYY-MM-DD' в UTC); пишутся пачками из flush_views
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS movie_views_daily (
+                code TEXT NOT NULL,
+                day TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (code, day)
+            ) WITHOUT ROWID
+        ''')
+        
+        # Состояние длинных callback-кнопок, вытесненное из памяти
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS callback_state (
+                token TEXT PRIMARY KEY,
+                tag TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                expires_at INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_callback_state_expires ON callback_state(expires_at)')
+        
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS bot_settings (
                 key TEXT PRIMARY KEY,
@@ -173,6 +459,19 @@ class Database:
             )
         ''')
         
+        conn.commit()
+        conn.close()
+        print("✅ Ma'lumotlar bazasi yangilandi")
+    
+    def seed_config(self):
+        """Добавляет настройки и каналы из config, которых еще нет в базе.
+
+        Выполняется при каждом запуске, а не в migrate: каналы, добавленные в config
+        после обновления схемы, тоже должны попасть в базу.
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
         # Добавляем начальные настройки
         cursor.execute('''
             INSERT OR IGNORE INTO bot_settings (key, value) VALUES 
@@ -193,10 +492,27 @@ class Database:
         
         conn.commit()
         conn.close()
-        print("✅ Ma'lumotlar bazasi yangilandi")
+    
+    def migrate(self):
+        """Приводит схему к SCHEMA_VERSION. Если база уже актуальна - это одно чтение PRAGMA"""
+        conn = sqlite3.connect(self.db_path)
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        conn.close()
+        if version >= self.SCHEMA_VERSION:
+            return False
+        
+        started = time.perf_counter()
+        self.init_db()
+        self.update_database()
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+        conn.commit()
+        conn.close()
+        logger.info(f"Sxema {version} -> {self.SCHEMA_VERSION} versiyaga yangilandi ({time.perf_counter() - started:.2f} s)")
+        return True
     
     def update_database(self):
-        """Обновляет структуру базы данных"""
+        """Обновляет структуру базы данных (данные дозаполняет backfill_movies в фоне)"""
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
@@ -209,8 +525,11 @@ class Database:
             ("users", "last_name", "TEXT"),
             ("users", "total_requests", "INTEGER DEFAULT 0"),
             ("users", "is_premium", "BOOLEAN DEFAULT FALSE"),
+            ("users", "is_active", "BOOLEAN DEFAULT TRUE"),
+            ("users", "blocked_at", "DATETIME"),
             ("channels", "is_active", "BOOLEAN DEFAULT TRUE"),
-            ("channels", "is_private", "BOOLEAN DEFAULT FALSE")
+            ("channels", "is_private", "BOOLEAN DEFAULT FALSE"),
+            ("movie_neighbors", "content_neighbors", "TEXT")
         ]
         
         for table, column, col_type in new_columns:
@@ -220,6 +539,17 @@ class Database:
             except sqlite3.OperationalError:
                 pass
         
+        # Индексы для быстрого отбора доступных пользователей и сегментов рассылки
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_is_active ON users (is_active)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_last_activity ON users (last_activity)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_premium ON users (is_premium, user_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_favorites_movie ON favorites (movie_code, user_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_activity_user_action ON user_activity_logs (user_id, action, details)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_movie_tags_value ON movie_tags (tag_type, tag_value)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_ratings_movie ON ratings (movie_code, rating)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_activity_action_time ON user_activity_logs (action, created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_activity_watchers ON user_activity_logs (action, details, user_id)')
+        
         # Создаем таблицу для заявок если ее нет
         try:
             cursor.execute('''
@@ -239,23 +569,31 @@ class Database:
         except sqlite3.OperationalError:
             pass
         
-        # Обновляем существующие записи
-        cursor.execute('UPDATE movies SET title = ? WHERE title IS NULL', ("Nomsiz film",))
-        
-        # Обновляем clean_title для существующих фильмов
-        cursor.execute('SELECT code, caption FROM movies WHERE clean_title IS NULL')
-        movies = cursor.fetchall()
-        for code, caption in movies:
-            clean_title = self._extract_clean_title(caption)
-            cursor.execute('UPDATE movies SET clean_title = ? WHERE code = ?', (clean_title, code))
-        
         conn.commit()
         conn.close()
+    
+    def backfill_movies(self, batch_size=500):
+        """Дозаполняет title и clean_title старых фильмов одной пачкой; возвращает число строк"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT code, caption FROM movies WHERE title IS NULL OR clean_title IS NULL LIMIT ?',
+            (batch_size,)
+        )
+        rows = [(caption_parser.parse(caption, code).clean_title, code) for code, caption in cursor.fetchall()]
+        if rows:
+            cursor.executemany(
+                'UPDATE movies SET title = COALESCE(title, \'Nomsiz film\'), clean_title = ? WHERE code = ?',
+                rows
+            )
+            conn.commit()
+        conn.close()
+        return len(rows)
 
     # НОВЫЕ МЕТОДЫ ДЛЯ РАБОТЫ С ЗАЯВКАМИ
     def add_channel_request(self, user_id, channel_id, status='pending'):
         """Добавляет или обновляет заявку на вступление в канал"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         try:
             cursor.execute('''
@@ -273,7 +611,7 @@ class Database:
     
     def get_channel_request(self, user_id, channel_id):
         """Получает информацию о заявке пользователя"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute(
             'SELECT status, created_at FROM channel_requests WHERE user_id = ? AND channel_id = ?',
@@ -285,7 +623,7 @@ class Database:
     
     def get_pending_requests_count(self, channel_id=None):
         """Получает количество ожидающих заявок"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         if channel_id:
@@ -302,7 +640,7 @@ class Database:
     
     def update_channel_request_status(self, user_id, channel_id, status):
         """Обновляет статус заявки"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         try:
             cursor.execute('''
@@ -320,7 +658,7 @@ class Database:
     
     def delete_channel_request(self, user_id, channel_id):
         """Удаляет заявку пользователя"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         try:
             cursor.execute(
@@ -337,7 +675,7 @@ class Database:
     
     def get_user_channel_requests(self, user_id):
         """Получает все заявки пользователя"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute('''
             SELECT cr.channel_id, cr.status, c.title, c.username, c.is_private
@@ -349,69 +687,49 @@ class Database:
         conn.close()
         return result
 
-    def _extract_clean_title(self, caption):
-        """Извлекает чистое название из описания для поиска"""
-        if not caption:
-            return "nomsiz film"
-        
-        # Убираем эмодзи и специальные символы, оставляем только текст
-        clean_caption = re.sub(r'[^\w\s]', ' ', caption)
-        clean_caption = re.sub(r'\s+', ' ', clean_caption).strip().lower()
-        
-        # Ищем хештег #nomi_Название
-        nomi_match = re.search(r'#nomi[_:]?([^#\n]+)', caption, re.IGNORECASE)
-        if nomi_match:
-            title = nomi_match.group(1).strip()
-            clean_title = re.sub(r'[^\w\s]', ' ', title)
-            clean_title = re.sub(r'\s+', ' ', clean_title).strip().lower()
-            return clean_title[:100]
-        
-        # Ищем хештег #nazar_Название
-        nazar_match = re.search(r'#nazar[_:]?([^#\n]+)', caption, re.IGNORECASE)
-        if nazar_match:
-            title = nazar_match.group(1).strip()
-            clean_title = re.sub(r'[^\w\s]', ' ', title)
-            clean_title = re.sub(r'\s+', ' ', clean_title).strip().lower()
-            return clean_title[:100]
-        
-        # Берем первую строку как название
-        lines = caption.split('\n')
-        for line in lines:
-            clean_line = re.sub(r'#\w+', '', line).strip()
-            if clean_line and len(clean_line) > 3:  # Минимум 3 символа
-                clean_title = re.sub(r'[^\w\s]', ' ', clean_line)
-                clean_title = re.sub(r'\s+', ' ', clean_title).strip().lower()
-                return clean_title[:100]
-        
-        return "nomsiz film"
-
     def add_movie(self, code, file_id, caption=None, duration=0, file_size=0):
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         try:
-            title = self._extract_title(caption)
-            clean_title = self._extract_clean_title(caption)
+            parsed = caption_parser.parse(caption, code)
+            title = parsed.title
             
             cursor.execute('''
                 INSERT OR REPLACE INTO movies (code, file_id, caption, title, clean_title, duration, file_size) 
                 VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (code, file_id, caption, title, clean_title, duration, file_size))
+            ''', (code, file_id, caption, title, parsed.clean_title, duration, file_size))
             
-            if caption:
-                self._parse_and_add_tags(code, caption, cursor)
+            # Перезаписанный фильм не должен сохранить теги старой подписи
+            cursor.execute('DELETE FROM movie_tags WHERE code = ?', (code,))
+            cursor.executemany(
+                'INSERT OR REPLACE INTO movie_tags (code, tag_type, tag_value) VALUES (?, ?, ?)',
+                [(code, tag_type, tag_value) for tag_type, tag_value in parsed.tags]
+            )
+            # Старые похожие по содержанию устарели; если пересчет ниже не удастся, их посчитает backfill
+            cursor.execute('UPDATE movie_neighbors SET content_neighbors = NULL WHERE code = ?', (code,))
             
             conn.commit()
-            print(f"✅ Video #{code} bazaga qo'shildi - Nomi: {title}")
-            return True
         except Exception as e:
+            conn.close()
             print(f"❌ Videoni qo'shishda xato: {e}")
             return False
+        
+        # Фильм уже в базе: индексы в памяти обновляются только после commit,
+        # и их ошибка не превращает успешное добавление в неудачное
+        try:
+            self._apply_index('facets', 'add', code, parsed.tags)
+            self._add_content(cursor, code, parsed.clean_title, parsed.tags)
+            conn.commit()
+        except Exception as e:
+            logger.error(f"#{code} xotiradagi indekslarga qo'shilmadi: {e}")
         finally:
             conn.close()
+        print(f"✅ Video #{code} bazaga qo'shildi - Nomi: {title}")
+        return True
 
     def delete_movie(self, code):
         """Удаляет фильм из базы данных"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         try:
             # Сначала получаем информацию о фильме для лога
@@ -425,6 +743,8 @@ class Database:
             
             # Удаляем связанные данные
             cursor.execute('DELETE FROM movie_tags WHERE code = ?', (code,))
+            cursor.execute('DELETE FROM movie_neighbors WHERE code = ?', (code,))
+            cursor.execute('DELETE FROM movie_views_daily WHERE code = ?', (code,))
             cursor.execute('DELETE FROM favorites WHERE movie_code = ?', (code,))
             cursor.execute('DELETE FROM ratings WHERE movie_code = ?', (code,))
             cursor.execute('DELETE FROM reports WHERE movie_code = ?', (code,))
@@ -433,6 +753,11 @@ class Database:
             cursor.execute('DELETE FROM movies WHERE code = ?', (code,))
             
             conn.commit()
+            self._apply_index('facets', 'remove', code)
+            self._apply_index('content', 'remove', code)
+            self._apply_index('trending', 'remove', code)
+            for key in [key for key in self._pending_views if key[0] == code]:
+                del self._pending_views[key]
             print(f"✅ Video #{code} bazadan o'chirildi - Nomi: {title}")
             return True, f"Film '{title}' (#{code}) o'chirildi"
             
@@ -442,96 +767,11 @@ class Database:
         finally:
             conn.close()
     
-    def _extract_title(self, caption):
-        """Извлекает название фильма из описания"""
-        if not caption:
-            return "Nomsiz film"
-        
-        # Сначала ищем хештег #nomi_Название
-        nomi_match = re.search(r'#nomi[_:]?([^#\n]+)', caption, re.IGNORECASE)
-        if nomi_match:
-            title = nomi_match.group(1).strip()
-            title = re.sub(r'[\n\r\t]', ' ', title)
-            return title[:100]
-        
-        # Ищем хештег #nazar_Название
-        nazar_match = re.search(r'#nazar[_:]?([^#\n]+)', caption, re.IGNORECASE)
-        if nazar_match:
-            title = nazar_match.group(1).strip()
-            title = re.sub(r'[\n\r\t]', ' ', title)
-            return title[:100]
-        
-        # Берем первую строку без хештегов как название
-        lines = caption.split('\n')
-        for line in lines:
-            clean_line = re.sub(r'#\w+', '', line).strip()
-            if clean_line and len(clean_line) > 3:
-                return clean_line[:100]
-        
-        return f"Video #{self._get_next_code()}"
-    
-    def _get_next_code(self):
-        """Генерирует следующий код для безымянных фильмов"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM movies')
-        count = cursor.fetchone()[0]
-        conn.close()
-        return f"VID{count + 1:04d}"
-    
-    def _parse_and_add_tags(self, code, caption, cursor):
-        hashtags = re.findall(r'#(\w+)', caption)
-        
-        for tag in hashtags:
-            tag_lower = tag.lower()
-            tag_type = None
-            tag_value = tag
-            
-            if tag_lower.startswith('nomi') or tag_lower.startswith('nazar'):
-                continue
-            
-            for genre in GENRES:
-                if genre.lower() in tag_lower or tag_lower in genre.lower():
-                    tag_type = "genre"
-                    tag_value = genre
-                    break
-            
-            if not tag_type:
-                for country in COUNTRIES:
-                    if country.lower() in tag_lower or tag_lower in country.lower():
-                        tag_type = "country"
-                        tag_value = country
-                        break
-            
-            if not tag_type and tag.isdigit() and len(tag) == 4:
-                if tag in YEARS:
-                    tag_type = "year"
-                    tag_value = tag
-            
-            if not tag_type:
-                for quality in QUALITIES:
-                    if quality.lower() in tag_lower or tag_lower in quality.lower():
-                        tag_type = "quality"
-                        tag_value = quality
-                        break
-            
-            if not tag_type:
-                for lang in LANGUAGES:
-                    if lang.lower() in tag_lower or tag_lower in lang.lower():
-                        tag_type = "language"
-                        tag_value = lang
-                        break
-            
-            if tag_type:
-                cursor.execute(
-                    'INSERT OR REPLACE INTO movie_tags (code, tag_type, tag_value) VALUES (?, ?, ?)',
-                    (code, tag_type, tag_value)
-                )
 
     # УЛУЧШЕННЫЙ ПОИСК ПО НАЗВАНИЮ
     def search_movies_by_title(self, query, limit=20):
         """Улучшенный поиск по названию - ищет в clean_title (первая строка)"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         # Очищаем запрос так же как clean_title
@@ -561,7 +801,7 @@ class Database:
 
     def search_movies(self, query):
         """Улучшенный поиск: по коду, названию и хештегам"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         # Поиск по коду (точное совпадение)
@@ -601,40 +841,165 @@ class Database:
         conn.close()
         return [(code, title) for code, title, clean_title in results]
 
-    def get_movies_by_tag(self, tag_type, tag_value, limit=5, offset=0):
-        """Поиск фильмов по тегам"""
-        conn = sqlite3.connect(self.db_path)
+    # ИНДЕКСЫ В ПАМЯТИ
+    def _apply_index(self, name, method, *args):
+        """Изменяет индекс в памяти; если он сейчас перестраивается - еще и записывает изменение"""
+        with self._index_lock:
+            getattr(getattr(self, name), method)(*args)
+            for journal in self._index_journals.get(name, ()):
+                journal.append((method, args))
+    
+    @contextmanager
+    def _index_journal(self, name):
+        """Журнал изменений индекса name на время его перестройки"""
+        journal = []
+        with self._index_lock:
+            self._index_journals.setdefault(name, []).append(journal)
+        try:
+            yield journal
+        finally:
+            with self._index_lock:
+                self._index_journals[name].remove(journal)
+                if not self._index_journals[name]:
+                    del self._index_journals[name]
+    
+    def _swap_index(self, name, index, journal):
+        """Повторяет на index изменения, сделанные за время его сборки, и подменяет им текущий"""
+        with self._index_lock:
+            for method, args in journal:
+                getattr(index, method)(*args)
+            setattr(self, name, index)
+    
+    # ФИЛЬТРЫ ПО КАТЕГОРИЯМ
+    def warm_facets(self):
+        """Строит индекс фильтров из movies и movie_tags; возвращает число фильмов"""
+        with self._index_journal('facets') as journal:
+            conn = self._connect()
+            cursor = conn.cursor()
+            cursor.execute('SELECT code, views FROM movies ORDER BY added_date, rowid')
+            movies = cursor.fetchall()
+            cursor.execute('SELECT code, tag_type, tag_value FROM movie_tags')
+            tags = cursor.fetchall()
+            conn.close()
+            
+            index = FacetIndex()
+            count = index.load(movies, tags)
+            self._swap_index('facets', index, journal)
+        return count
+    
+    def _loaded_facets(self):
+        if not self.facets.loaded:
+            self.warm_facets()
+        return self.facets
+    
+    # ПОХОЖИЕ ПО СОДЕРЖАНИЮ
+    def warm_content(self):
+        """Строит индекс признаков из movies и movie_tags; возвращает число фильмов"""
+        with self._index_journal('content') as journal:
+            conn = self._connect()
+            cursor = conn.cursor()
+            cursor.execute('SELECT code, clean_title FROM movies ORDER BY added_date, rowid')
+            movies = cursor.fetchall()
+            cursor.execute('SELECT code, tag_type, tag_value FROM movie_tags')
+            tags = cursor.fetchall()
+            conn.close()
+            
+            index = ContentIndex()
+            count = index.load(movies, tags)
+            self._swap_index('content', index, journal)
+        return count
+    
+    def _loaded_content(self):
+        if not self.content.loaded:
+            self.warm_content()
+        return self.content
+    
+    def _save_content_neighbors(self, cursor, rows):
+        """rows - [(code, [(сосед, сходство)])]; пустая строка - соседей нет, но фильм посчитан"""
+        now = int(time.time())
+        cursor.executemany('''
+            INSERT INTO movie_neighbors (code, content_neighbors, computed_at) VALUES (?, ?, ?)
+            ON CONFLICT(code) DO UPDATE SET content_neighbors = excluded.content_neighbors
+        ''', [(code, ",".join(other for other, _ in found), now) for code, found in rows])
+    
+    def _add_content(self, cursor, code, clean_title, tags):
+        """Новый фильм сразу получает похожие по содержанию - без истории просмотров"""
+        content = self._loaded_content()
+        self._apply_index('content', 'add', code, clean_title, tags)
+        self._save_content_neighbors(cursor, [(code, content.neighbors(code, RECOMMENDATIONS_TOP_K))])
+    
+    def backfill_content_neighbors(self, batch_size=500):
+        """Считает похожие по содержанию для фильмов без них одной пачкой; возвращает число фильмов"""
+        conn = self._connect()
         cursor = conn.cursor()
-        
         cursor.execute('''
-            SELECT DISTINCT m.code, m.title 
-            FROM movies m
-            JOIN movie_tags mt ON m.code = mt.code
-            WHERE mt.tag_type = ? AND LOWER(mt.tag_value) = LOWER(?)
-            ORDER BY m.added_date DESC
-            LIMIT ? OFFSET ?
-        ''', (tag_type, tag_value, limit, offset))
-        result = cursor.fetchall()
+            SELECT m.code FROM movies m
+            LEFT JOIN movie_neighbors n ON n.code = m.code
+            WHERE n.content_neighbors IS NULL
+            LIMIT ?
+        ''', (batch_size,))
+        codes = [row[0] for row in cursor.fetchall()]
+        if codes:
+            content = self._loaded_content()
+            self._save_content_neighbors(
+                cursor, [(code, content.neighbors(code, RECOMMENDATIONS_TOP_K)) for code in codes]
+            )
+            conn.commit()
         conn.close()
-        return result
+        return len(codes)
     
-    def get_movies_count_by_tag(self, tag_type, tag_value):
-        """Подсчет фильмов по тегам"""
-        conn = sqlite3.connect(self.db_path)
+    def get_similar_movies(self, code, limit=10):
+        """Похожие фильмы [(code, title)]: сначала по действиям пользователей, затем по содержанию"""
+        conn = self._connect()
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT COUNT(DISTINCT m.code)
-            FROM movies m
-            JOIN movie_tags mt ON m.code = mt.code
-            WHERE mt.tag_type = ? AND LOWER(mt.tag_value) = LOWER(?)
-        ''', (tag_type, tag_value))
-        result = cursor.fetchone()[0]
+        cursor.execute('SELECT neighbors, content_neighbors FROM movie_neighbors WHERE code = ?', (code,))
+        row = cursor.fetchone()
         conn.close()
-        return result
-
+        if not row:
+            return []
+        codes = []
+        for neighbors in row:
+            for other in (neighbors or "").split(","):
+                if other and other not in codes:
+                    codes.append(other)
+        return self.get_movies_by_codes(codes[:limit])
+    
+    def get_user_feed(self, user_id):
+        """Коды ленты "Siz uchun" или [] если ее нет или она устарела"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT codes FROM user_feeds WHERE user_id = ? AND expires_at > ?', (user_id, int(time.time())))
+        row = cursor.fetchone()
+        conn.close()
+        return row[0].split(",") if row else []
+    
+    def get_movies_by_codes(self, codes):
+        """[(code, title)] в порядке codes"""
+        if not codes:
+            return []
+        conn = self._connect()
+        cursor = conn.cursor()
+        placeholders = ",".join("?" * len(codes))
+        cursor.execute(f'SELECT code, title FROM movies WHERE code IN ({placeholders})', list(codes))
+        titles = dict(cursor.fetchall())
+        conn.close()
+        return [(code, titles[code]) for code in codes if code in titles]
+    
+    def browse_movies(self, filters, limit=5, offset=0, order="recent"):
+        """Фильмы по набору фильтров [(tag_type, value)]: ([(code, title)], всего)"""
+        facets = self._loaded_facets()
+        bitmap = facets.query(filters)
+        codes = facets.page(bitmap, offset, limit, order)
+        return self.get_movies_by_codes(codes), facets.count(bitmap)
+    
+    def get_facet_counts(self, tag_type, filters=()):
+        """{значение: число фильмов} для кнопок категории с учетом уже выбранных фильтров"""
+        facets = self._loaded_facets()
+        return dict(facets.values(tag_type, facets.query(filters)))
+    
     def get_setting(self, key):
         """Получает значение настройки"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute('SELECT value FROM bot_settings WHERE key = ?', (key,))
         result = cursor.fetchone()
@@ -643,7 +1008,7 @@ class Database:
     
     def update_setting(self, key, value):
         """Обновляет значение настройки"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute('INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)', (key, value))
         conn.commit()
@@ -652,17 +1017,35 @@ class Database:
 
     def log_user_activity(self, user_id, action, details=None):
         """Логирует действия пользователя"""
-        conn = sqlite3.connect(self.db_path)
+        sql = 'INSERT INTO user_activity_logs (user_id, action, details) VALUES (?, ?, ?)'
+        params = (user_id, action, details)
+        if self._defer_write(sql, params):
+            return
+        
+        conn = self._connect()
         cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO user_activity_logs (user_id, action, details) VALUES (?, ?, ?)',
-            (user_id, action, details)
-        )
+        cursor.execute(sql, params)
         conn.commit()
         conn.close()
     
+    def warm_known_users(self):
+        """Загружает id всех пользователей в память"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT user_id FROM users')
+        self.known_users = {row[0] for row in cursor}
+        conn.close()
+        return len(self.known_users)
+    
     def add_user(self, user_id, username=None, first_name=None, last_name=None):
-        conn = sqlite3.connect(self.db_path)
+        # Уже известный пользователь - INSERT OR IGNORE все равно ничего не изменит
+        if user_id in self.known_users:
+            self.write_stats['skipped_user_writes'] += 1
+            self.cache_stats[('known_users', 'hit')] += 1
+            return
+        self.cache_stats[('known_users', 'miss')] += 1
+        
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute(
             'INSERT OR IGNORE INTO users (user_id, username, first_name, last_name) VALUES (?, ?, ?, ?)',
@@ -670,21 +1053,62 @@ class Database:
         )
         conn.commit()
         conn.close()
+        self.known_users.add(user_id)
     
     def update_user_activity(self, user_id):
-        """Обновляет активность пользователя"""
-        conn = sqlite3.connect(self.db_path)
+        """Обновляет активность пользователя (не чаще раза в activity_window секунд)"""
+        now = time.monotonic()
+        written_at = self._activity_written_at.get(user_id)
+        if written_at is not None and now - written_at < self.activity_window:
+            # Недавно уже записали - только копим счетчик запросов
+            self._pending_requests[user_id] += 1
+            self.write_stats['skipped_user_writes'] += 1
+            return
+        
+        if len(self._activity_written_at) >= 50000:
+            self._activity_written_at = {
+                uid: t for uid, t in self._activity_written_at.items() if now - t < self.activity_window
+            }
+        self._activity_written_at[user_id] = now
+        requests = self._pending_requests.pop(user_id, 0) + 1
+        
+        # Пользователь снова пишет боту - значит он снова доступен
+        sql = '''UPDATE users SET last_activity = CURRENT_TIMESTAMP, total_requests = total_requests + ?,
+                 is_active = TRUE, blocked_at = NULL WHERE user_id = ?'''
+        if self._defer_write(sql, (requests, user_id)):
+            return
+        
+        conn = self._connect()
         cursor = conn.cursor()
-        cursor.execute(
-            'UPDATE users SET last_activity = CURRENT_TIMESTAMP, total_requests = total_requests + 1 WHERE user_id = ?',
-            (user_id,)
-        )
+        cursor.execute(sql, (requests, user_id))
         conn.commit()
         conn.close()
     
+    def flush_user_activity(self):
+        """Записывает накопленные в памяти счетчики запросов"""
+        if not self._pending_requests:
+            return 0
+        pending, self._pending_requests = self._pending_requests, Counter()
+        
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.executemany(
+                'UPDATE users SET total_requests = total_requests + ? WHERE user_id = ?',
+                [(count, user_id) for user_id, count in pending.items()]
+            )
+            conn.commit()
+        except Exception:
+            # Как и в flush_views: счетчики вернутся в следующий flush
+            self._pending_requests.update(pending)
+            raise
+        finally:
+            conn.close()
+        return len(pending)
+    
     def add_rating(self, user_id, movie_code, rating, review=None):
         """Добавляет оценку фильму"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         try:
             cursor.execute(
@@ -701,7 +1125,7 @@ class Database:
     
     def get_movie_rating(self, movie_code):
         """Получает средний рейтинг фильма"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute(
             'SELECT AVG(rating), COUNT(*) FROM ratings WHERE movie_code = ?',
@@ -716,7 +1140,7 @@ class Database:
     
     def get_user_rating(self, user_id, movie_code):
         """Получает оценку пользователя для фильма"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute(
             'SELECT rating, review FROM ratings WHERE user_id = ? AND movie_code = ?',
@@ -728,7 +1152,7 @@ class Database:
     
     def get_random_movie(self):
         """Получает случайный фильм"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute(
             'SELECT code, title FROM movies ORDER BY RANDOM() LIMIT 1'
@@ -739,7 +1163,7 @@ class Database:
     
     def get_popular_movies(self, limit=10):
         """Получает популярные фильмы"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute(
             'SELECT code, title, views FROM movies ORDER BY views DESC LIMIT ?',
@@ -751,7 +1175,7 @@ class Database:
     
     def get_daily_active_users(self):
         """Получает количество активных пользователей за сегодня"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute(
             'SELECT COUNT(DISTINCT user_id) FROM user_activity_logs WHERE DATE(created_at) = DATE("now")'
@@ -762,7 +1186,7 @@ class Database:
     
     def get_user_stats(self, user_id):
         """Получает статистику пользователя"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         cursor.execute('SELECT COUNT(*) FROM favorites WHERE user_id = ?', (user_id,))
@@ -785,7 +1209,7 @@ class Database:
 
     def add_report(self, user_id, movie_code, report_type, description=None):
         """Добавляет жалобу на фильм"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         try:
             cursor.execute(
@@ -802,7 +1226,7 @@ class Database:
     
     def get_pending_reports(self):
         """Получает все необработанные жалобы"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute('''
             SELECT r.id, r.user_id, r.movie_code, r.report_type, r.description, r.created_at,
@@ -819,7 +1243,7 @@ class Database:
     
     def resolve_report(self, report_id, admin_id):
         """Помечает жалобу как решенную"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         try:
             cursor.execute(
@@ -836,7 +1260,7 @@ class Database:
     
     def get_reports_count(self):
         """Получает количество жалоб"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute('SELECT COUNT(*) FROM reports WHERE status = "pending"')
         pending_count = cursor.fetchone()[0]
@@ -846,16 +1270,25 @@ class Database:
         return pending_count, total_count
 
     def get_all_channels(self):
-        conn = sqlite3.connect(self.db_path)
+        if self._channels_cache is None:
+            self.cache_stats[('channels', 'miss')] += 1
+            self.warm_channels()
+        else:
+            self.cache_stats[('channels', 'hit')] += 1
+        return list(self._channels_cache)
+    
+    def warm_channels(self):
+        """Загружает активные каналы в память"""
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute('SELECT channel_id, username, title, invite_link, is_private FROM channels WHERE is_active = TRUE')
-        result = cursor.fetchall()
+        self._channels_cache = cursor.fetchall()
         conn.close()
-        return result
+        return len(self._channels_cache)
     
     def add_channel(self, channel_id, username="", title=None, invite_link=None, is_private=False):
         """Добавляет канал в базу данных"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         try:
             cursor.execute(
@@ -863,6 +1296,7 @@ class Database:
                 (channel_id, username, title, invite_link, is_private)
             )
             conn.commit()
+            self._channels_cache = None
             return True
         except Exception as e:
             print(f"❌ Kanal qo'shishda xato: {e}")
@@ -872,11 +1306,12 @@ class Database:
     
     def delete_channel(self, channel_id):
         """Удаляет канал из базы данных"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         try:
             cursor.execute('DELETE FROM channels WHERE channel_id = ?', (channel_id,))
             conn.commit()
+            self._channels_cache = None
             return True
         except Exception as e:
             print(f"❌ Kanalni o'chirishda xato: {e}")
@@ -885,78 +1320,314 @@ class Database:
             conn.close()
 
     def get_movie(self, code):
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute('SELECT code, file_id, caption, title, duration, file_size FROM movies WHERE code = ?', (code,))
         result = cursor.fetchone()
         conn.close()
         return result
     
-    def get_all_users(self):
-        conn = sqlite3.connect(self.db_path)
+    def get_movie_card(self, code, user_id):
+        """Все данные для карточки фильма одним запросом: фильм, рейтинг, оценка и избранное пользователя"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT m.code, m.file_id, m.caption, m.title, m.duration, m.file_size,
+                   r.avg_rating, r.rating_count,
+                   (SELECT rating FROM ratings WHERE movie_code = m.code AND user_id = ?),
+                   EXISTS (SELECT 1 FROM favorites WHERE movie_code = m.code AND user_id = ?)
+            FROM movies m
+            LEFT JOIN (
+                SELECT AVG(rating) AS avg_rating, COUNT(*) AS rating_count
+                FROM ratings WHERE movie_code = ?
+            ) r
+            WHERE m.code = ?
+        ''', (user_id, user_id, code, code))
+        row = cursor.fetchone()
+        conn.close()
+        
+        if not row:
+            return None
+        
+        code, file_id, caption, title, duration, file_size, avg_rating, rating_count, user_rating, is_fav = row
+        return {
+            'code': code,
+            'file_id': file_id,
+            'caption': caption,
+            'title': title,
+            'duration': duration,
+            'file_size': file_size,
+            'avg_rating': float(avg_rating) if avg_rating is not None else 0.0,
+            'rating_count': rating_count or 0,
+            'user_rating': user_rating,
+            'is_favorite': bool(is_fav)
+        }
+    
+    def record_movie_view(self, user_id, movie_code):
+        """Логирует просмотр; счетчики просмотров копятся в памяти до flush_views"""
+        self.increment_views(movie_code)
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute(
+            'INSERT INTO user_activity_logs (user_id, action, details) VALUES (?, ?, ?)',
+            (user_id, "watch_movie", movie_code)
+        )
+        conn.commit()
+        conn.close()
+        self._apply_index('facets', 'record_view', movie_code)
+        self._apply_index('trending', 'record', movie_code)
+
+    def get_all_users(self, include_inactive=False):
+        """Получает пользователей (по умолчанию только доступных)"""
+        conn = self._connect()
         cursor = conn.cursor()
-        cursor.execute('SELECT user_id, username, first_name, last_name, joined_at, total_requests FROM users')
+        if include_inactive:
+            cursor.execute('SELECT user_id, username, first_name, last_name, joined_at, total_requests FROM users')
+        else:
+            cursor.execute(
+                'SELECT user_id, username, first_name, last_name, joined_at, total_requests FROM users WHERE is_active = TRUE'
+            )
         result = cursor.fetchall()
         conn.close()
         return result
     
     def get_users_count(self):
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute('SELECT COUNT(*) FROM users')
         result = cursor.fetchone()[0]
         conn.close()
         return result
 
-    def increment_views(self, movie_code):
-        conn = sqlite3.connect(self.db_path)
+    # ОТСЛЕЖИВАНИЕ НЕДОСТУПНЫХ ПОЛЬЗОВАТЕЛЕЙ
+    def mark_users_inactive(self, user_ids):
+        """Помечает пользователей, заблокировавших бота или удаливших аккаунт"""
+        if not user_ids:
+            return 0
+        conn = self._connect()
         cursor = conn.cursor()
-        cursor.execute('UPDATE movies SET views = views + 1 WHERE code = ?', (movie_code,))
-        conn.commit()
-        conn.close()
+        try:
+            cursor.executemany(
+                'UPDATE users SET is_active = FALSE, blocked_at = CURRENT_TIMESTAMP WHERE user_id = ? AND is_active = TRUE',
+                [(user_id,) for user_id in user_ids]
+            )
+            conn.commit()
+            # Следующая активность пользователя должна сразу вернуть его в доступные
+            for user_id in user_ids:
+                self._activity_written_at.pop(user_id, None)
+            return cursor.rowcount
+        except Exception as e:
+            print(f"❌ Foydalanuvchilarni belgilashda xato: {e}")
+            return 0
+        finally:
+            conn.close()
     
-    def get_top_movies(self, limit=10, offset=0, min_views=100):
-        conn = sqlite3.connect(self.db_path)
+    def mark_user_inactive(self, user_id):
+        """Помечает одного пользователя как недоступного"""
+        return self.mark_users_inactive([user_id])
+    
+    def get_users_health_counts(self):
+        """Возвращает количество доступных и недоступных пользователей"""
+        conn = self._connect()
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT code, title, views 
-            FROM movies 
-            WHERE views >= ?
-            ORDER BY views DESC
-            LIMIT ? OFFSET ?
-        ''', (min_views, limit, offset))
-        result = cursor.fetchall()
+        cursor.execute('SELECT is_active, COUNT(*) FROM users GROUP BY is_active')
+        counts = dict(cursor.fetchall())
         conn.close()
-        return result
-    
-    def get_top_movies_count(self, min_views=100):
-        conn = sqlite3.connect(self.db_path)
+        active = sum(count for is_active, count in counts.items() if is_active)
+        inactive = sum(count for is_active, count in counts.items() if not is_active)
+        return active, inactive
+
+    # СЕГМЕНТЫ АУДИТОРИИ ДЛЯ РАССЫЛКИ
+    def _audience_query(self, segment, value=None):
+        """Строит запрос сегмента: (FROM/WHERE часть, колонка user_id, параметры)"""
+        if segment == "all":
+            return "FROM users u WHERE u.is_active = TRUE", "u.user_id", []
+        if segment == "active":
+            cutoff = (datetime.datetime.utcnow() - datetime.timedelta(days=int(value))).strftime('%Y-%m-%d %H:%M:%S')
+            return "FROM users u WHERE u.is_active = TRUE AND u.last_activity >= ?", "u.user_id", [cutoff]
+        if segment == "premium":
+            return "FROM users u WHERE u.is_premium = TRUE AND u.is_active = TRUE", "u.user_id", []
+        if segment == "genre":
+            # От жанра к пользователям: фильмы жанра -> их просмотры -> пользователи,
+            # стоимость зависит от размера сегмента, а не от всей таблицы users
+            return f"FROM users u WHERE u.is_active = TRUE AND u.user_id IN ({GENRE_VIEWERS_SQL})", "u.user_id", [value]
+        if segment == "favorite":
+            return '''FROM favorites f JOIN users u ON u.user_id = f.user_id
+                      WHERE f.movie_code = ? AND u.is_active = TRUE''', "f.user_id", [value]
+        raise ValueError(f"Noma'lum segment: {segment}")
+    
+    def count_audience(self, segment, value=None):
+        """Подсчитывает количество получателей сегмента"""
+        from_where, id_column, params = self._audience_query(segment, value)
+        conn = self._connect()
         cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM movies WHERE views >= ?', (min_views,))
+        cursor.execute(f'SELECT COUNT(*) {from_where}', params)
         result = cursor.fetchone()[0]
         conn.close()
         return result
     
-    def get_recent_movies_by_years(self, years_range, limit=10, offset=0):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        placeholders = ','.join('?' * len(years_range))
-        cursor.execute(f'''
-            SELECT m.code, m.title 
-            FROM movies m
-            JOIN movie_tags mt ON m.code = mt.code
-            WHERE mt.tag_type = 'year' AND mt.tag_value IN ({placeholders})
-            ORDER BY m.added_date DESC
-            LIMIT ? OFFSET ?
-        ''', years_range + [limit, offset])
+    def iter_audience_ids(self, segment, value=None, batch_size=500):
+        """Отдает user_id сегмента пачками по индексу (keyset-пагинация по user_id)"""
+        if segment == "genre":
+            yield from self._iter_genre_audience(value, batch_size)
+            return
+        from_where, id_column, params = self._audience_query(segment, value)
+        last_id = None
+        while True:
+            # Каждая пачка - отдельное короткое чтение, чтобы не держать блокировку во время рассылки
+            conn = self._connect()
+            cursor = conn.cursor()
+            if last_id is None:
+                cursor.execute(
+                    f'SELECT {id_column} {from_where} ORDER BY {id_column} LIMIT ?',
+                    params + [batch_size]
+                )
+            else:
+                cursor.execute(
+                    f'SELECT {id_column} {from_where} AND {id_column} > ? ORDER BY {id_column} LIMIT ?',
+                    params + [last_id, batch_size]
+                )
+            batch = [row[0] for row in cursor.fetchall()]
+            conn.close()
+            
+            if not batch:
+                return
+            yield batch
+            if len(batch) < batch_size:
+                return
+            last_id = batch[-1]
+
+    def _iter_genre_audience(self, genre, batch_size):
+        """Зрители жанра читаются один раз; пачки только отсеивают недоступных по первичному ключу.
+        
+        Keyset-запрос с подзапросом IN заново собирал бы зрителей жанра на каждую пачку.
+        """
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT DISTINCT user_id FROM ({GENRE_VIEWERS_SQL}) ORDER BY user_id', (genre,))
+        viewers = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        
+        for start in range(0, len(viewers), batch_size):
+            candidates = viewers[start:start + batch_size]
+            conn = self._connect()
+            cursor = conn.cursor()
+            placeholders = ",".join("?" * len(candidates))
+            cursor.execute(
+                f'SELECT user_id FROM users WHERE user_id IN ({placeholders}) AND is_active = TRUE ORDER BY user_id',
+                candidates
+            )
+            batch = [row[0] for row in cursor.fetchall()]
+            conn.close()
+            if batch:
+                yield batch
+
+    def increment_views(self, movie_code):
+        self._pending_views[(movie_code, time.strftime('%Y-%m-%d', time.gmtime()))] += 1
+    
+    def flush_views(self):
+        """Записывает накопленные просмотры: по дням и в общий счетчик, одной транзакцией"""
+        if not self._pending_views:
+            return 0
+        pending, self._pending_views = self._pending_views, Counter()
+        totals = Counter()
+        for (code, _), count in pending.items():
+            totals[code] += count
+        
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT INTO movie_views_daily (code, day, count) VALUES (?, ?, ?)
+                ON CONFLICT(code, day) DO UPDATE SET count = count + excluded.count
+            ''', [(code, day, count) for (code, day), count in pending.items()])
+            cursor.executemany(
+                'UPDATE movies SET views = views + ? WHERE code = ?',
+                [(count, code) for code, count in totals.items()]
+            )
+            conn.commit()
+        except Exception:
+            # Запись не удалась (например, база занята) - просмотры вернутся в следующий flush.
+            # Просмотры, накопленные за время записи, складываются с возвращенными
+            self._pending_views.update(pending)
+            raise
+        finally:
+            conn.close()
+        return len(pending)
+    
+    def get_movie_daily_views(self, movie_code, days=30):
+        """[(день, просмотры)] за последние days дней, включая еще не записанные; пустые дни - 0"""
+        today = datetime.datetime.utcnow().date()
+        day_list = [(today - datetime.timedelta(days=n)).isoformat() for n in range(days - 1, -1, -1)]
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT day, count FROM movie_views_daily WHERE code = ? AND day >= ? ORDER BY day',
+            (movie_code, day_list[0])
+        )
+        counts = Counter(dict(cursor.fetchall()))
+        conn.close()
+        for (code, day), count in self._pending_views.items():
+            if code == movie_code:
+                counts[day] += count
+        return [(day, counts[day]) for day in day_list]
+    
+    # ПОПУЛЯРНЫЕ С ЗАТУХАНИЕМ
+    def warm_trending(self):
+        """Строит рейтинги из счетчиков просмотров и почасовых просмотров за неделю; возвращает число фильмов"""
+        with self._index_journal('trending') as journal:
+            conn = self._connect()
+            cursor = conn.cursor()
+            cursor.execute('SELECT code, views FROM movies WHERE views > 0')
+            views = cursor.fetchall()
+            cursor.execute('''
+                SELECT l.details, CAST(strftime('%s', l.created_at) AS INTEGER) / 3600 * 3600 AS hour, COUNT(*)
+                FROM user_activity_logs l
+                JOIN movies m ON m.code = l.details
+                WHERE l.action = 'watch_movie' AND l.created_at >= datetime('now', '-7 days')
+                GROUP BY l.details, hour
+            ''')
+            buckets = cursor.fetchall()
+            conn.close()
+            
+            board = TrendingBoard()
+            count = board.load(views, buckets)
+            self._swap_index('trending', board, journal)
+        return count
+    
+    def _loaded_trending(self):
+        if not self.trending.loaded:
+            self.warm_trending()
+        return self.trending
+    
+    def get_trending_movies(self, period="today", limit=10, offset=0):
+        """([(code, title, оценка)], всего) для периода today, week или all"""
+        trending = self._loaded_trending()
+        scored = trending.page(period, offset, limit)
+        titles = dict(self.get_movies_by_codes([code for code, _ in scored]))
+        movies = [(code, titles[code], score) for code, score in scored if code in titles]
+        return movies, trending.count(period)
+    
+    def get_recent_movies_by_years(self, years_range, limit=10, offset=0):
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        placeholders = ','.join('?' * len(years_range))
+        cursor.execute(f'''
+            SELECT m.code, m.title 
+            FROM movies m
+            JOIN movie_tags mt ON m.code = mt.code
+            WHERE mt.tag_type = 'year' AND mt.tag_value IN ({placeholders})
+            ORDER BY m.added_date DESC
+            LIMIT ? OFFSET ?
+        ''', years_range + [limit, offset])
         
         result = cursor.fetchall()
         conn.close()
         return result
     
     def get_recent_movies_count_by_years(self, years_range):
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         placeholders = ','.join('?' * len(years_range))
@@ -972,7 +1643,7 @@ class Database:
         return result
 
     def add_to_favorites(self, user_id, movie_code):
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         try:
             cursor.execute('INSERT OR IGNORE INTO favorites (user_id, movie_code) VALUES (?, ?)', 
@@ -986,7 +1657,7 @@ class Database:
             conn.close()
     
     def remove_from_favorites(self, user_id, movie_code):
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute('DELETE FROM favorites WHERE user_id = ? AND movie_code = ?', 
                      (user_id, movie_code))
@@ -995,7 +1666,7 @@ class Database:
         return True
     
     def get_favorites(self, user_id, limit=10, offset=0):
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute('''
             SELECT m.code, m.title 
@@ -1010,7 +1681,7 @@ class Database:
         return result
     
     def get_favorites_count(self, user_id):
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute('SELECT COUNT(*) FROM favorites WHERE user_id = ?', (user_id,))
         result = cursor.fetchone()[0]
@@ -1018,7 +1689,7 @@ class Database:
         return result
     
     def is_favorite(self, user_id, movie_code):
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute('SELECT 1 FROM favorites WHERE user_id = ? AND movie_code = ?', 
                      (user_id, movie_code))
@@ -1028,7 +1699,7 @@ class Database:
 
     def get_all_movies(self, limit=50, offset=0):
         """Получает все фильмы с пагинацией"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute('''
             SELECT code, title 
@@ -1042,15 +1713,183 @@ class Database:
 
     def get_all_movies_count(self):
         """Получает общее количество фильмов"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute('SELECT COUNT(*) FROM movies')
         result = cursor.fetchone()[0]
         conn.close()
         return result
 
+    # СОСТОЯНИЕ CALLBACK-КНОПОК
+    def save_callback_states(self, rows):
+        """Сохраняет токены [(token, tag, payload_json, expires_at)] и удаляет истекшие"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        if rows:
+            cursor.executemany('''
+                INSERT INTO callback_state (token, tag, payload, expires_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(token) DO UPDATE SET expires_at = MAX(expires_at, excluded.expires_at)
+            ''', rows)
+        cursor.execute('DELETE FROM callback_state WHERE expires_at < ?', (int(time.time()),))
+        conn.commit()
+        conn.close()
+    
+    def get_callback_state(self, token):
+        """Возвращает (tag, payload_json, expires_at) для действующего токена или None"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT tag, payload, expires_at FROM callback_state
+            WHERE token = ? AND expires_at >= ?
+        ''', (token, int(time.time())))
+        result = cursor.fetchone()
+        conn.close()
+        return result
+
+# Время каждого публичного метода - в bot_db_seconds{method=...}
+instrument_methods(Database, DB_SECONDS)
+
 db = Database()
-db.update_database()
+
+# ХРАНИЛИЩЕ СОСТОЯНИЯ CALLBACK-КНОПОК
+class CallbackStateStore:
+    """Короткие токены для кнопок, чьи данные не помещаются в 64 байта callback_data.
+
+    Токен - хэш от (тег, аргументы), поэтому одна и та же кнопка при каждой отрисовке
+    получает один и тот же токен. Свежие токены живут в LRU в памяти, вытесненные
+    пачками уходят в таблицу callback_state и читаются оттуда при нажатии.
+    """
+    
+    TOKEN_BYTES = 9  # 12 символов base64
+    SPILL_BATCH = 500
+    
+    def __init__(self, database, capacity=CALLBACK_STATE_CAPACITY, ttl=CALLBACK_STATE_TTL):
+        self.db = database
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries = OrderedDict()  # токен -> (тег, аргументы, истекает)
+        self._spilled = {}  # вытесненные, но еще не записанные в базу
+        self._dirty = set()  # токены в памяти, которых еще нет в базе
+        self.stats = Counter()
+    
+    @classmethod
+    def make_token(cls, tag, args):
+        raw = json.dumps([tag, list(args)], ensure_ascii=False, separators=(',', ':'))
+        digest = hashlib.blake2b(raw.encode(), digest_size=cls.TOKEN_BYTES).digest()
+        return base64.urlsafe_b64encode(digest).decode()
+    
+    def put(self, tag, args):
+        """Запоминает (тег, аргументы) и возвращает токен"""
+        token = self.make_token(tag, args)
+        expires_at = int(time.time()) + self.ttl
+        if token not in self._entries:
+            self._dirty.add(token)
+        self._entries[token] = (tag, tuple(args), expires_at)
+        self._entries.move_to_end(token)
+        self._spilled.pop(token, None)
+        
+        while len(self._entries) > self.capacity:
+            old_token, entry = self._entries.popitem(last=False)
+            self._dirty.discard(old_token)
+            self._spilled[old_token] = entry
+        if len(self._spilled) >= self.SPILL_BATCH:
+            self.flush()
+        return token
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, token):
+        """Возвращает (тег, аргументы) или None, если токен неизвестен или истек"""
+        now = int(time.time())
+        entry = self._entries.get(token)
+        if entry is None and token in self._spilled:
+            # Вытесненный, но не записанный - возвращается в память все еще не сохраненным
+            entry = self._spilled[token]
+            self._dirty.add(token)
+        if entry is not None:
+            self.stats['memory_hits'] += 1
+        else:
+            row = self.db.get_callback_state(token)
+            if row is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['db_hits'] += 1
+            entry = (row[0], tuple(json.loads(row[1])), row[2])
+        
+        tag, args, expires_at = entry
+        if expires_at < now:
+            self.stats['expired'] += 1
+            self._entries.pop(token, None)
+            self._spilled.pop(token, None)
+            self._dirty.discard(token)
+            return None
+        
+        self._entries[token] = entry
+        self._entries.move_to_end(token)
+        self._spilled.pop(token, None)
+        return tag, args
+    
+    def flush(self, everything=False):
+        """Пишет в базу вытесненные и еще не сохраненные токены.
+
+        everything=True (при остановке) - еще и все остальные токены из памяти, чтобы
+        обновить срок жизни. Истекшие токены убираются из памяти, а база сама
+        удаляет истекшие строки.
+        """
+        now = int(time.time())
+        for token in [token for token, entry in self._entries.items() if entry[2] < now]:
+            del self._entries[token]
+            self._dirty.discard(token)
+        spilled = {token: entry for token, entry in self._spilled.items() if entry[2] >= now}
+        entries = dict(self._entries) if everything else {token: self._entries[token] for token in self._dirty}
+        entries.update(spilled)
+        rows = [
+            (token, tag, json.dumps(list(args), ensure_ascii=False), expires_at)
+            for token, (tag, args, expires_at) in entries.items()
+        ]
+        self.db.save_callback_states(rows)
+        self._spilled.clear()
+        self._dirty.clear()
+        self.stats['spilled'] += len(spilled)
+        self.stats['saved'] += len(rows) - len(spilled)
+
+callback_state = CallbackStateStore(db)
+
+# Telegram принимает не больше 64 байт в callback_data
+CALLBACK_DATA_LIMIT = 64
+
+def pack_callback(tag, *args):
+    """Собирает callback_data "тег:арг1:арг2".
+
+    Если данные длиннее лимита, содержат ":" или аргументы не строки/числа
+    (курсор, набор фильтров), кнопка получает токен "~<token>" из callback_state.
+    """
+    if all(isinstance(arg, (str, int)) for arg in args):
+        values = [str(arg) for arg in args]
+        if not any(":" in value for value in values):
+            data = ":".join([tag, *values])
+            if len(data.encode()) <= CALLBACK_DATA_LIMIT:
+                return data
+    return "~" + callback_state.put(tag, args)
+
+# Ошибки Bot API, после которых писать пользователю бессмысленно
+DEAD_RECIPIENT_MARKERS = (
+    "chat not found",
+    "user not found",
+    "user is deactivated",
+    "bot was blocked",
+    "peer_id_invalid",
+)
+
+def is_dead_recipient_error(error):
+    """Определяет, что пользователь заблокировал бота или удалил аккаунт"""
+    if isinstance(error, Forbidden):
+        return True
+    if isinstance(error, BadRequest):
+        message = str(error).lower()
+        return any(marker in message for marker in DEAD_RECIPIENT_MARKERS)
+    return False
 
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ДЛЯ ПРОВЕРКИ ПОДПИСКИ
 async def check_subscription(user_id: int, context: ContextTypes.DEFAULT_TYPE):
@@ -1148,6 +1987,8 @@ async def show_subscription_required(update: Update, context: ContextTypes.DEFAU
             await update.message.reply_text(text, reply_markup=reply_markup)
         return False
     except Exception as e:
+        if is_dead_recipient_error(e):
+            db.mark_user_inactive(update.effective_user.id)
         logger.error(f"Obunani ko'rsatish xatosi: {e}")
         return False
 
@@ -1239,7 +2080,8 @@ def get_main_keyboard():
         [KeyboardButton("🔍 Film Qidirish"), KeyboardButton("🎬 Kategoriyalar")],
         [KeyboardButton("🎬 Barcha filmlar"), KeyboardButton("📊 Yangi filmlar (2020-2025)")],
         [KeyboardButton("🏆 Top filmlar"), KeyboardButton("⭐ Tasodifiy film")],
-        [KeyboardButton("❤️ Mening filmlarim"), KeyboardButton("ℹ️ Yordam")]
+        [KeyboardButton("✨ Siz uchun"), KeyboardButton("❤️ Mening filmlarim")],
+        [KeyboardButton("ℹ️ Yordam")]
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
@@ -1248,26 +2090,33 @@ def get_main_menu_inline_keyboard():
     keyboard = [
         [InlineKeyboardButton("🔍 Film Qidirish", callback_data="search_by_code")],
         [InlineKeyboardButton("🎬 Kategoriyalar", callback_data="categories")],
-        [InlineKeyboardButton("🎬 Barcha filmlar", callback_data="all_movies_0")],
-        [InlineKeyboardButton("📊 Yangi filmlar (2020-2025)", callback_data="recent_movies_0")],
-        [InlineKeyboardButton("🏆 Top filmlar", callback_data="top_movies_0")],
+        [InlineKeyboardButton("🎬 Barcha filmlar", callback_data="all_movies:0")],
+        [InlineKeyboardButton("📊 Yangi filmlar (2020-2025)", callback_data="recent_movies:0")],
+        [InlineKeyboardButton("🏆 Top filmlar", callback_data="top_movies:0")],
+        [InlineKeyboardButton("✨ Siz uchun", callback_data="feed:0")],
         [InlineKeyboardButton("⭐ Tasodifiy film", callback_data="random_movie")],
-        [InlineKeyboardButton("❤️ Mening filmlarim", callback_data="favorites_0")],
+        [InlineKeyboardButton("❤️ Mening filmlarim", callback_data="favorites:0")],
         [InlineKeyboardButton("ℹ️ Yordam", callback_data="help")]
     ]
     return InlineKeyboardMarkup(keyboard)
 
-def get_movie_keyboard(user_id, movie_code):
-    is_fav = db.is_favorite(user_id, movie_code)
+def get_movie_keyboard(user_id, movie_code, card=None):
+    # Если карточка уже загружена - не ходим в базу повторно
+    if card is not None:
+        is_fav = card['is_favorite']
+        user_rating = card['user_rating']
+    else:
+        is_fav = db.is_favorite(user_id, movie_code)
+        user_rating = db.get_user_rating(user_id, movie_code)
     favorite_text = "❌ Olib tashlash" if is_fav else "❤️ Saqlash"
     
-    user_rating = db.get_user_rating(user_id, movie_code)
     rating_text = "⭐ Baholash" if not user_rating else "✏️ Bahoni o'zgartirish"
     
     keyboard = [
-        [InlineKeyboardButton(favorite_text, callback_data=f"fav_{movie_code}")],
-        [InlineKeyboardButton(rating_text, callback_data=f"rate_{movie_code}")],
-        [InlineKeyboardButton("⚠️ Shikoyat qilish", callback_data=f"report_{movie_code}")],
+        [InlineKeyboardButton(favorite_text, callback_data=pack_callback("fav", movie_code))],
+        [InlineKeyboardButton(rating_text, callback_data=pack_callback("rate", movie_code))],
+        [InlineKeyboardButton("🎯 O'xshash filmlar", callback_data=pack_callback("similar", movie_code))],
+        [InlineKeyboardButton("⚠️ Shikoyat qilish", callback_data=pack_callback("report", movie_code))],
         [InlineKeyboardButton("🔙 Bosh menyu", callback_data="main_menu")]
     ]
     return InlineKeyboardMarkup(keyboard)
@@ -1275,31 +2124,31 @@ def get_movie_keyboard(user_id, movie_code):
 def get_rating_keyboard(movie_code):
     keyboard = [
         [
-            InlineKeyboardButton("1⭐", callback_data=f"rating_{movie_code}_1"),
-            InlineKeyboardButton("2⭐", callback_data=f"rating_{movie_code}_2"),
-            InlineKeyboardButton("3⭐", callback_data=f"rating_{movie_code}_3"),
-            InlineKeyboardButton("4⭐", callback_data=f"rating_{movie_code}_4"),
-            InlineKeyboardButton("5⭐", callback_data=f"rating_{movie_code}_5")
+            InlineKeyboardButton("1⭐", callback_data=pack_callback("rating", movie_code, 1)),
+            InlineKeyboardButton("2⭐", callback_data=pack_callback("rating", movie_code, 2)),
+            InlineKeyboardButton("3⭐", callback_data=pack_callback("rating", movie_code, 3)),
+            InlineKeyboardButton("4⭐", callback_data=pack_callback("rating", movie_code, 4)),
+            InlineKeyboardButton("5⭐", callback_data=pack_callback("rating", movie_code, 5))
         ],
-        [InlineKeyboardButton("🔙 Orqaga", callback_data=f"back_to_movie_{movie_code}")]
+        [InlineKeyboardButton("🔙 Orqaga", callback_data=pack_callback("back_to_movie", movie_code))]
     ]
     return InlineKeyboardMarkup(keyboard)
 
 def get_report_keyboard(movie_code):
     keyboard = [
         [
-            InlineKeyboardButton("❌ Noto'g'ri video", callback_data=f"report_type_{movie_code}_wrong"),
-            InlineKeyboardButton("📛 Hakoratli", callback_data=f"report_type_{movie_code}_offensive")
+            InlineKeyboardButton("❌ Noto'g'ri video", callback_data=pack_callback("report_type", movie_code, "wrong")),
+            InlineKeyboardButton("📛 Hakoratli", callback_data=pack_callback("report_type", movie_code, "offensive"))
         ],
         [
-            InlineKeyboardButton("⚖️ Mualliflik huquqi", callback_data=f"report_type_{movie_code}_copyright"),
-            InlineKeyboardButton("🔞 18+ kontent", callback_data=f"report_type_{movie_code}_adult")
+            InlineKeyboardButton("⚖️ Mualliflik huquqi", callback_data=pack_callback("report_type", movie_code, "copyright")),
+            InlineKeyboardButton("🔞 18+ kontent", callback_data=pack_callback("report_type", movie_code, "adult"))
         ],
         [
-            InlineKeyboardButton("📉 Sifat past", callback_data=f"report_type_{movie_code}_quality"),
-            InlineKeyboardButton("🚫 Boshqa sabab", callback_data=f"report_type_{movie_code}_other")
+            InlineKeyboardButton("📉 Sifat past", callback_data=pack_callback("report_type", movie_code, "quality")),
+            InlineKeyboardButton("🚫 Boshqa sabab", callback_data=pack_callback("report_type", movie_code, "other"))
         ],
-        [InlineKeyboardButton("🔙 Orqaga", callback_data=f"back_to_movie_{movie_code}")]
+        [InlineKeyboardButton("🔙 Orqaga", callback_data=pack_callback("back_to_movie", movie_code))]
     ]
     return InlineKeyboardMarkup(keyboard)
 
@@ -1313,13 +2162,19 @@ def get_categories_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+def facet_button_text(value, counts):
+    """Название значения категории с числом фильмов"""
+    count = counts.get(value)
+    return f"{value} ({count})" if count else value
+
 def get_genres_keyboard():
     """Клавиатура для выбора жанров"""
+    counts = db.get_facet_counts("genre")
     keyboard = []
     row = []
     
     for i, genre in enumerate(GENRES):
-        row.append(InlineKeyboardButton(genre, callback_data=f"select_genre_{genre}"))
+        row.append(InlineKeyboardButton(facet_button_text(genre, counts), callback_data=pack_callback("select", "genre", genre)))
         if len(row) == 2 or i == len(GENRES) - 1:
             keyboard.append(row)
             row = []
@@ -1329,11 +2184,12 @@ def get_genres_keyboard():
 
 def get_countries_keyboard():
     """Клавиатура для выбора стран"""
+    counts = db.get_facet_counts("country")
     keyboard = []
     row = []
     
     for i, country in enumerate(COUNTRIES):
-        row.append(InlineKeyboardButton(country, callback_data=f"select_country_{country}"))
+        row.append(InlineKeyboardButton(facet_button_text(country, counts), callback_data=pack_callback("select", "country", country)))
         if len(row) == 2 or i == len(COUNTRIES) - 1:
             keyboard.append(row)
             row = []
@@ -1343,11 +2199,12 @@ def get_countries_keyboard():
 
 def get_years_keyboard():
     """Клавиатура для выбора годов"""
+    counts = db.get_facet_counts("year")
     keyboard = []
     row = []
     
     for i, year in enumerate(YEARS):
-        row.append(InlineKeyboardButton(year, callback_data=f"select_year_{year}"))
+        row.append(InlineKeyboardButton(facet_button_text(year, counts), callback_data=pack_callback("select", "year", year)))
         if len(row) == 3 or i == len(YEARS) - 1:
             keyboard.append(row)
             row = []
@@ -1357,11 +2214,12 @@ def get_years_keyboard():
 
 def get_qualities_keyboard():
     """Клавиатура для выбора качества"""
+    counts = db.get_facet_counts("quality")
     keyboard = []
     row = []
     
     for i, quality in enumerate(QUALITIES):
-        row.append(InlineKeyboardButton(quality, callback_data=f"select_quality_{quality}"))
+        row.append(InlineKeyboardButton(facet_button_text(quality, counts), callback_data=pack_callback("select", "quality", quality)))
         if len(row) == 2 or i == len(QUALITIES) - 1:
             keyboard.append(row)
             row = []
@@ -1369,29 +2227,31 @@ def get_qualities_keyboard():
     keyboard.append([InlineKeyboardButton("🔙 Kategoriyalar", callback_data="categories")])
     return InlineKeyboardMarkup(keyboard)
 
-def get_movies_list_keyboard(movies, page, total_pages, callback_prefix):
-    """Клавиатура для списка фильмов с пагинацией"""
+def get_movies_list_keyboard(movies, page, total_pages, callback_tag, *tag_args, extra_rows=()):
+    """Клавиатура для списка фильмов с пагинацией: страница передается последним аргументом callback_tag"""
     keyboard = []
     
     for code, title in movies:
         display_title = title[:35] + "..." if len(title) > 35 else title
-        keyboard.append([InlineKeyboardButton(f"🎬 {display_title}", callback_data=f"download_{code}")])
+        keyboard.append([InlineKeyboardButton(f"🎬 {display_title}", callback_data=pack_callback("download", code))])
     
     nav_buttons = []
     if page > 0:
-        nav_buttons.append(InlineKeyboardButton("⬅️ Oldingi", callback_data=f"{callback_prefix}_{page-1}"))
+        nav_buttons.append(InlineKeyboardButton("⬅️ Oldingi", callback_data=pack_callback(callback_tag, *tag_args, page-1)))
     
     nav_buttons.append(InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data="current_page"))
     
     if page < total_pages - 1:
-        nav_buttons.append(InlineKeyboardButton("Keyingi ➡️", callback_data=f"{callback_prefix}_{page+1}"))
+        nav_buttons.append(InlineKeyboardButton("Keyingi ➡️", callback_data=pack_callback(callback_tag, *tag_args, page+1)))
     
     if nav_buttons:
         keyboard.append(nav_buttons)
     
-    if callback_prefix.startswith("category_page"):
+    keyboard.extend(extra_rows)
+    
+    if callback_tag in ("category_page", "browse"):
         keyboard.append([InlineKeyboardButton("🔙 Kategoriyalar", callback_data="categories")])
-    elif callback_prefix.startswith("all_movies"):
+    elif callback_tag == "all_movies":
         keyboard.append([InlineKeyboardButton("🔙 Bosh menyu", callback_data="main_menu")])
     else:
         keyboard.append([InlineKeyboardButton("🔙 Bosh menyu", callback_data="main_menu")])
@@ -1404,7 +2264,7 @@ def get_search_results_keyboard(movies):
     
     for code, title in movies:
         display_title = title[:30] + "..." if len(title) > 30 else title
-        keyboard.append([InlineKeyboardButton(f"🎬 {display_title}", callback_data=f"download_{code}")])
+        keyboard.append([InlineKeyboardButton(f"🎬 {display_title}", callback_data=pack_callback("download", code))])
     
     keyboard.append([InlineKeyboardButton("🔙 Bosh menyu", callback_data="main_menu")])
     
@@ -1413,12 +2273,13 @@ def get_search_results_keyboard(movies):
 def get_admin_keyboard():
     keyboard = [
         [InlineKeyboardButton("📊 Statistika", callback_data="admin_stats")],
-        [InlineKeyboardButton("🎬 Filmlar", callback_data="admin_movies_0")],
-        [InlineKeyboardButton("🗑️ Filmlarni o'chirish", callback_data="admin_delete_movies_0")],
+        [InlineKeyboardButton("🎬 Filmlar", callback_data="admin_movies:0")],
+        [InlineKeyboardButton("🗑️ Filmlarni o'chirish", callback_data="admin_delete_movies:0")],
         [InlineKeyboardButton("📢 Kanallar", callback_data="admin_channels")],
         [InlineKeyboardButton("⚙️ Sozlamalar", callback_data="admin_settings")],
-        [InlineKeyboardButton("⚠️ Shikoyatlar", callback_data="admin_reports_0")],
+        [InlineKeyboardButton("⚠️ Shikoyatlar", callback_data="admin_reports:0")],
         [InlineKeyboardButton("📈 Analytics", callback_data="admin_analytics")],
+        [InlineKeyboardButton("⚡ Bot holati", callback_data="admin_perf")],
         [InlineKeyboardButton("📨 Xabar yuborish", callback_data="admin_broadcast")],
         [InlineKeyboardButton("🔙 Bosh menyu", callback_data="main_menu")]
     ]
@@ -1441,21 +2302,21 @@ def get_admin_movies_keyboard(movies, page, total_pages, delete_mode=False):
         display_title = title[:30] + "..." if len(title) > 30 else title
         if delete_mode:
             keyboard.append([
-                InlineKeyboardButton(f"🎬 {display_title}", callback_data=f"admin_movie_info_{code}"),
-                InlineKeyboardButton("❌", callback_data=f"admin_delete_{code}")
+                InlineKeyboardButton(f"🎬 {display_title}", callback_data=pack_callback("admin_movie_info", code)),
+                InlineKeyboardButton("❌", callback_data=pack_callback("admin_delete", code))
             ])
         else:
-            keyboard.append([InlineKeyboardButton(f"🎬 {display_title}", callback_data=f"admin_movie_info_{code}")])
+            keyboard.append([InlineKeyboardButton(f"🎬 {display_title}", callback_data=pack_callback("admin_movie_info", code))])
     
     # Пагинация
     nav_buttons = []
     if page > 0:
-        nav_buttons.append(InlineKeyboardButton("⬅️ Oldingi", callback_data=f"admin_movies_{page-1}" if not delete_mode else f"admin_delete_movies_{page-1}"))
+        nav_buttons.append(InlineKeyboardButton("⬅️ Oldingi", callback_data=pack_callback("admin_delete_movies" if delete_mode else "admin_movies", page-1)))
     
     nav_buttons.append(InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data="current_page"))
     
     if page < total_pages - 1:
-        nav_buttons.append(InlineKeyboardButton("Keyingi ➡️", callback_data=f"admin_movies_{page+1}" if not delete_mode else f"admin_delete_movies_{page+1}"))
+        nav_buttons.append(InlineKeyboardButton("Keyingi ➡️", callback_data=pack_callback("admin_delete_movies" if delete_mode else "admin_movies", page+1)))
     
     if nav_buttons:
         keyboard.append(nav_buttons)
@@ -1463,9 +2324,9 @@ def get_admin_movies_keyboard(movies, page, total_pages, delete_mode=False):
     # Кнопки действий
     action_buttons = []
     if not delete_mode:
-        action_buttons.append(InlineKeyboardButton("🗑️ O'chirish rejimi", callback_data="admin_delete_movies_0"))
+        action_buttons.append(InlineKeyboardButton("🗑️ O'chirish rejimi", callback_data="admin_delete_movies:0"))
     else:
-        action_buttons.append(InlineKeyboardButton("📋 Ko'rish rejimi", callback_data="admin_movies_0"))
+        action_buttons.append(InlineKeyboardButton("📋 Ko'rish rejimi", callback_data="admin_movies:0"))
     
     action_buttons.append(InlineKeyboardButton("🔙 Admin panel", callback_data="main_menu"))
     keyboard.append(action_buttons)
@@ -1476,8 +2337,8 @@ def get_admin_delete_confirmation_keyboard(movie_code):
     """Клавиатура подтверждения удаления фильма"""
     keyboard = [
         [
-            InlineKeyboardButton("✅ HA, o'chirish", callback_data=f"admin_confirm_delete_{movie_code}"),
-            InlineKeyboardButton("❌ BEKOR QILISH", callback_data="admin_delete_movies_0")
+            InlineKeyboardButton("✅ HA, o'chirish", callback_data=pack_callback("admin_confirm_delete", movie_code)),
+            InlineKeyboardButton("❌ BEKOR QILISH", callback_data="admin_delete_movies:0")
         ],
         [InlineKeyboardButton("🔙 Admin panel", callback_data="main_menu")]
     ]
@@ -1491,19 +2352,19 @@ def get_admin_reports_keyboard(reports, page, total_pages):
         user_display = f"@{username}" if username else first_name
         report_text = f"#{report_id} {user_display} - {title[:20]}..."
         keyboard.append([
-            InlineKeyboardButton(report_text, callback_data=f"admin_report_info_{report_id}"),
-            InlineKeyboardButton("✅", callback_data=f"admin_resolve_report_{report_id}")
+            InlineKeyboardButton(report_text, callback_data=pack_callback("admin_report_info", report_id)),
+            InlineKeyboardButton("✅", callback_data=pack_callback("admin_resolve_report", report_id))
         ])
     
     # Пагинация
     nav_buttons = []
     if page > 0:
-        nav_buttons.append(InlineKeyboardButton("⬅️ Oldingi", callback_data=f"admin_reports_{page-1}"))
+        nav_buttons.append(InlineKeyboardButton("⬅️ Oldingi", callback_data=pack_callback("admin_reports", page-1)))
     
     nav_buttons.append(InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data="current_page"))
     
     if page < total_pages - 1:
-        nav_buttons.append(InlineKeyboardButton("Keyingi ➡️", callback_data=f"admin_reports_{page+1}"))
+        nav_buttons.append(InlineKeyboardButton("Keyingi ➡️", callback_data=pack_callback("admin_reports", page+1)))
     
     if nav_buttons:
         keyboard.append(nav_buttons)
@@ -1536,70 +2397,6 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=get_main_keyboard()
     )
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик текстовых сообщений"""
-    user = update.effective_user
-    db.update_user_activity(user.id)
-    
-    if user.id not in ADMIN_IDS:
-        if not await require_subscription(update, context):
-            return
-    
-    text = update.message.text.strip()
-    db.log_user_activity(user.id, "message", text)
-    
-    if text == "🔍 Film Qidirish":
-        await update.message.reply_text(
-            "🔍 Film nomi yoki kodini kiriting:\n\n"
-            "Misol: <code>Avatar</code> yoki <code>AVATAR2024</code>\n"
-            "Yoki: <code>Tezlik</code> (qisman nom)",
-            parse_mode="HTML",
-            reply_markup=ReplyKeyboardMarkup([[KeyboardButton("🔙 Bosh menyu")]], resize_keyboard=True)
-        )
-        return
-    
-    elif text == "🎬 Kategoriyalar":
-        await update.message.reply_text(
-            "Qidiruv turini tanlang:",
-            reply_markup=get_categories_keyboard()
-        )
-        return
-    
-    elif text == "🎬 Barcha filmlar":
-        await show_all_movies(update, context)
-        return
-    
-    elif text == "📊 Yangi filmlar (2020-2025)":
-        await show_recent_movies(update, context)
-        return
-    
-    elif text == "🏆 Top filmlar":
-        await show_top_movies(update, context)
-        return
-    
-    elif text == "⭐ Tasodifiy film":
-        await send_random_movie(update, context)
-        return
-    
-    elif text == "❤️ Mening filmlarim":
-        await show_favorites(update, context)
-        return
-    
-    elif text == "ℹ️ Yordam":
-        await show_help(update, context)
-        return
-    
-    elif text == "🔙 Bosh menyu":
-        await update.message.reply_text(
-            "Bosh menyu:",
-            reply_markup=get_main_keyboard()
-        )
-        return
-    
-    # УНИВЕРСАЛЬНЫЙ ПОИСК - ОБРАБОТКА ЛЮБОГО ТЕКСТА
-    else:
-        await universal_search(update, context, text)
-
 # УЛУЧШЕННЫЙ ПОИСК ПО НАЗВАНИЮ
 async def search_movies_by_title(update: Update, context: ContextTypes.DEFAULT_TYPE, query):
     """Улучшенный поиск фильмов по названию"""
@@ -1728,7 +2525,7 @@ async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📊 **Ko'rish:**\n"
         "• Barcha filmlar - barcha mavjud filmlar ro'yxati\n"
         "• Yangi filmlar (2020-2025) - so'nggi yillardagi yangi filmlar\n"
-        "• Top filmlar - eng ko'p ko'rilgan filmlar\n"
+        "• Top filmlar - bugun, hafta va umuman eng ko'p ko'rilgan filmlar\n"
         "• Tasodifiy film - tasodifiy filmni ko'rish\n\n"
         "❤️ **Shaxsiy:**\n"
         "• Mening filmlarim - saqlangan filmlaringiz\n"
@@ -1770,28 +2567,67 @@ async def show_recent_movies(update: Update, context: ContextTypes.DEFAULT_TYPE,
     else:
         await update.message.reply_text(text, reply_markup=keyboard)
 
-async def show_top_movies(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0):
+TRENDING_PERIODS = {"today": "📅 Bugun", "week": "🗓 Hafta", "all": "♾ Hammasi"}
+
+async def show_top_movies(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0, period="today", header=""):
     limit = 5
-    offset = page * limit
-    min_views = 100
+    if period not in TRENDING_PERIODS:
+        period = "today"
     
-    movies = db.get_top_movies(limit, offset, min_views)
-    total_count = db.get_top_movies_count(min_views)
-    total_pages = (total_count + limit - 1) // limit
+    movies, total_count = db.get_trending_movies(period, limit, page * limit)
+    total_pages = (total_count + limit - 1) // limit if total_count > 0 else 1
+    
+    period_row = [
+        InlineKeyboardButton(("✅ " if key == period else "") + label, callback_data=pack_callback("trending", key, 0))
+        for key, label in TRENDING_PERIODS.items()
+    ]
     
     if not movies:
+        text = header + f"🏆 {TRENDING_PERIODS[period]}: hozircha ko'rilgan filmlar yo'q"
+        keyboard = InlineKeyboardMarkup([period_row, [InlineKeyboardButton("🔙 Bosh menyu", callback_data="main_menu")]])
         if update.callback_query:
-            await update.callback_query.edit_message_text("🏆 Hozircha top filmlar yo'q (minimal 100 ko'rish)")
+            await update.callback_query.edit_message_text(text, reply_markup=keyboard)
+        else:
+            await update.message.reply_text(text, reply_markup=keyboard)
+        return
+    
+    text = header + f"🏆 Top filmlar - {TRENDING_PERIODS[period]} (Sahifa {page+1}/{total_pages}):\n\n"
+    
+    for code, title, score in movies:
+        if period == "all":
+            text += f"🎬 {title}\n👁️ Ko'rishlar: {score:.0f}\n🔗 Kod: {code}\n\n"
         else:
-            await update.message.reply_text("🏆 Hozircha top filmlar yo'q (minimal 100 ko'rish)")
+            text += f"🎬 {title}\n🔥 Reyting: {score:.1f}\n🔗 Kod: {code}\n\n"
+    
+    keyboard = get_movies_list_keyboard(
+        [(code, title) for code, title, _ in movies], page, total_pages, "trending", period,
+        extra_rows=[period_row]
+    )
+    
+    if update.callback_query:
+        await update.callback_query.edit_message_text(text, reply_markup=keyboard)
+    else:
+        await update.message.reply_text(text, reply_markup=keyboard)
+
+async def show_feed(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0):
+    """Лента "Siz uchun"; пока ее нет - популярные за сегодня"""
+    user = update.effective_user
+    limit = 5
+    codes = db.get_user_feed(user.id)
+    if not codes:
+        header = "✨ Siz uchun tavsiyalar hali tayyor emas - filmlarni ko'ring va saqlang.\n\n"
+        await show_top_movies(update, context, header=header)
         return
     
-    text = f"🏆 Top filmlar (Sahifa {page+1}/{total_pages}):\n\n"
+    total_pages = (len(codes) + limit - 1) // limit
+    page = min(page, total_pages - 1)
+    movies = db.get_movies_by_codes(codes[page * limit:(page + 1) * limit])
     
-    for code, title, views in movies:
-        text += f"🎬 {title}\n👁️ Ko'rishlar: {views}\n🔗 Kod: {code}\n\n"
+    text = f"✨ Siz uchun (Sahifa {page+1}/{total_pages}):\n\n"
+    for code, title in movies:
+        text += f"🎬 {title}\n🔗 Kod: {code}\n\n"
     
-    keyboard = get_movies_list_keyboard([(code, title) for code, title, views in movies], page, total_pages, "top_movies")
+    keyboard = get_movies_list_keyboard(movies, page, total_pages, "feed")
     
     if update.callback_query:
         await update.callback_query.edit_message_text(text, reply_markup=keyboard)
@@ -1826,10 +2662,81 @@ async def show_favorites(update: Update, context: ContextTypes.DEFAULT_TYPE, pag
     else:
         await update.message.reply_text(text, reply_markup=keyboard)
 
+# Лимит подписи к медиа в Telegram - в единицах UTF-16, а не в символах Python
+CAPTION_LIMIT = 1024
+
+def caption_length(text):
+    """Длина так, как ее считает Telegram: эмодзи вне BMP занимают две единицы UTF-16"""
+    return len(text.encode('utf-16-le')) // 2
+
+def fit_caption(text, limit=CAPTION_LIMIT):
+    """Обрезает text до limit единиц UTF-16, не разрывая суррогатную пару"""
+    if caption_length(text) <= limit:
+        return text
+    return text.encode('utf-16-le')[:limit * 2].decode('utf-16-le', errors='ignore')
+
+def is_media_message(message):
+    """Сообщение с видео редактируется через подпись, а не через текст"""
+    return message is not None and message.text is None
+
+async def edit_query_message(query, text, reply_markup=None, parse_mode=None):
+    """Редактирует сообщение кнопки - текст или подпись к видео"""
+    if is_media_message(query.message):
+        await query.edit_message_caption(caption=fit_caption(text), reply_markup=reply_markup, parse_mode=parse_mode)
+    else:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+
+def build_movie_info(card):
+    """Форматирует карточку фильма из get_movie_card"""
+    movie_info = f"🎬 **{card['title']}**\n\n"
+    
+    if card['avg_rating'] > 0:
+        movie_info += f"⭐ **Reyting:** {card['avg_rating']:.1f}/5 ({card['rating_count']} baho)\n"
+    
+    if card['user_rating']:
+        movie_info += f"📝 **Sizning bahoingiz:** {card['user_rating']} ⭐\n"
+    
+    duration = card['duration']
+    if duration and duration > 0:
+        hours = duration // 3600
+        minutes = (duration % 3600) // 60
+        movie_info += f"⏱ **Davomiylik:** {hours:02d}:{minutes:02d}\n"
+    
+    file_size = card['file_size']
+    if file_size and file_size > 0:
+        size_mb = file_size / (1024 * 1024)
+        movie_info += f"📦 **Hajmi:** {size_mb:.1f} MB\n"
+    
+    movie_info += f"\n🔗 **Kod:** `{card['code']}`"
+    
+    return movie_info
+
+def build_video_caption(card):
+    """Подпись к видео: описание из архива и карточка фильма"""
+    if card['caption']:
+        base_caption = card['caption']
+    else:
+        base_caption = f"🎬 {card['title']}\n\nKod: #{card['code']}"
+    return f"{base_caption}\n\n{build_movie_info(card)}"
+
+async def show_movie_screen(query, card, user_id, suffix="", reply_markup=None):
+    """Показывает карточку фильма в сообщении кнопки (текстовом или с видео)"""
+    if reply_markup is None:
+        reply_markup = get_movie_keyboard(user_id, card['code'], card)
+    
+    movie_info = build_movie_info(card)
+    if is_media_message(query.message):
+        text = build_video_caption(card) + suffix
+        if caption_length(text) > CAPTION_LIMIT:
+            text = movie_info + suffix
+        await query.edit_message_caption(caption=fit_caption(text), reply_markup=reply_markup)
+    else:
+        await query.edit_message_text(movie_info + suffix, reply_markup=reply_markup)
+
 async def send_movie_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE, movie_code, user_id):
     """Отправляет фильм пользователю"""
-    movie = db.get_movie(movie_code)
-    if not movie:
+    card = db.get_movie_card(movie_code, user_id)
+    if not card:
         try:
             if update.callback_query:
                 await update.callback_query.answer("❌ Film topilmadi", show_alert=True)
@@ -1839,35 +2746,49 @@ async def send_movie_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE,
             pass
         return False
     
-    code, file_id, caption, title, duration, file_size = movie
+    code = card['code']
     
     try:
-        if caption:
-            message_caption = caption
-        else:
-            message_caption = f"🎬 {title}\n\nKod: #{code}"
-        
-        await context.bot.send_video(
-            chat_id=user_id,
-            video=file_id,
-            caption=message_caption,
-            protect_content=True
-        )
+        keyboard = get_movie_keyboard(user_id, code, card)
+        video_caption = build_video_caption(card)
         
-        movie_info = await format_movie_info(movie_code, user_id)
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=movie_info,
-            reply_markup=get_movie_keyboard(user_id, movie_code)
-        )
+        if caption_length(video_caption) <= CAPTION_LIMIT:
+            # Видео, карточка и кнопки - одним запросом
+            await context.bot.send_video(
+                chat_id=user_id,
+                video=card['file_id'],
+                caption=video_caption,
+                reply_markup=keyboard,
+                protect_content=True
+            )
+        else:
+            # Подпись не помещается - карточка отдельным сообщением
+            if card['caption']:
+                message_caption = card['caption']
+            else:
+                message_caption = f"🎬 {card['title']}\n\nKod: #{code}"
+            
+            await context.bot.send_video(
+                chat_id=user_id,
+                video=card['file_id'],
+                caption=fit_caption(message_caption),
+                protect_content=True
+            )
+            await context.bot.send_message(
+                chat_id=user_id,
+                text=build_movie_info(card),
+                reply_markup=keyboard
+            )
         
-        db.increment_views(code)
-        db.log_user_activity(user_id, "watch_movie", movie_code)
+        db.record_movie_view(user_id, code)
         
         return True
         
     except Exception as e:
         logger.error(f"Videoni yuborishda xato: {e}")
+        if is_dead_recipient_error(e):
+            db.mark_user_inactive(user_id)
+            return False
         try:
             await context.bot.send_message(
                 chat_id=user_id,
@@ -1877,97 +2798,129 @@ async def send_movie_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE,
             pass
         return False
 
-async def format_movie_info(movie_code, user_id):
-    """Форматирует информацию о фильме"""
-    movie = db.get_movie(movie_code)
-    if not movie:
-        return "❌ Film topilmadi"
-    
-    code, file_id, caption, title, duration, file_size = movie
-    avg_rating, rating_count = db.get_movie_rating(movie_code)
-    user_rating = db.get_user_rating(user_id, movie_code)
-    
-    movie_info = f"🎬 **{title}**\n\n"
-    
-    if avg_rating > 0:
-        movie_info += f"⭐ **Reyting:** {avg_rating:.1f}/5 ({rating_count} baho)\n"
-    
-    if user_rating:
-        rating, review = user_rating
-        movie_info += f"📝 **Sizning bahoingiz:** {rating} ⭐\n"
-    
-    if duration and duration > 0:
-        hours = duration // 3600
-        minutes = (duration % 3600) // 60
-        movie_info += f"⏱ **Davomiylik:** {hours:02d}:{minutes:02d}\n"
-    
-    if file_size and file_size > 0:
-        size_mb = file_size / (1024 * 1024)
-        movie_info += f"📦 **Hajmi:** {size_mb:.1f} MB\n"
-    
-    movie_info += f"\n🔗 **Kod:** `{code}`"
-    
-    return movie_info
-
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ДЛЯ РЕЙТИНГОВ И ЖАЛОБ
 async def show_rating_options(query, movie_code):
     """Показывает опции для оценки фильма"""
-    movie_info = await format_movie_info(movie_code, query.from_user.id)
-    text = f"{movie_info}\n\nFilmini baholang:"
+    card = db.get_movie_card(movie_code, query.from_user.id)
+    if not card:
+        await query.answer("❌ Film topilmadi", show_alert=True)
+        return
     
-    await query.edit_message_text(text, reply_markup=get_rating_keyboard(movie_code))
+    await show_movie_screen(
+        query, card, query.from_user.id,
+        suffix="\n\nFilmini baholang:",
+        reply_markup=get_rating_keyboard(movie_code)
+    )
 
-async def show_report_options(query, movie_code):
+async def show_report_options(query, card):
     """Показывает опции для жалобы"""
-    movie_info = await format_movie_info(movie_code, query.from_user.id)
-    text = f"⚠️ **FILMGA SHIKOYAT** ⚠️\n\n{movie_info}\n\nShikoyat turini tanlang:"
+    text = f"⚠️ **FILMGA SHIKOYAT** ⚠️\n\n{build_movie_info(card)}\n\nShikoyat turini tanlang:"
     
-    await query.edit_message_text(text, reply_markup=get_report_keyboard(movie_code))
+    await edit_query_message(query, text, reply_markup=get_report_keyboard(card['code']))
 
 async def send_movie_details(query, movie_code, user_id):
     """Отправляет детали фильма"""
-    movie_info = await format_movie_info(movie_code, user_id)
-    await query.edit_message_text(movie_info, reply_markup=get_movie_keyboard(user_id, movie_code))
+    card = db.get_movie_card(movie_code, user_id)
+    if not card:
+        await edit_query_message(query, "❌ Film topilmadi")
+        return
+    await show_movie_screen(query, card, user_id)
+
+CATEGORY_NAMES = {
+    "genre": "Janr",
+    "country": "Davlat",
+    "year": "Yil",
+    "quality": "Sifat",
+    "language": "Til",
+}
+# Готовые диапазоны лет для уточнения
+YEAR_RANGES = ("2020", "2015")
+
+def describe_filter(category_type, value):
+    if value.startswith(RANGE_PREFIX):
+        value = value[len(RANGE_PREFIX):] + "+"
+    return f"{CATEGORY_NAMES.get(category_type, 'Kategoriya')}: {value}"
 
 async def show_movies_by_category(query, category_type, category_value, page=0):
     """Показывает фильмы по выбранной категории"""
+    await show_browse(query, [[category_type, category_value]], "recent", page)
+
+async def show_browse(query, filters, order="recent", page=0):
+    """Фильмы по набору фильтров с кнопками уточнения и сортировки"""
     limit = 5
-    offset = page * limit
-    
-    movies = db.get_movies_by_tag(category_type, category_value, limit, offset)
-    total_count = db.get_movies_count_by_tag(category_type, category_value)
+    filters = [list(item) for item in filters]
+    movies, total_count = db.browse_movies(filters, limit, page * limit, order)
     total_pages = (total_count + limit - 1) // limit if total_count > 0 else 1
     
     if not movies:
+        back_type = filters[-1][0] if filters else "genre"
         await query.edit_message_text(
-            f"❌ '{category_value}' bo'yicha videolar topilmadi",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Orqaga", callback_data=f"category_{category_type}")]])
+            "❌ " + ", ".join(describe_filter(*item) for item in filters) + " bo'yicha videolar topilmadi",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Orqaga", callback_data=f"category_{back_type}")]])
         )
         return
     
-    category_names = {
-        "genre": "Janr",
-        "country": "Davlat", 
-        "year": "Yil",
-        "quality": "Sifat"
-    }
-    
-    category_name = category_names.get(category_type, "Kategoriya")
-    
-    text = f"🎬 {category_name}: {category_value} (Sahifa {page+1}/{total_pages}):\n\n"
+    text = "🎬 " + " • ".join(describe_filter(*item) for item in filters)
+    text += f" ({total_count} ta, sahifa {page+1}/{total_pages}):\n\n"
     
     for code, title in movies:
         text += f"🎬 {title}\n🔗 Kod: {code}\n\n"
     
-    keyboard = get_movies_list_keyboard(movies, page, total_pages, f"category_page_{category_type}_{category_value}")
+    refine_row = [
+        InlineKeyboardButton(f"➕ {CATEGORY_NAMES[category_type]}", callback_data=pack_callback("refine", filters, category_type))
+        for category_type in ("genre", "country", "year", "quality")
+    ]
+    if order == "recent":
+        order_button = InlineKeyboardButton("🔥 Ko'p ko'rilganlar", callback_data=pack_callback("browse", filters, "views", 0))
+    else:
+        order_button = InlineKeyboardButton("🆕 Yangilari", callback_data=pack_callback("browse", filters, "recent", 0))
     
+    keyboard = get_movies_list_keyboard(
+        movies, page, total_pages, "browse", filters, order,
+        extra_rows=[refine_row[:2], refine_row[2:], [order_button]]
+    )
     await query.edit_message_text(text, reply_markup=keyboard)
 
+async def show_refine_options(query, filters, category_type):
+    """Значения категории с числом фильмов среди уже отобранных"""
+    filters = [list(item) for item in filters]
+    selected = {value for item_type, value in filters if item_type == category_type}
+    counts = db.get_facet_counts(category_type, filters)
+    options = sorted(
+        ((value, count) for value, count in counts.items() if value not in selected),
+        key=lambda item: (-item[1], item[0])
+    )
+    
+    keyboard = []
+    if category_type == "year":
+        keyboard.append([
+            InlineKeyboardButton(f"{year}+", callback_data=pack_callback("browse", filters + [[category_type, RANGE_PREFIX + year]], "recent", 0))
+            for year in YEAR_RANGES
+        ])
+    row = []
+    for value, count in options[:30]:
+        row.append(InlineKeyboardButton(
+            f"{value} ({count})",
+            callback_data=pack_callback("browse", filters + [[category_type, value]], "recent", 0)
+        ))
+        if len(row) == 2:
+            keyboard.append(row)
+            row = []
+    if row:
+        keyboard.append(row)
+    keyboard.append([InlineKeyboardButton("🔙 Orqaga", callback_data=pack_callback("browse", filters, "recent", 0))])
+    
+    await query.edit_message_text(
+        f"➕ {CATEGORY_NAMES.get(category_type, 'Kategoriya')} bo'yicha aniqlashtiring:",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
 # АДМИН ФУНКЦИИ
 async def show_admin_stats(query):
     """Показывает статистику для админа"""
     movies_count = db.get_all_movies_count()
     users_count = db.get_users_count()
+    active_users, dead_users = db.get_users_health_counts()
     channels_count = len(db.get_all_channels())
     daily_users = db.get_daily_active_users()
     pending_reports, total_reports = db.get_reports_count()
@@ -1977,13 +2930,27 @@ async def show_admin_stats(query):
         f"📊 **Admin statistikasi:**\n\n"
         f"🎬 **Filmlar:** {movies_count}\n"
         f"👥 **Foydalanuvchilar:** {users_count}\n"
+        f"✅ **Yetib boradi:** {active_users}\n"
+        f"🚫 **Botni bloklagan:** {dead_users}\n"
         f"📢 **Kanallar:** {channels_count}\n"
         f"📈 **Kunlik aktiv:** {daily_users}\n"
         f"⚠️ **Shikoyatlar:** {pending_reports}/{total_reports}\n"
-        f"🆕 **Kutilayotgan so'rovlar:** {pending_requests}\n\n"
-        f"**Kanallar ro'yxati:**"
+        f"🆕 **Kutilayotgan so'rovlar:** {pending_requests}\n"
+        f"🛡 **Rad etilgan (flood):** {sum(flood_control.dropped.values())}\n"
     )
     
+    write_stats = db.write_stats
+    if write_stats['updates']:
+        text += (
+            f"💾 **Yozuvlar/apdeyt:** {write_stats['writes'] / write_stats['updates']:.2f} "
+            f"(commit: {write_stats['commits'] / write_stats['updates']:.2f})\n"
+        )
+    
+    for reason, count in flood_control.dropped.most_common():
+        text += f"   • {reason}: {count}\n"
+    
+    text += "\n**Kanallar ro'yxati:**"
+    
     channels = db.get_all_channels()
     for channel_id, username, title, invite_link, is_private in channels:
         channel_type = "🔒 Maxfiy" if is_private else "📢 Ochiq"
@@ -2048,12 +3015,12 @@ async def delete_movie_confirmed(query, movie_code):
     if success:
         await query.edit_message_text(
             f"✅ {message}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Filmlar ro'yxati", callback_data="admin_delete_movies_0")]])
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Filmlar ro'yxati", callback_data="admin_delete_movies:0")]])
         )
     else:
         await query.edit_message_text(
             f"❌ {message}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Filmlar ro'yxati", callback_data="admin_delete_movies_0")]])
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Filmlar ro'yxati", callback_data="admin_delete_movies:0")]])
         )
 
 async def show_admin_movie_info(query, movie_code):
@@ -2069,7 +3036,7 @@ async def show_admin_movie_info(query, movie_code):
     avg_rating, rating_count = db.get_movie_rating(movie_code)
     
     # Получаем количество пользователей, добавивших в избранное
-    favorites_count = sum(1 for user in db.get_all_users() if db.is_favorite(user[0], movie_code))
+    favorites_count = sum(1 for user in db.get_all_users(include_inactive=True) if db.is_favorite(user[0], movie_code))
     
     text = f"🎬 **Film ma'lumotlari**\n\n"
     text += f"📝 **Nomi:** {title}\n"
@@ -2097,8 +3064,8 @@ async def show_admin_movie_info(query, movie_code):
         text += f"\n📄 **Tavsif:**\n{caption[:200]}..."
     
     keyboard = [
-        [InlineKeyboardButton("🗑️ O'chirish", callback_data=f"admin_delete_{movie_code}")],
-        [InlineKeyboardButton("🔙 Filmlar ro'yxati", callback_data="admin_movies_0")]
+        [InlineKeyboardButton("🗑️ O'chirish", callback_data=pack_callback("admin_delete", movie_code))],
+        [InlineKeyboardButton("🔙 Filmlar ro'yxati", callback_data="admin_movies:0")]
     ]
     
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
@@ -2180,10 +3147,10 @@ async def show_admin_report_info(query, report_id):
     
     keyboard = [
         [
-            InlineKeyboardButton("✅ Hal qilindi", callback_data=f"admin_resolve_report_{report_id}"),
-            InlineKeyboardButton("🗑️ Filmlarni o'chirish", callback_data=f"admin_delete_{movie_code}")
+            InlineKeyboardButton("✅ Hal qilindi", callback_data=pack_callback("admin_resolve_report", report_id)),
+            InlineKeyboardButton("🗑️ Filmlarni o'chirish", callback_data=pack_callback("admin_delete", movie_code))
         ],
-        [InlineKeyboardButton("🔙 Shikoyatlar ro'yxati", callback_data="admin_reports_0")]
+        [InlineKeyboardButton("🔙 Shikoyatlar ro'yxati", callback_data="admin_reports:0")]
     ]
     
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
@@ -2195,12 +3162,12 @@ async def resolve_report_confirmed(query, report_id):
     if success:
         await query.edit_message_text(
             f"✅ Shikoyat #{report_id} hal qilindi!",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Shikoyatlar ro'yxati", callback_data="admin_reports_0")]])
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Shikoyatlar ro'yxati", callback_data="admin_reports:0")]])
         )
     else:
         await query.edit_message_text(
             f"❌ Shikoyatni hal qilishda xato!",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Shikoyatlar ro'yxati", callback_data="admin_reports_0")]])
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Shikoyatlar ro'yxati", callback_data="admin_reports:0")]])
         )
 
 async def show_admin_channels(query):
@@ -2247,7 +3214,7 @@ async def set_archive_channel(query, context):
         "⚠️ Eslatma: Bot kanalda admin bo'lishi kerak!",
         parse_mode="HTML"
     )
-    context.user_data['waiting_for_archive_channel'] = True
+    conversation.set(query.from_user.id, "archive_channel")
 
 async def set_codes_channel(query, context):
     """Устанавливает канал для кодов"""
@@ -2256,12 +3223,12 @@ async def set_codes_channel(query, context):
         "Misol: <code>@codes_channel</code> yoki <code>https://t.me/codes_channel</code>",
         parse_mode="HTML"
     )
-    context.user_data['waiting_for_codes_channel'] = True
+    conversation.set(query.from_user.id, "codes_channel")
 
 async def show_admin_analytics(query):
     """Показывает расширенную аналитику"""
     popular_movies = db.get_popular_movies(5)
-    total_requests = sum(user[5] for user in db.get_all_users() if user[5] is not None)
+    total_requests = sum(user[5] for user in db.get_all_users(include_inactive=True) if user[5] is not None)
     
     text = "📈 **Batafsil analitika:**\n\n"
     text += f"📊 **Jami so'rovlar:** {total_requests}\n\n"
@@ -2270,29 +3237,104 @@ async def show_admin_analytics(query):
     for i, (code, title, views) in enumerate(popular_movies, 1):
         text += f"{i}. {title} - {views} ko'rish\n"
     
+    route_stats = sorted(
+        ((tag, stats) for tag, stats in callback_router.stats.items() if stats[0]),
+        key=lambda item: item[1][1], reverse=True
+    )
+    if route_stats:
+        text += "\n⏱ **Callback marshrutlari (vaqt bo'yicha):**\n"
+        for tag, (count, total, longest) in route_stats[:8]:
+            text += f"• {tag}: {count} ta, o'rtacha {total / count * 1000:.0f} ms, max {longest * 1000:.0f} ms\n"
+    
     keyboard = [[InlineKeyboardButton("🔙 Orqaga", callback_data="main_menu")]]
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
 
-# ОБРАБОТЧИК ВИДЕО ДЛЯ АДМИНОВ
-async def handle_admin_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик видео для админов"""
-    if not update.message or not update.effective_user:
-        return
-    
-    user = update.effective_user
+def process_rss():
+    """(байты, точное ли значение): текущий RSS из /proc, иначе пиковый из getrusage"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024, True
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, False
+    except (ImportError, OSError):
+        return None, False
+
+def format_megabytes(size):
+    return f"{size / 1024 / 1024:.1f} MB" if size is not None else "-"
+
+def perf_report():
+    """Текст экрана /perf: перцентили по последним апдейтам, частоты - за последнюю минуту"""
+    p50, p95, p99 = PERF_UPDATE_LATENCY.percentiles(0.5, 0.95, 0.99)
+    api_calls = PERF_API_CALLS.total()
+    api_errors = PERF_API_ERRORS.total()
+    db_size = os.path.getsize(db.db_path) if os.path.exists(db.db_path) else None
+    wal_path = db.db_path + "-wal"
+    wal_size = os.path.getsize(wal_path) if os.path.exists(wal_path) else None
+    rss, exact = process_rss()
+    
+    text = f"⚡ Bot holati ({datetime.datetime.now():%H:%M:%S})\n\n"
+    if p50 is None:
+        text += "⏱ Apdeytlar hali yo'q\n"
+    else:
+        text += (
+            f"⏱ Oxirgi {len(PERF_UPDATE_LATENCY)} apdeyt: "
+            f"p50 {p50 * 1000:.0f} ms | p95 {p95 * 1000:.0f} ms | p99 {p99 * 1000:.0f} ms\n"
+        )
+    text += f"📥 Oxirgi 60 s: {PERF_UPDATES.rate():.2f} apdeyt/s | navbatda: {QUEUE_DEPTH.get()}\n"
+    text += (
+        f"🌐 API (60 s): {PERF_API_CALLS.rate():.2f} so'rov/s | xato: "
+        f"{api_errors / api_calls * 100 if api_calls else 0:.1f}% | RetryAfter: {PERF_API_RETRY_AFTER.total()}\n"
+    )
+    wal_text = format_megabytes(wal_size) if wal_size is not None else "yo'q"
+    text += f"💾 Baza: {format_megabytes(db_size)} | WAL: {wal_text}\n"
+    text += f"🧠 RSS: {format_megabytes(rss)}{'' if exact else ' (eng yuqori)'}\n"
+    
+    requests = cache_requests()
+    sizes = {cache: size for (cache,), size in cache_sizes()}
+    text += "\n🗂 Keshlar:\n"
+    for cache in list(sizes) + sorted({cache for cache, _ in requests} - set(sizes)):
+        line = f"• {cache}: {sizes[cache] if cache in sizes else '-'}"
+        total = requests[(cache, 'hit')] + requests[(cache, 'miss')]
+        if total:
+            line += f" (hit {requests[(cache, 'hit')] / total * 100:.1f}%)"
+        text += line + "\n"
+    return text
+
+def get_perf_keyboard():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔄 Yangilash", callback_data="admin_perf")],
+        [InlineKeyboardButton("🔙 Admin panel", callback_data="main_menu")]
+    ])
+
+async def perf_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Состояние бота: задержки, нагрузка, ошибки API, размер базы и память"""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    await update.message.reply_text(perf_report(), reply_markup=get_perf_keyboard())
+
+# ОБРАБОТЧИК ВИДЕО ДЛЯ АДМИНОВ
+async def handle_admin_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик видео для админов"""
+    if not update.message or not update.effective_user:
+        return
+    
+    user = update.effective_user
     if user.id not in ADMIN_IDS:
         return
     
     message = update.message
     caption = message.caption or ""
     
-    code_match = re.search(r'#(\w+)', caption)
-    if not code_match:
+    code = caption_parser.parse(caption).code
+    if not code:
         await message.reply_text("❌ Izohda #123 formatida kod ko'rsating")
         return
     
-    code = code_match.group(1)
-    
     file_id = None
     duration = 0
     file_size = 0
@@ -2427,18 +3469,302 @@ async def delete_movie_command(update: Update, context: ContextTypes.DEFAULT_TYP
             "❌ Foydalanish: /deletemovie <kod>"
         )
 
+SQL_TOP_KEYS = ("total", "avg", "p99", "count", "rows", "max")
+
+def parse_top_args(args, keys):
+    """Разбирает аргументы "top" в любом порядке: (N или None, показатель из keys или None)"""
+    number = next((int(arg) for arg in args if arg.isdigit()), None)
+    key = next((arg for arg in args if arg in keys), None)
+    return number, key
+
+SQL_PROFILE_USAGE = (
+    "🧪 SQL profiler:\n\n"
+    "/sqlprof on - yoqish\n"
+    "/sqlprof off - o'chirish\n"
+    "/sqlprof reset - statistikani tozalash\n"
+    f"/sqlprof top [N] [{'|'.join(SQL_TOP_KEYS)}] - eng og'ir so'rovlar\n"
+    "/sqlprof slow - oxirgi sekin so'rovlar va ularning rejasi"
+)
+
+def format_sql_top(limit=10, key="total"):
+    """Текст отчета профилировщика: top-N запросов по выбранному показателю"""
+    profiler = db.profiler
+    rows = profiler.top(limit, key)
+    if not rows:
+        return "🧪 Hozircha o'lchangan so'rovlar yo'q"
+    
+    since = datetime.datetime.fromtimestamp(profiler.started_at).strftime('%H:%M:%S') if profiler.started_at else "-"
+    text = f"🧪 SQL top-{limit} ({key}), {since} dan beri:\n\n"
+    for n, (sql, stats) in enumerate(rows, 1):
+        text += (
+            f"{n}. {stats.count} ta | jami {stats.total * 1000:.1f} ms | o'rtacha {stats.avg * 1000:.2f} ms | "
+            f"p99 {stats.p99 * 1000:.2f} ms | {stats.rows} qator\n"
+            f"   {sql[:300]}\n\n"
+        )
+    return text
+
+async def sql_profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Управление профилировщиком SQL и отчет по самым дорогим запросам"""
+    user = update.effective_user
+    if user.id not in ADMIN_IDS:
+        return
+    
+    args = [arg.lower() for arg in context.args or []]
+    action = args[0] if args else "top"
+    profiler = db.profiler
+    
+    if action == "on":
+        profiler.enable()
+        await update.message.reply_text(f"✅ SQL profiler yoqildi (sekin: >{profiler.slow_threshold * 1000:.0f} ms)")
+    elif action == "off":
+        profiler.disable()
+        await update.message.reply_text("⏸ SQL profiler o'chirildi (statistika saqlandi)")
+    elif action == "reset":
+        profiler.reset()
+        await update.message.reply_text("🧹 SQL statistikasi tozalandi")
+    elif action == "slow":
+        if not profiler.slow_log:
+            await update.message.reply_text("🐢 Sekin so'rovlar yo'q")
+            return
+        text = "🐢 Oxirgi sekin so'rovlar:\n\n"
+        for logged_at, ms, sql, plan in list(profiler.slow_log)[-10:]:
+            text += f"{datetime.datetime.fromtimestamp(logged_at):%H:%M:%S} {ms:.0f} ms\n{sql[:300]}\n"
+            text += "".join(f"   └ {line}\n" for line in plan) + "\n"
+        await update.message.reply_text(text[:4000])
+    elif action == "top":
+        limit, key = parse_top_args(args[1:], SQL_TOP_KEYS)
+        await update.message.reply_text(format_sql_top(min(limit or 10, 30), key or "total")[:4000])
+    else:
+        await update.message.reply_text(SQL_PROFILE_USAGE)
+
+CPU_PROFILE_USAGE = (
+    "🔬 cProfile:\n\n"
+    "/cprof updates [N] - keyingi N ta update (standart 200)\n"
+    "/cprof seconds [T] - keyingi T soniya (standart 30)\n"
+    "/cprof stop - hozir to'xtatish\n"
+    f"/cprof top [N] [{'|'.join(PROFILE_SORT_KEYS)}] - oxirgi o'lchov natijasi\n"
+    "/cprof file - oxirgi o'lchov .pstats fayli"
+)
+
+MEMORY_PROFILE_USAGE = (
+    "🧠 tracemalloc:\n\n"
+    "/memprof start [kadrlar] - yoqish va boshlang'ich snapshot\n"
+    "/memprof diff [N] - snapshotdan beri eng ko'p o'sgan N ta joy\n"
+    "/memprof reset - yangi boshlang'ich snapshot\n"
+    "/memprof stop - o'chirish"
+)
+
+async def send_text_or_file(bot, chat_id, text, filename):
+    """Длинный отчет уходит файлом: сообщение Telegram ограничено 4096 символами"""
+    if len(text) <= 4000:
+        await bot.send_message(chat_id=chat_id, text=text)
+    else:
+        await bot.send_document(chat_id=chat_id, document=text.encode(), filename=filename)
+
+async def send_cpu_profile(bot, chat_id, limit=25, sort="cumulative"):
+    report = cpu_profiler.report(limit, sort)
+    if report is None:
+        await bot.send_message(chat_id=chat_id, text="🔬 Hali o'lchov qilinmagan")
+        return
+    since = datetime.datetime.fromtimestamp(cpu_profiler.started_at).strftime('%H:%M:%S')
+    header = (
+        f"🔬 cProfile {since}: {cpu_profiler.updates} ta update, {cpu_profiler.elapsed:.1f} s, "
+        f"top-{limit} ({sort})\n\n"
+    )
+    await send_text_or_file(bot, chat_id, header + report, "cprofile.txt")
+
+async def deliver_cpu_profile(bot, chat_id, seconds=None):
+    """Ждет конца замера и отправляет отчет админу, который его запустил"""
+    await cpu_profiler.wait(seconds)
+    try:
+        await send_cpu_profile(bot, chat_id)
+    except TelegramError as e:
+        logger.error(f"cProfile hisobotini yuborishda xato: {e}")
+
+async def cpu_profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """cProfile на следующие N апдейтов или T секунд и отчет по самым дорогим функциям"""
+    user = update.effective_user
+    if user.id not in ADMIN_IDS:
+        return
+    
+    args = [arg.lower() for arg in context.args or []]
+    action = args[0] if args else ""
+    number = int(args[1]) if len(args) > 1 and args[1].isdigit() else None
+    
+    if action in ("updates", "seconds"):
+        if cpu_profiler.active:
+            await update.message.reply_text("⏳ O'lchov allaqachon ketmoqda: /cprof stop")
+            return
+        if action == "updates":
+            cpu_profiler.start(updates=number or 200)
+            start_background(deliver_cpu_profile(context.bot, update.effective_chat.id))
+            await update.message.reply_text(f"🔬 cProfile yoqildi: keyingi {number or 200} ta update")
+        else:
+            cpu_profiler.start()
+            start_background(deliver_cpu_profile(context.bot, update.effective_chat.id, number or 30))
+            await update.message.reply_text(f"🔬 cProfile yoqildi: {number or 30} soniya")
+    elif action == "stop":
+        if not cpu_profiler.stop():
+            await update.message.reply_text("🔬 cProfile yoqilmagan")
+    elif action == "top":
+        limit, sort = parse_top_args(args[1:], PROFILE_SORT_KEYS)
+        await send_cpu_profile(context.bot, update.effective_chat.id, min(limit or 25, 200), sort or "cumulative")
+    elif action == "file":
+        data = cpu_profiler.dump()
+        if data is None:
+            await update.message.reply_text("🔬 Hali o'lchov qilinmagan")
+            return
+        filename = f"bot-{datetime.datetime.fromtimestamp(cpu_profiler.started_at):%Y%m%d-%H%M%S}.pstats"
+        await update.message.reply_document(
+            document=data, filename=filename,
+            caption="python -m pstats " + filename
+        )
+    else:
+        await update.message.reply_text(CPU_PROFILE_USAGE)
+
+def format_memory_diff(limit=15):
+    stats = memory_profiler.diff(limit)
+    current, peak = memory_profiler.traced()
+    since = datetime.datetime.fromtimestamp(memory_profiler.baseline_at).strftime('%H:%M:%S')
+    text = (
+        f"🧠 tracemalloc: {format_megabytes(current)} (eng yuqori {format_megabytes(peak)}), "
+        f"{since} dan beri top-{limit}:\n\n"
+    )
+    for stat in stats:
+        frame = stat.traceback[0]
+        filename = os.path.join(*frame.filename.split(os.sep)[-2:])
+        text += (
+            f"{stat.size_diff / 1024:+.1f} KiB ({stat.count_diff:+d} ta), jami {stat.size / 1024:.1f} KiB\n"
+            f"   {filename}:{frame.lineno}\n"
+        )
+    return text
+
+async def memory_profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """tracemalloc: разница снимков памяти с момента start/reset"""
+    user = update.effective_user
+    if user.id not in ADMIN_IDS:
+        return
+    
+    args = [arg.lower() for arg in context.args or []]
+    action = args[0] if args else ""
+    number = int(args[1]) if len(args) > 1 and args[1].isdigit() else None
+    
+    if action not in ("start", "diff", "reset", "stop"):
+        await update.message.reply_text(MEMORY_PROFILE_USAGE)
+    elif action == "start":
+        # Больше кадров - точнее место аллокации, но дороже каждая аллокация
+        await run_in_thread(memory_profiler.start, min(number or 1, 25))
+        await update.message.reply_text("🧠 tracemalloc yoqildi, boshlang'ich snapshot olindi")
+    elif not memory_profiler.active:
+        await update.message.reply_text("🧠 tracemalloc yoqilmagan: /memprof start")
+    elif action == "diff":
+        # Снимок и сравнение всей кучи - в потоке, чтобы не останавливать прием апдейтов
+        text = await run_in_thread(format_memory_diff, min(number or 15, 100))
+        await send_text_or_file(context.bot, update.effective_chat.id, text, "tracemalloc.txt")
+    elif action == "reset":
+        await run_in_thread(memory_profiler.reset)
+        await update.message.reply_text("🧠 Yangi boshlang'ich snapshot olindi")
+    elif action == "stop":
+        memory_profiler.stop()
+        await update.message.reply_text("🧠 tracemalloc o'chirildi")
+
+SPARK_BARS = "▁▂▃▄▅▆▇█"
+
+async def movie_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Просмотры фильма по дням за последние 30 дней"""
+    user = update.effective_user
+    if user.id not in ADMIN_IDS:
+        return
+    
+    if not context.args:
+        await update.message.reply_text("❌ Foydalanish: /moviestats <kod>")
+        return
+    
+    movie_code = context.args[0]
+    movie = db.get_movie(movie_code)
+    if not movie:
+        await update.message.reply_text("❌ Film topilmadi")
+        return
+    
+    days = db.get_movie_daily_views(movie_code, 30)
+    peak = max(count for _, count in days)
+    total = sum(count for _, count in days)
+    sparkline = "".join(
+        SPARK_BARS[count * (len(SPARK_BARS) - 1) // peak] if peak else SPARK_BARS[0]
+        for _, count in days
+    )
+    
+    text = f"📈 #{movie_code} - oxirgi 30 kun\n\n{sparkline}\n\n"
+    text += f"👁️ Jami: {total} | 📅 O'rtacha: {total / len(days):.1f}/kun | 🔝 Eng ko'p: {peak}\n\n"
+    for day, count in days[-7:]:
+        bar = "█" * (count * 15 // peak) if peak else ""
+        text += f"{day[5:]} {bar} {count}\n"
+    
+    await update.message.reply_text(text)
+
+async def deliver_broadcast_copy(message_to_send, user_id):
+    """Копирует сообщение пользователю и классифицирует результат: ok, dead или failed"""
+    for attempt in range(2):
+        try:
+            await message_to_send.copy(chat_id=user_id)
+            return "ok"
+        except RetryAfter as e:
+            # Telegram просит подождать - ждем и пробуем еще раз
+            if attempt == 0:
+                await asyncio.sleep(e.retry_after)
+                continue
+            logger.error(f"Xabar yuborishda xato {user_id}: {e}")
+            return "failed"
+        except Exception as e:
+            if is_dead_recipient_error(e):
+                return "dead"
+            logger.error(f"Xabar yuborishda xato {user_id}: {e}")
+            return "failed"
+    return "failed"
+
+BROADCAST_USAGE = (
+    "📨 Xabar yuborish uchun xabarga javob bering:\n\n"
+    "/broadcast - barcha foydalanuvchilarga\n"
+    "/broadcast active 7 - oxirgi 7 kunda faol bo'lganlarga\n"
+    "/broadcast premium - premium foydalanuvchilarga\n"
+    "/broadcast genre Drama - shu janrdagi filmlarni ko'rganlarga\n"
+    "/broadcast fav <kod> - filmni saqlaganlarga"
+)
+
+def parse_broadcast_segment(args):
+    """Разбирает аргументы /broadcast в (сегмент, значение) или None"""
+    if not args:
+        return "all", None
+    
+    segment = args[0].lower()
+    if segment == "all":
+        return "all", None
+    if segment == "premium":
+        return "premium", None
+    if segment == "active" and len(args) > 1 and args[1].isdigit() and int(args[1]) > 0:
+        return "active", int(args[1])
+    if segment == "genre" and len(args) > 1:
+        genre = next((g for g in GENRES if g.lower() == args[1].lower()), None)
+        return ("genre", genre) if genre else None
+    if segment in ("fav", "favorite") and len(args) > 1:
+        return "favorite", args[1]
+    return None
+
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Рассылка сообщения всем пользователям"""
+    """Рассылка сообщения всем пользователям или выбранному сегменту"""
     user = update.effective_user
     if user.id not in ADMIN_IDS:
         return
     
-    if update.message.reply_to_message:
+    segment = parse_broadcast_segment(context.args)
+    if update.message.reply_to_message and segment:
         message_to_send = update.message.reply_to_message
-        users = db.get_all_users()
-        total_users = len(users)
+        segment_name, segment_value = segment
+        total_users = db.count_audience(segment_name, segment_value)
         success_count = 0
         failed_count = 0
+        dead_user_ids = []
+        pending_dead = []
         
         status_message = await update.message.reply_text(
             f"📨 Xabar yuborish boshlandi...\n"
@@ -2447,36 +3773,46 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"❌ Muvaffaqiyatsiz: 0"
         )
         
-        for user_data in users:
-            user_id = user_data[0]
-            try:
-                await message_to_send.copy(chat_id=user_id)
-                success_count += 1
+        for user_ids in db.iter_audience_ids(segment_name, segment_value):
+            for user_id in user_ids:
+                result = await deliver_broadcast_copy(message_to_send, user_id)
                 
-                if success_count % 10 == 0:
-                    await status_message.edit_text(
-                        f"📨 Xabar yuborish davom etmoqda...\n"
-                        f"👥 Jami foydalanuvchilar: {total_users}\n"
-                        f"✅ Muvaffaqiyatli: {success_count}\n"
-                        f"❌ Muvaffaqiyatsiz: {failed_count}"
-                    )
-                
-                await asyncio.sleep(0.1)
-                
-            except Exception as e:
-                failed_count += 1
-                logger.error(f"Xabar yuborishda xato {user_id}: {e}")
+                if result == "ok":
+                    success_count += 1
+                    
+                    if success_count % 10 == 0:
+                        await status_message.edit_text(
+                            f"📨 Xabar yuborish davom etmoqda...\n"
+                            f"👥 Jami foydalanuvchilar: {total_users}\n"
+                            f"✅ Muvaffaqiyatli: {success_count}\n"
+                            f"❌ Muvaffaqiyatsiz: {failed_count}\n"
+                            f"🚫 Botni bloklagan: {len(dead_user_ids)}"
+                        )
+                    
+                    await asyncio.sleep(0.1)
+                elif result == "dead":
+                    dead_user_ids.append(user_id)
+                    pending_dead.append(user_id)
+                    # Помечаем пачками, чтобы не открывать соединение на каждого
+                    if len(pending_dead) >= 100:
+                        db.mark_users_inactive(pending_dead)
+                        pending_dead = []
+                else:
+                    failed_count += 1
+        
+        db.mark_users_inactive(pending_dead)
+        active_users, inactive_users = db.get_users_health_counts()
         
         await status_message.edit_text(
             f"✅ Xabar yuborish yakunlandi!\n\n"
             f"👥 Jami foydalanuvchilar: {total_users}\n"
             f"✅ Muvaffaqiyatli: {success_count}\n"
-            f"❌ Muvaffaqiyatsiz: {failed_count}"
+            f"❌ Muvaffaqiyatsiz: {failed_count}\n"
+            f"🚫 Botni bloklagan: {len(dead_user_ids)}\n\n"
+            f"📊 Yetib boradi: {active_users} / Bloklagan: {inactive_users}"
         )
     else:
-        await update.message.reply_text(
-            "📨 Xabar yuborish uchun xabarga javob bering: /broadcast"
-        )
+        await update.message.reply_text(BROADCAST_USAGE)
 
 async def random_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда для случайного фильма"""
@@ -2519,323 +3855,993 @@ async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=get_main_keyboard()
         )
 
-# ОБРАБОТЧИК АДМИНСКИХ СООБЩЕНИЙ
-async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обрабатывает сообщения от админа для настройки каналов"""
-    user = update.effective_user
-    if user.id not in ADMIN_IDS:
+# ДИСПЕТЧЕР ТЕКСТОВЫХ СООБЩЕНИЙ
+class ConversationStates:
+    """Состояния диалога по пользователям: какой ответ бот ждет от пользователя.
+
+    Обработчик состояния: async def handler(update, context, text). Он сам снимает
+    состояние после успешного ввода; кнопка меню тоже снимает его.
+    """
+    
+    def __init__(self):
+        self.handlers = {}  # состояние -> (обработчик, только админ)
+        self._states = {}  # user_id -> состояние
+    
+    def state(self, name, admin=False):
+        """Регистрирует обработчик ответа для состояния name"""
+        def decorator(func):
+            self.handlers[name] = (func, admin)
+            return func
+        return decorator
+    
+    def get(self, user_id):
+        return self._states.get(user_id)
+    
+    def set(self, user_id, name):
+        self._states[user_id] = name
+    
+    def clear(self, user_id):
+        self._states.pop(user_id, None)
+    
+    async def dispatch(self, update, context, text):
+        """Передает текст обработчику текущего состояния; False - состояния нет"""
+        user_id = update.effective_user.id
+        state = self._states.get(user_id)
+        if state is None:
+            return False
+        func, admin_only = self.handlers[state]
+        if admin_only and user_id not in ADMIN_IDS:
+            self.clear(user_id)
+            return False
+        await func(update, context, text)
+        return True
+
+conversation = ConversationStates()
+
+@conversation.state("archive_channel", admin=True)
+async def receive_archive_channel(update, context, text):
+    """Админ прислал ID нового архивного канала"""
+    try:
+        channel_id = int(text)
+    except ValueError:
+        await update.message.reply_text(
+            "❌ Noto'g'ri format! Faqat raqam kiriting.\n"
+            "Misol: <code>-1001234567890</code>",
+            parse_mode="HTML"
+        )
         return
     
-    text = update.message.text.strip()
+    db.update_setting('archive_channel', str(channel_id))
+    conversation.clear(update.effective_user.id)
+    await update.message.reply_text(
+        f"✅ Arxiv kanali yangilandi: {channel_id}",
+        reply_markup=get_admin_keyboard()
+    )
+
+@conversation.state("codes_channel", admin=True)
+async def receive_codes_channel(update, context, text):
+    """Админ прислал username или ссылку нового канала кодов"""
+    # Извлекаем username или оставляем как есть
+    if text.startswith('https://t.me/'):
+        codes_channel = text.split('/')[-1]
+        if codes_channel.startswith('@'):
+            codes_channel = codes_channel[1:]
+    elif text.startswith('@'):
+        codes_channel = text[1:]
+    else:
+        codes_channel = text
     
-    # Обработка установки архива канала
-    if context.user_data.get('waiting_for_archive_channel'):
-        try:
-            channel_id = int(text)
-            db.update_setting('archive_channel', str(channel_id))
-            await update.message.reply_text(
-                f"✅ Arxiv kanali yangilandi: {channel_id}",
-                reply_markup=get_admin_keyboard()
-            )
-            context.user_data.pop('waiting_for_archive_channel', None)
-        except ValueError:
-            await update.message.reply_text(
-                "❌ Noto'g'ri format! Faqat raqam kiriting.\n"
-                "Misol: <code>-1001234567890</code>",
-                parse_mode="HTML"
-            )
+    db.update_setting('codes_channel', codes_channel)
+    conversation.clear(update.effective_user.id)
+    await update.message.reply_text(
+        f"✅ Kodlar kanali yangilandi: {codes_channel}",
+        reply_markup=get_admin_keyboard()
+    )
+
+@conversation.state("report_description")
+async def receive_report_description(update, context, text):
+    """Пользователь написал пояснение к жалобе - отправляем жалобу сразу"""
+    user_id = update.effective_user.id
+    conversation.clear(user_id)
+    report_data = context.user_data.pop('current_report', None)
+    if not report_data:
+        await universal_search(update, context, text)
+        return
     
-    # Обработка установки канала кодов
-    elif context.user_data.get('waiting_for_codes_channel'):
-        # Извлекаем username или оставляем как есть
-        if text.startswith('https://t.me/'):
-            codes_channel = text.split('/')[-1]
-            if codes_channel.startswith('@'):
-                codes_channel = codes_channel[1:]
-        elif text.startswith('@'):
-            codes_channel = text[1:]
-        else:
-            codes_channel = text
-        
-        db.update_setting('codes_channel', codes_channel)
+    movie_code = report_data['movie_code']
+    if db.add_report(user_id, movie_code, report_data['report_type'], text[:1000]):
         await update.message.reply_text(
-            f"✅ Kodlar kanali yangilandi: {codes_channel}",
-            reply_markup=get_admin_keyboard()
+            "✅ Shikoyatingiz qabul qilindi!\n\n"
+            "Administratorlar tez orada ko'rib chiqishadi.\n"
+            "Hisobingizga e'tiboringiz uchun rahmat!",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Orqaga", callback_data=pack_callback("back_to_movie", movie_code))]
+            ])
         )
-        context.user_data.pop('waiting_for_codes_channel', None)
+    else:
+        await update.message.reply_text("❌ Shikoyat yuborishda xato")
 
-# ОБРАБОТЧИК CALLBACK
-async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+async def show_search_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "🔍 Film nomi yoki kodini kiriting:\n\n"
+        "Misol: <code>Avatar</code> yoki <code>AVATAR2024</code>\n"
+        "Yoki: <code>Tezlik</code> (qisman nom)",
+        parse_mode="HTML",
+        reply_markup=ReplyKeyboardMarkup([[KeyboardButton("🔙 Bosh menyu")]], resize_keyboard=True)
+    )
+
+async def show_categories_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "Qidiruv turini tanlang:",
+        reply_markup=get_categories_keyboard()
+    )
+
+async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "Bosh menyu:",
+        reply_markup=get_main_keyboard()
+    )
+
+# Кнопки основной клавиатуры -> обработчик
+MENU_BUTTONS = {
+    "🔍 Film Qidirish": show_search_prompt,
+    "🎬 Kategoriyalar": show_categories_menu,
+    "🎬 Barcha filmlar": show_all_movies,
+    "📊 Yangi filmlar (2020-2025)": show_recent_movies,
+    "🏆 Top filmlar": show_top_movies,
+    "✨ Siz uchun": show_feed,
+    "⭐ Tasodifiy film": send_random_movie,
+    "❤️ Mening filmlarim": show_favorites,
+    "ℹ️ Yordam": show_help,
+    "🔙 Bosh menyu": show_main_menu,
+}
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Единый обработчик текста: ожидаемый ответ, кнопка меню или поиск"""
+    user = update.effective_user
+    text = update.message.text.strip()
+    is_admin = user.id in ADMIN_IDS
+    menu_action = MENU_BUTTONS.get(text)
     
-    user = query.from_user
-    data = query.data
+    # Админ в процессе настройки: без проверки подписки и без поиска
+    if is_admin and menu_action is None and await conversation.dispatch(update, context, text):
+        return
     
     db.update_user_activity(user.id)
-    db.log_user_activity(user.id, "callback", data)
     
-    if user.id not in ADMIN_IDS:
+    if not is_admin:
         if not await require_subscription(update, context):
             return
     
-    # Основные обработчики
-    if data == "main_menu":
-        if user.id in ADMIN_IDS:
-            await query.edit_message_text("👨‍💻 Admin paneli:", reply_markup=get_admin_keyboard())
+    db.log_user_activity(user.id, "message", text)
+    
+    if menu_action is not None:
+        conversation.clear(user.id)
+        await menu_action(update, context)
+    elif not await conversation.dispatch(update, context, text):
+        # УНИВЕРСАЛЬНЫЙ ПОИСК - ОБРАБОТКА ЛЮБОГО ТЕКСТА
+        await universal_search(update, context, text)
+
+# МАРШРУТИЗАТОР CALLBACK
+class CallbackRouter:
+    """Таблица маршрутов callback_data: тег действия -> обработчик с типизированными аргументами.
+
+    Формат данных кнопки: "тег", "тег:арг1:арг2" или "~токен" для длинных данных
+    (см. pack_callback). Кнопки старого формата ("fav_123", "category_page_genre_Drama_0")
+    разбираются по самому длинному совпадающему префиксу.
+    """
+    
+    def __init__(self):
+        self.routes = {}  # тег -> (обработчик, типы аргументов, только админ, нужна подписка)
+        self.stats = {}  # тег -> [вызовы, суммарное время, максимум]
+        self.latency = {}  # тег -> гистограмма bot_handler_seconds
+        self._legacy = {}  # старый префикс -> тег
+        self._legacy_prefixes = ()
+    
+    def route(self, tag, *arg_types, admin=False, auth=True, legacy=None):
+        """Регистрирует обработчик: async def handler(update, context, *args)"""
+        def decorator(func):
+            self.routes[tag] = (func, arg_types, admin, auth)
+            self.stats[tag] = [0, 0.0, 0.0]
+            self.latency[tag] = HANDLER_SECONDS.labels(f"callback:{tag}")
+            if legacy:
+                self._legacy[legacy] = tag
+                # Длинные префиксы проверяются первыми: admin_delete_movies_ раньше admin_delete_
+                self._legacy_prefixes = tuple(sorted(self._legacy, key=len, reverse=True))
+            return func
+        return decorator
+    
+    def resolve(self, data):
+        """Возвращает (тег, аргументы) или None, если кнопка неизвестна или устарела"""
+        if data.startswith("~"):
+            # Аргументы из хранилища уже типизированы
+            resolved = callback_state.get(data[1:])
+            if resolved is None or resolved[0] not in self.routes:
+                return None
+            return resolved
+        
+        tag, sep, rest = data.partition(":")
+        if tag in self.routes:
+            raw_args = rest.split(":") if sep else []
         else:
-            await query.edit_message_text("Bosh menyu:", reply_markup=get_main_menu_inline_keyboard())
+            prefix = next((p for p in self._legacy_prefixes if data.startswith(p)), None)
+            if prefix is None:
+                return None
+            tag = self._legacy[prefix]
+            arg_types = self.routes[tag][1]
+            rest = data[len(prefix):]
+            raw_args = self._split_legacy(rest, len(arg_types))
+        
+        arg_types = self.routes[tag][1]
+        if len(raw_args) != len(arg_types):
+            return None
+        try:
+            return tag, tuple(arg_type(value) for arg_type, value in zip(arg_types, raw_args))
+        except ValueError:
+            return None
     
-    elif data == "categories":
-        await query.edit_message_text("Qidiruv turini tanlang:", reply_markup=get_categories_keyboard())
+    @staticmethod
+    def _split_legacy(rest, count):
+        """Делит "genre_Ilmiy_fantastika_2" на count аргументов.
+
+        Первый аргумент (тип, код) и последние (номера страниц) без "_", поэтому
+        первый отделяется слева, последние - справа, а значение в середине
+        забирает все остальное вместе со своими "_".
+        """
+        if count == 0:
+            return []
+        if count == 1:
+            return [rest]
+        first, _, rest = rest.partition("_")
+        return [first, *rest.rsplit("_", count - 2)]
+    
+    def record(self, tag, elapsed):
+        self.latency[tag].observe(elapsed)
+        stats = self.stats[tag]
+        stats[0] += 1
+        stats[1] += elapsed
+        if elapsed > stats[2]:
+            stats[2] = elapsed
+
+callback_router = CallbackRouter()
+
+# ОБРАБОТЧИК CALLBACK
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
     
-    elif data.startswith("all_movies_"):
-        page = int(data.split("_")[2])
-        await show_all_movies(update, context, page)
+    user = query.from_user
+    data = query.data
     
-    elif data == "search_by_code":
-        await query.edit_message_text(
-            "🔍 Film nomi yoki kodini kiriting:\n\n"
-            "Misol: <code>Avatar</code> yoki <code>AVATAR2024</code>\n"
-            "Yoki: <code>Tezlik</code> (qisman nom)",
-            parse_mode="HTML"
-        )
+    resolved = callback_router.resolve(data)
+    if resolved is None:
+        logger.warning(f"Noma'lum callback: {data}")
+        return
     
-    elif data == "random_movie":
-        await send_random_movie(update, context)
+    tag, args = resolved
+    func, arg_types, admin_only, needs_auth = callback_router.routes[tag]
+    if admin_only and user.id not in ADMIN_IDS:
+        return
     
-    elif data == "help":
-        await show_help(update, context)
+    if needs_auth:
+        db.update_user_activity(user.id)
+        db.log_user_activity(user.id, "callback", data)
+        
+        if user.id not in ADMIN_IDS:
+            if not await require_subscription(update, context):
+                return
     
-    elif data == "category_genre":
-        await query.edit_message_text("🎭 Janrni tanlang:", reply_markup=get_genres_keyboard())
+    # Любая кнопка отменяет незавершенный ввод; маршрут, которому нужен ответ, выставит состояние заново
+    conversation.clear(user.id)
     
-    elif data == "category_country":
-        await query.edit_message_text("🌎 Davlatni tanlang:", reply_markup=get_countries_keyboard())
+    started = time.perf_counter()
+    try:
+        await func(update, context, *args)
+    finally:
+        callback_router.record(tag, time.perf_counter() - started)
+
+# Основные обработчики
+@callback_router.route("main_menu")
+async def route_main_menu(update, context):
+    query = update.callback_query
+    if query.from_user.id in ADMIN_IDS:
+        text, reply_markup = "👨‍💻 Admin paneli:", get_admin_keyboard()
+    else:
+        text, reply_markup = "Bosh menyu:", get_main_menu_inline_keyboard()
     
-    elif data == "category_year":
-        await query.edit_message_text("🗓️ Yilni tanlang:", reply_markup=get_years_keyboard())
+    # Видео не превращаем в меню - меню приходит новым сообщением
+    if is_media_message(query.message):
+        await query.message.reply_text(text, reply_markup=reply_markup)
+    else:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+
+@callback_router.route("current_page", auth=False)
+async def route_current_page(update, context):
+    """Кнопка с номером страницы ничего не делает"""
+
+@callback_router.route("check_subscription", auth=False)
+async def route_check_subscription(update, context):
+    await check_subscription_callback(update, context)
+
+@callback_router.route("categories")
+async def route_categories(update, context):
+    await update.callback_query.edit_message_text("Qidiruv turini tanlang:", reply_markup=get_categories_keyboard())
+
+@callback_router.route("all_movies", int, legacy="all_movies_")
+async def route_all_movies(update, context, page):
+    await show_all_movies(update, context, page)
+
+@callback_router.route("search_by_code")
+async def route_search_by_code(update, context):
+    await update.callback_query.edit_message_text(
+        "🔍 Film nomi yoki kodini kiriting:\n\n"
+        "Misol: <code>Avatar</code> yoki <code>AVATAR2024</code>\n"
+        "Yoki: <code>Tezlik</code> (qisman nom)",
+        parse_mode="HTML"
+    )
+
+@callback_router.route("random_movie")
+async def route_random_movie(update, context):
+    await send_random_movie(update, context)
+
+@callback_router.route("help")
+async def route_help(update, context):
+    await show_help(update, context)
+
+@callback_router.route("category_genre")
+async def route_category_genre(update, context):
+    await update.callback_query.edit_message_text("🎭 Janrni tanlang:", reply_markup=get_genres_keyboard())
+
+@callback_router.route("category_country")
+async def route_category_country(update, context):
+    await update.callback_query.edit_message_text("🌎 Davlatni tanlang:", reply_markup=get_countries_keyboard())
+
+@callback_router.route("category_year")
+async def route_category_year(update, context):
+    await update.callback_query.edit_message_text("🗓️ Yilni tanlang:", reply_markup=get_years_keyboard())
+
+@callback_router.route("category_quality")
+async def route_category_quality(update, context):
+    await update.callback_query.edit_message_text("📹 Sifatni tanlang:", reply_markup=get_qualities_keyboard())
+
+@callback_router.route("select", str, str, legacy="select_")
+async def route_select_category(update, context, category_type, category_value):
+    await show_movies_by_category(update.callback_query, category_type, category_value)
+
+@callback_router.route("category_page", str, str, int, legacy="category_page_")
+async def route_category_page(update, context, category_type, category_value, page):
+    await show_movies_by_category(update.callback_query, category_type, category_value, page)
+
+# Набор фильтров всегда передается через callback_state
+@callback_router.route("browse", list, str, int)
+async def route_browse(update, context, filters, order, page):
+    await show_browse(update.callback_query, filters, order, page)
+
+@callback_router.route("refine", list, str)
+async def route_refine(update, context, filters, category_type):
+    await show_refine_options(update.callback_query, filters, category_type)
+
+@callback_router.route("recent_movies", int, legacy="recent_movies_")
+async def route_recent_movies(update, context, page):
+    await show_recent_movies(update, context, page)
+
+@callback_router.route("top_movies", int, legacy="top_movies_")
+async def route_top_movies(update, context, page):
+    await show_top_movies(update, context, page)
+
+@callback_router.route("trending", str, int)
+async def route_trending(update, context, period, page):
+    await show_top_movies(update, context, page, period)
+
+@callback_router.route("feed", int)
+async def route_feed(update, context, page):
+    await show_feed(update, context, page)
+
+@callback_router.route("favorites", int, legacy="favorites_")
+async def route_favorites(update, context, page):
+    await show_favorites(update, context, page)
+
+@callback_router.route("download", str, legacy="download_")
+async def route_download(update, context, movie_code):
+    query = update.callback_query
+    success = await send_movie_to_user(update, context, movie_code, query.from_user.id)
+    if not success:
+        await query.answer("❌ Videoni yuborishda xato", show_alert=True)
+
+@callback_router.route("fav", str, legacy="fav_")
+async def route_toggle_favorite(update, context, movie_code):
+    query = update.callback_query
+    user = query.from_user
+    card = db.get_movie_card(movie_code, user.id)
+    if not card:
+        await query.answer("❌ Film topilmadi", show_alert=True)
+        return
     
-    elif data == "category_quality":
-        await query.edit_message_text("📹 Sifatni tanlang:", reply_markup=get_qualities_keyboard())
+    if card['is_favorite']:
+        db.remove_from_favorites(user.id, movie_code)
+        await query.answer("❌ Film olib tashlandi")
+    else:
+        db.add_to_favorites(user.id, movie_code)
+        await query.answer("❤️ Film saqlandi")
     
-    elif data.startswith("select_"):
-        parts = data.split("_")
-        if len(parts) >= 3:
-            category_type = parts[1]
-            category_value = parts[2]
-            await show_movies_by_category(query, category_type, category_value)
+    card['is_favorite'] = not card['is_favorite']
+    await show_movie_screen(query, card, user.id)
+
+@callback_router.route("rate", str, legacy="rate_")
+async def route_rate(update, context, movie_code):
+    await show_rating_options(update.callback_query, movie_code)
+
+@callback_router.route("rating", str, int, legacy="rating_")
+async def route_rating(update, context, movie_code, rating):
+    query = update.callback_query
+    if not 1 <= rating <= 5:
+        return
     
-    elif data.startswith("category_page_"):
-        parts = data.split("_")
-        if len(parts) >= 5:
-            category_type = parts[2]
-            category_value = parts[3]
-            page = int(parts[4])
-            await show_movies_by_category(query, category_type, category_value, page)
+    db.add_rating(query.from_user.id, movie_code, rating)
+    await query.answer(f"✅ {rating} baho qo'yildi!")
     
-    elif data.startswith("recent_movies_"):
-        page = int(data.split("_")[2])
-        await show_recent_movies(update, context, page)
+    await send_movie_details(query, movie_code, query.from_user.id)
+
+@callback_router.route("report", str, legacy="report_")
+async def route_report(update, context, movie_code):
+    query = update.callback_query
+    card = db.get_movie_card(movie_code, query.from_user.id)
+    if not card:
+        await query.answer("❌ Film topilmadi", show_alert=True)
+        return
+    await show_report_options(query, card)
+
+@callback_router.route("report_type", str, str, legacy="report_type_")
+async def route_report_type(update, context, movie_code, report_type):
+    query = update.callback_query
     
-    elif data.startswith("top_movies_"):
-        page = int(data.split("_")[2])
-        await show_top_movies(update, context, page)
+    # Проверяем существование фильма
+    movie = db.get_movie(movie_code)
+    if not movie:
+        await query.answer("❌ Film topilmadi", show_alert=True)
+        return
     
-    elif data.startswith("favorites_"):
-        page = int(data.split("_")[1])
-        await show_favorites(update, context, page)
+    # Сохраняем тип жалобы в контексте
+    context.user_data['current_report'] = {
+        'movie_code': movie_code,
+        'report_type': report_type
+    }
+    conversation.set(query.from_user.id, "report_description")
+    
+    await edit_query_message(
+        query,
+        f"⚠️ Shikoyat turi: {get_report_type_name(report_type)}\n\n"
+        "Qo'shimcha izoh yozing (ixtiyoriy):\n\n"
+        "Misol: <i>Video sifat yomon, to'liq ko'rinmayapti</i>",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🚫 Izohsiz yuborish", callback_data=pack_callback("report_submit", movie_code))],
+            [InlineKeyboardButton("🔙 Orqaga", callback_data=pack_callback("back_to_movie", movie_code))]
+        ])
+    )
+
+@callback_router.route("report_submit", str, legacy="report_submit_")
+async def route_report_submit(update, context, movie_code):
+    query = update.callback_query
+    report_data = context.user_data.get('current_report', {})
     
-    elif data.startswith("download_"):
-        movie_code = data.split("_")[1]
-        success = await send_movie_to_user(update, context, movie_code, user.id)
-        if not success:
-            await query.answer("❌ Videoni yuborishda xato", show_alert=True)
+    # Проверяем существование фильма
+    movie = db.get_movie(movie_code)
+    if not movie:
+        await query.answer("❌ Film topilmadi", show_alert=True)
+        return
     
-    elif data.startswith("fav_"):
-        movie_code = data.split("_")[1]
+    if report_data.get('movie_code') == movie_code:
+        report_type = report_data.get('report_type')
+        description = report_data.get('description')
         
-        if db.is_favorite(user.id, movie_code):
-            db.remove_from_favorites(user.id, movie_code)
-            await query.answer("❌ Film olib tashlandi")
-        else:
-            db.add_to_favorites(user.id, movie_code)
-            await query.answer("❤️ Film saqlandi")
-        
-        movie = db.get_movie(movie_code)
-        if movie:
-            movie_info = await format_movie_info(movie_code, user.id)
-            await query.edit_message_text(
-                movie_info,
-                reply_markup=get_movie_keyboard(user.id, movie_code)
+        success = db.add_report(query.from_user.id, movie_code, report_type, description)
+        if success:
+            await edit_query_message(
+                query,
+                "✅ Shikoyatingiz qabul qilindi!\n\n"
+                "Administratorlar tez orada ko'rib chiqishadi.\n"
+                "Hisobingizga e'tiboringiz uchun rahmat!",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("🔙 Orqaga", callback_data=pack_callback("back_to_movie", movie_code))]
+                ])
             )
+        else:
+            await query.answer("❌ Shikoyat yuborishda xato", show_alert=True)
     
-    elif data.startswith("rate_"):
-        movie_code = data.split("_")[1]
-        await show_rating_options(query, movie_code)
+    # Очищаем контекст
+    context.user_data.pop('current_report', None)
+    conversation.clear(query.from_user.id)
+
+@callback_router.route("similar", str)
+async def route_similar(update, context, movie_code):
+    query = update.callback_query
+    movies = db.get_similar_movies(movie_code)
+    back = [InlineKeyboardButton("🔙 Orqaga", callback_data=pack_callback("back_to_movie", movie_code))]
+    if not movies:
+        # Нажатие уже подтверждено в handle_callback - второй answer() вызовет BadRequest
+        await edit_query_message(query, "🎯 Hozircha o'xshash filmlar yo'q", reply_markup=InlineKeyboardMarkup([back]))
+        return
     
-    elif data.startswith("rating_"):
-        parts = data.split("_")
-        movie_code = parts[1]
-        rating = int(parts[2])
-        
-        db.add_rating(user.id, movie_code, rating)
-        await query.answer(f"✅ {rating} baho qo'yildi!")
+    keyboard = [
+        [InlineKeyboardButton(f"🎬 {title[:35] + '...' if len(title) > 35 else title}", callback_data=pack_callback("download", code))]
+        for code, title in movies
+    ]
+    keyboard.append(back)
+    await edit_query_message(query, "🎯 O'xshash filmlar:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+@callback_router.route("back_to_movie", str, legacy="back_to_movie_")
+async def route_back_to_movie(update, context, movie_code):
+    query = update.callback_query
+    await send_movie_details(query, movie_code, query.from_user.id)
+
+# АДМИН ОБРАБОТЧИКИ
+@callback_router.route("admin_stats", admin=True)
+async def route_admin_stats(update, context):
+    await show_admin_stats(update.callback_query)
+
+@callback_router.route("admin_perf", admin=True)
+async def route_admin_perf(update, context):
+    try:
+        await update.callback_query.edit_message_text(perf_report(), reply_markup=get_perf_keyboard())
+    except BadRequest as e:
+        # Повторное "Yangilash" в ту же секунду дает тот же текст
+        if "not modified" not in str(e).lower():
+            raise
+
+@callback_router.route("admin_movies", int, admin=True, legacy="admin_movies_")
+async def route_admin_movies(update, context, page):
+    await show_admin_movies(update.callback_query, page)
+
+@callback_router.route("admin_delete_movies", int, admin=True, legacy="admin_delete_movies_")
+async def route_admin_delete_movies(update, context, page):
+    await show_admin_movies(update.callback_query, page, delete_mode=True)
+
+@callback_router.route("admin_delete", str, admin=True, legacy="admin_delete_")
+async def route_admin_delete(update, context, movie_code):
+    await show_delete_confirmation(update.callback_query, movie_code)
+
+@callback_router.route("admin_confirm_delete", str, admin=True, legacy="admin_confirm_delete_")
+async def route_admin_confirm_delete(update, context, movie_code):
+    await delete_movie_confirmed(update.callback_query, movie_code)
+
+@callback_router.route("admin_movie_info", str, admin=True, legacy="admin_movie_info_")
+async def route_admin_movie_info(update, context, movie_code):
+    await show_admin_movie_info(update.callback_query, movie_code)
+
+@callback_router.route("admin_reports", int, admin=True, legacy="admin_reports_")
+async def route_admin_reports(update, context, page):
+    await show_admin_reports(update.callback_query, page)
+
+@callback_router.route("admin_report_info", int, admin=True, legacy="admin_report_info_")
+async def route_admin_report_info(update, context, report_id):
+    await show_admin_report_info(update.callback_query, report_id)
+
+@callback_router.route("admin_resolve_report", int, admin=True, legacy="admin_resolve_report_")
+async def route_admin_resolve_report(update, context, report_id):
+    await resolve_report_confirmed(update.callback_query, report_id)
+
+@callback_router.route("admin_channels", admin=True)
+async def route_admin_channels(update, context):
+    await show_admin_channels(update.callback_query)
+
+@callback_router.route("admin_settings", admin=True)
+async def route_admin_settings(update, context):
+    await show_admin_settings(update.callback_query)
+
+@callback_router.route("admin_set_archive", admin=True)
+async def route_admin_set_archive(update, context):
+    await set_archive_channel(update.callback_query, context)
+
+@callback_router.route("admin_set_codes", admin=True)
+async def route_admin_set_codes(update, context):
+    await set_codes_channel(update.callback_query, context)
+
+@callback_router.route("admin_analytics", admin=True)
+async def route_admin_analytics(update, context):
+    await show_admin_analytics(update.callback_query)
+
+@callback_router.route("admin_broadcast", admin=True)
+async def route_admin_broadcast(update, context):
+    await update.callback_query.message.reply_text(BROADCAST_USAGE)
+
+# ЗАЩИТА ОТ ФЛУДА
+class FloodControl:
+    """Решает в памяти, принимать ли апдейт, до любых записей в базу"""
+    
+    # Сколько записей держать, прежде чем чистить устаревшие
+    MAX_TRACKED = 10000
+    
+    def __init__(self, rate, burst, duplicate_window):
+        self.rate = rate
+        self.burst = burst
+        self.duplicate_window = duplicate_window
+        self._buckets = {}  # user_id -> [токены, время последнего пополнения]
+        self._recent_callbacks = {}  # (user_id, callback_data) -> время нажатия
+        self._warned_at = {}  # user_id -> время последнего предупреждения
+        self.dropped = Counter()
+    
+    def allow(self, user_id, now=None):
+        """Token bucket: True, если у пользователя есть токен"""
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= self.MAX_TRACKED:
+                self._prune_buckets(now)
+            self._buckets[user_id] = [self.burst - 1, now]
+            return True
         
-        movie_info = await format_movie_info(movie_code, user.id)
-        await query.edit_message_text(
-            movie_info,
-            reply_markup=get_movie_keyboard(user.id, movie_code)
-        )
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1
+        return True
     
-    elif data.startswith("report_"):
-        movie_code = data.split("_")[1]
-        movie = db.get_movie(movie_code)
-        if not movie:
-            await query.answer("❌ Film topilmadi", show_alert=True)
-            return
-        await show_report_options(query, movie_code)
-    
-    elif data == "check_subscription":
-        await check_subscription_callback(update, context)
-
-    # АДМИН ОБРАБОТЧИКИ
-    elif data == "admin_stats":
-        await show_admin_stats(query)
-    elif data.startswith("admin_movies_"):
-        page = int(data.split("_")[2])
-        await show_admin_movies(query, page)
-    elif data.startswith("admin_delete_movies_"):
-        page = int(data.split("_")[3])
-        await show_admin_movies(query, page, delete_mode=True)
-    elif data.startswith("admin_delete_"):
-        movie_code = data.split("_")[2]
-        await show_delete_confirmation(query, movie_code)
-    elif data.startswith("admin_confirm_delete_"):
-        movie_code = data.split("_")[3]
-        await delete_movie_confirmed(query, movie_code)
-    elif data.startswith("admin_movie_info_"):
-        movie_code = data.split("_")[3]
-        await show_admin_movie_info(query, movie_code)
-    elif data.startswith("admin_reports_"):
-        page = int(data.split("_")[2])
-        await show_admin_reports(query, page)
-    elif data.startswith("admin_report_info_"):
-        report_id = int(data.split("_")[3])
-        await show_admin_report_info(query, report_id)
-    elif data.startswith("admin_resolve_report_"):
-        report_id = int(data.split("_")[3])
-        await resolve_report_confirmed(query, report_id)
-    elif data == "admin_channels":
-        await show_admin_channels(query)
-    elif data == "admin_settings":
-        await show_admin_settings(query)
-    elif data == "admin_set_archive":
-        await set_archive_channel(query, context)
-    elif data == "admin_set_codes":
-        await set_codes_channel(query, context)
-    elif data == "admin_analytics":
-        await show_admin_analytics(query)
-    elif data == "admin_broadcast":
-        await query.message.reply_text("📨 Xabar yuborish uchun xabarga javob bering: /broadcast")
-    
-    elif data.startswith("report_type_"):
-        parts = data.split("_")
-        if len(parts) >= 4:
-            movie_code = parts[2]
-            report_type = parts[3]
-            
-            # Проверяем существование фильма
-            movie = db.get_movie(movie_code)
-            if not movie:
-                await query.answer("❌ Film topilmadi", show_alert=True)
-                return
-            
-            # Сохраняем тип жалобы в контексте
-            context.user_data['current_report'] = {
-                'movie_code': movie_code,
-                'report_type': report_type
+    def is_duplicate_callback(self, user_id, data, now=None):
+        """True, если та же кнопка уже была нажата в пределах окна"""
+        now = time.monotonic() if now is None else now
+        key = (user_id, data)
+        last = self._recent_callbacks.get(key)
+        if last is not None and now - last < self.duplicate_window:
+            return True
+        if len(self._recent_callbacks) >= self.MAX_TRACKED:
+            self._recent_callbacks = {
+                k: t for k, t in self._recent_callbacks.items() if now - t < self.duplicate_window
             }
-            
-            await query.edit_message_text(
-                f"⚠️ Shikoyat turi: {get_report_type_name(report_type)}\n\n"
-                "Qo'shimcha izoh yozing (ixtiyoriy):\n\n"
-                "Misol: <i>Video sifat yomon, to'liq ko'rinmayapti</i>",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🚫 Izohsiz yuborish", callback_data=f"report_submit_{movie_code}")],
-                    [InlineKeyboardButton("🔙 Orqaga", callback_data=f"back_to_movie_{movie_code}")]
-                ])
-            )
+        self._recent_callbacks[key] = now
+        return False
     
-    elif data.startswith("report_submit_"):
-        parts = data.split("_")
-        if len(parts) >= 3:
-            movie_code = parts[2]
-            report_data = context.user_data.get('current_report', {})
-            
-            # Проверяем существование фильма
-            movie = db.get_movie(movie_code)
-            if not movie:
-                await query.answer("❌ Film topilmadi", show_alert=True)
-                return
-            
-            if report_data.get('movie_code') == movie_code:
-                report_type = report_data.get('report_type')
-                description = report_data.get('description')
-                
-                success = db.add_report(user.id, movie_code, report_type, description)
-                if success:
-                    await query.edit_message_text(
-                        "✅ Shikoyatingiz qabul qilindi!\n\n"
-                        "Administratorlar tez orada ko'rib chiqishadi.\n"
-                        "Hisobingizga e'tiboringiz uchun rahmat!",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("🔙 Orqaga", callback_data=f"back_to_movie_{movie_code}")]
-                        ])
-                    )
-                else:
-                    await query.answer("❌ Shikoyat yuborishda xato", show_alert=True)
-            
-            # Очищаем контекст
-            if 'current_report' in context.user_data:
-                del context.user_data['current_report']
+    def should_warn(self, user_id, now=None, interval=10.0):
+        """Предупреждаем о флуде не чаще раза в interval секунд"""
+        now = time.monotonic() if now is None else now
+        last = self._warned_at.get(user_id)
+        if last is not None and now - last < interval:
+            return False
+        if len(self._warned_at) >= self.MAX_TRACKED:
+            self._warned_at.clear()
+        self._warned_at[user_id] = now
+        return True
     
-    elif data.startswith("back_to_movie_"):
-        parts = data.split("_")
-        if len(parts) >= 4:
-            movie_code = parts[3]
-            await send_movie_details(query, movie_code, user.id)
+    def _prune_buckets(self, now):
+        """Удаляет полностью восстановившиеся корзины - они ничем не отличаются от новых"""
+        refill_time = self.burst / self.rate if self.rate > 0 else float('inf')
+        self._buckets = {
+            user_id: bucket for user_id, bucket in self._buckets.items() if now - bucket[1] < refill_time
+        }
+
+flood_control = FloodControl(FLOOD_RATE, FLOOD_BURST, DUPLICATE_CALLBACK_WINDOW)
+
+QUEUE_FULL_TEXT = "⏳ Oldingi so'rovingiz bajarilmoqda, biroz kuting."
+
+async def answer_dropped_callback(update, text=None):
+    """Отброшенное нажатие все равно нужно подтвердить - иначе на кнопке крутится часик до таймаута"""
+    if not isinstance(update, Update) or not update.callback_query:
+        return
+    try:
+        await update.callback_query.answer(text)
+    except Exception as e:
+        logger.debug(f"Tashlab yuborilgan callbackka javob berilmadi: {e}")
+
+async def admission_gate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отсекает флуд и повторные нажатия до основных обработчиков (группа -1)"""
+    user = update.effective_user
+    if not user or user.id in ADMIN_IDS:
+        return
+    if not (update.message or update.callback_query):
+        return
+    
+    if update.callback_query and flood_control.is_duplicate_callback(user.id, update.callback_query.data):
+        flood_control.dropped['duplicate_callback'] += 1
+        await answer_dropped_callback(update)
+        raise ApplicationHandlerStop
+    
+    if not flood_control.allow(user.id):
+        flood_control.dropped['rate_limited'] += 1
+        if flood_control.should_warn(user.id):
+            try:
+                if update.callback_query:
+                    await update.callback_query.answer("⏳ Juda tez! Biroz kuting.")
+                else:
+                    await update.message.reply_text("⏳ Juda tez! Biroz kuting.")
+            except Exception as e:
+                logger.warning(f"Flood ogohlantirishida xato: {e}")
+        else:
+            await answer_dropped_callback(update)
+        raise ApplicationHandlerStop
+
+# ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА АПДЕЙТОВ
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает апдейты параллельно, но апдейты одного пользователя - строго по очереди"""
+    
+    def __init__(self, max_concurrent_updates, max_pending=MAX_PENDING_UPDATES, max_pending_per_user=MAX_PENDING_PER_USER):
+        # Семафор базового класса пропускает на один апдейт больше лимита очереди, чтобы лишний
+        # сразу отбрасывался; реальная параллельность ограничивается после блокировки пользователя.
+        # max_concurrent_updates при этом отдает настоящую параллельность
+        self._concurrent = max_concurrent_updates
+        super().__init__(max_concurrent_updates)
+        self._semaphore = asyncio.BoundedSemaphore(max_pending + 1)
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self.max_pending = max_pending
+        self.max_pending_per_user = max_pending_per_user
+        self.pending = 0
+        self._user_locks = {}  # ключ -> [asyncio.Lock, число апдейтов в очереди]
+        QUEUE_DEPTH.set_function(lambda: self.pending)
+    
+    @property
+    def max_concurrent_updates(self):
+        """Реальная параллельность (application.concurrent_updates), а не размер семафора очереди"""
+        return self._concurrent
+    
+    @staticmethod
+    def _order_key(update):
+        """Ключ очереди: пользователь, а если его нет - чат"""
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+    
+    async def do_process_update(self, update, coroutine):
+        if 'first_update' not in boot_stats:
+            boot_stats['first_update'] = time.monotonic() - BOOT_STARTED
+            logger.info(f"Birinchi update {boot_stats['first_update']:.2f} s da qabul qilindi")
+        UPDATES_TOTAL.inc()
+        PERF_UPDATES.add()
+        
+        key = self._order_key(update)
+        if key is None:
+            with db.unit_of_work():
+                await coroutine
+            return
+        
+        entry = self._user_locks.get(key)
+        is_admin = key in ADMIN_IDS
+        # Глобальный лимит и лимит очереди пользователя - до запуска обработчиков
+        if not is_admin and self.pending >= self.max_pending:
+            flood_control.dropped['global_queue_full'] += 1
+            coroutine.close()
+            await answer_dropped_callback(update, QUEUE_FULL_TEXT)
+            return
+        if not is_admin and entry is not None and entry[1] >= self.max_pending_per_user:
+            flood_control.dropped['user_queue_full'] += 1
+            coroutine.close()
+            await answer_dropped_callback(update, QUEUE_FULL_TEXT)
+            return
+        
+        if entry is None:
+            entry = [asyncio.Lock(), 0]
+            self._user_locks[key] = entry
+        entry[1] += 1
+        self.pending += 1
+        started = time.perf_counter()
+        try:
+            async with entry[0], self._running:
+                with db.unit_of_work():
+                    await coroutine
+        finally:
+            elapsed = time.perf_counter() - started
+            UPDATE_SECONDS.observe(elapsed)
+            PERF_UPDATE_LATENCY.observe(elapsed)
+            if cpu_profiler.active:
+                cpu_profiler.update_done(started)
+            entry[1] -= 1
+            self.pending -= 1
+            if entry[1] == 0:
+                self._user_locks.pop(key, None)
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
+# МЕТРИКИ ИЗ СЧЕТЧИКОВ В ПАМЯТИ (читаются только при запросе /metrics)
+def cache_requests():
+    requests = Counter(db.cache_stats)
+    requests[('callback_state', 'hit')] += callback_state.stats['memory_hits'] + callback_state.stats['db_hits']
+    requests[('callback_state', 'miss')] += callback_state.stats['misses'] + callback_state.stats['expired']
+    return requests
+
+def cache_hit_ratios():
+    requests = cache_requests()
+    for cache in sorted({cache for cache, _ in requests}):
+        total = requests[(cache, 'hit')] + requests[(cache, 'miss')]
+        if total:
+            yield (cache,), requests[(cache, 'hit')] / total
+
+metrics.collect("bot_cache_requests_total", "Обращения к кэшам", "counter", ("cache", "result"),
+                lambda: cache_requests().items())
+metrics.collect("bot_cache_hit_ratio", "Доля попаданий в кэш", "gauge", ("cache",), cache_hit_ratios)
+metrics.collect("bot_dropped_updates_total", "Апдейты, отброшенные защитой от флуда", "counter", ("reason",),
+                lambda: (((reason,), count) for reason, count in flood_control.dropped.items()))
+metrics.collect("bot_db_write_stats_total", "Единицы работы: апдейты, записи, commit", "counter", ("kind",),
+                lambda: (((kind,), count) for kind, count in db.write_stats.items()))
+def cache_sizes():
+    return [
+        (("known_users",), len(db.known_users)),
+        (("callback_state",), len(callback_state)),
+        (("facets",), len(db.facets)),
+        (("content",), len(db.content)),
+        (("trending",), len(db.trending.boards["all"])),
+    ]
+
+metrics.collect("bot_cached_items", "Размер кэшей в памяти", "gauge", ("cache",), cache_sizes)
+
+metrics_server = None
+
+# ЗАПУСК: ПРОГРЕВ КЭШЕЙ И ФОНОВОЕ ДОЗАПОЛНЕНИЕ
+background_tasks = set()
+
+def start_background(coroutine):
+    """Запускает фоновую задачу, которая не задерживает прием апдейтов"""
+    # Пустой контекст: задача, запущенная из обработчика, не должна унаследовать его единицу работы
+    task = asyncio.get_running_loop().create_task(coroutine, context=contextvars.Context())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def warm_caches():
+    """Параллельно загружает горячие кэши; до окончания бот работает через базу"""
+    started = time.perf_counter()
+    users, channels, movies, _, _ = await asyncio.gather(
+        run_in_thread(db.warm_known_users),
+        run_in_thread(db.warm_channels),
+        run_in_thread(db.warm_facets),
+        run_in_thread(db.warm_content),
+        run_in_thread(db.warm_trending),
+    )
+    boot_stats['caches_warm'] = time.monotonic() - BOOT_STARTED
+    logger.info(
+        f"Keshlar tayyor: {users} foydalanuvchi, {channels} kanal, {movies} film filtrlarda "
+        f"({time.perf_counter() - started:.2f} s)"
+    )
+
+async def run_backfills(batch_size=500):
+    """Дозаполняет старые строки пачками, уступая апдейтам между пачками"""
+    started = time.perf_counter()
+    total = 0
+    while True:
+        done = await run_in_thread(db.backfill_movies, batch_size)
+        total += done
+        if done < batch_size:
+            break
+        await asyncio.sleep(0.05)
+    if total:
+        logger.info(f"Backfill: {total} ta film yangilandi ({time.perf_counter() - started:.2f} s)")
+    
+    # Похожие по содержанию для фильмов, добавленных до их появления
+    started = time.perf_counter()
+    total = 0
+    while True:
+        done = await run_in_thread(db.backfill_content_neighbors, batch_size)
+        total += done
+        if done < batch_size:
+            break
+        await asyncio.sleep(0.05)
+    if total:
+        logger.info(f"O'xshash (kontent): {total} ta film hisoblandi ({time.perf_counter() - started:.2f} s)")
+
+async def run_views_flush(interval):
+    """Раз в interval секунд пачкой записывает накопленные просмотры и счетчики запросов"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            db.flush_views()
+        except Exception as e:
+            logger.error(f"Ko'rishlarni yozishda xato: {e}")
+        try:
+            db.flush_user_activity()
+        except Exception as e:
+            logger.error(f"So'rovlar sonini yozishda xato: {e}")
+
+async def run_callback_state_flush(interval):
+    """Раз в interval секунд сохраняет новые токены кнопок и чистит истекшие"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            callback_state.flush()
+        except Exception as e:
+            logger.error(f"Tugmalar holatini saqlashda xato: {e}")
+
+async def run_recommendations_schedule(interval, first_delay=60):
+    """Периодически пересчитывает похожие фильмы и ленты "Siz uchun" в отдельном процессе (без GIL бота)"""
+    await asyncio.sleep(first_delay)
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                stats = await loop.run_in_executor(pool, build_item_neighbors, db.db_path, RECOMMENDATIONS_TOP_K)
+                logger.info(
+                    f"O'xshash filmlar yangilandi ({stats['engine']}): {stats['with_neighbors']}/{stats['movies']} film, "
+                    f"{stats['users']} foydalanuvchi, {stats['seconds']:.2f} s"
+                )
+                # Ленты строятся из только что посчитанных соседей
+                stats = await loop.run_in_executor(
+                    pool, build_user_feeds, db.db_path, FEED_ACTIVE_DAYS, RECOMMENDATIONS_TOP_K, FEED_TTL
+                )
+                logger.info(
+                    f"'Siz uchun' lentalari: {stats['feeds']}/{stats['active_users']} faol foydalanuvchi, "
+                    f"{stats['seconds']:.2f} s"
+                )
+        except Exception as e:
+            logger.error(f"Tavsiyalarni hisoblashda xato: {e}")
+        await asyncio.sleep(interval)
+
+async def on_startup(application):
+    """Бот готов принимать апдейты; прогрев и дозаполнение идут в фоне"""
+    boot_stats['ready'] = time.monotonic() - BOOT_STARTED
+    logger.info(f"Bot {boot_stats['ready']:.2f} s da ishga tayyor")
+    global metrics_server
+    if METRICS_PORT:
+        try:
+            metrics_server = await serve_metrics(METRICS_HOST, METRICS_PORT)
+            logger.info(f"Metrikalar: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+        except OSError as e:
+            logger.error(f"Metrikalar serverini ishga tushirib bo'lmadi: {e}")
+    start_background(warm_caches())
+    start_background(run_backfills())
+    start_background(run_views_flush(VIEWS_FLUSH_INTERVAL))
+    start_background(run_callback_state_flush(CALLBACK_STATE_FLUSH_INTERVAL))
+    if RECOMMENDATIONS_INTERVAL > 0:
+        start_background(run_recommendations_schedule(RECOMMENDATIONS_INTERVAL))
+
+async def on_shutdown(application):
+    """Сохраняет накопленные в памяти данные перед остановкой"""
+    for task in list(background_tasks):
+        task.cancel()
+    if metrics_server is not None:
+        metrics_server.close()
+    db.flush_user_activity()
+    db.flush_views()
+    callback_state.flush(everything=True)
 
 def main():
-    application = Application.builder().token(BOT_TOKEN).build()
-    
-    # Обработчики команд
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("addchannel", add_channel_command))
-    application.add_handler(CommandHandler("addprivatechannel", add_private_channel_command))
-    application.add_handler(CommandHandler("deletechannel", delete_channel_command))
-    application.add_handler(CommandHandler("deletemovie", delete_movie_command))
-    application.add_handler(CommandHandler("broadcast", broadcast_command))
-    application.add_handler(CommandHandler("random", random_command))
-    application.add_handler(CommandHandler("stats", stats_command))
-    application.add_handler(CommandHandler("top", top_command))
-    application.add_handler(CommandHandler("search", search_command))
+    builder = Application.builder().token(BOT_TOKEN)
+    builder.concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+    if BOT_API_BASE_URL:
+        base_url = BOT_API_BASE_URL.rstrip('/')
+        builder.base_url(f"{base_url}/bot").base_file_url(f"{base_url}/file/bot")
+    # Не ограничивает запросы - только замеряет каждый метод Bot API
+    builder.rate_limiter(MeteredRequests())
+    builder.post_init(on_startup).post_shutdown(on_shutdown)
+    application = builder.build()
+    
+    # Защита от флуда - раньше всех остальных обработчиков
+    application.add_handler(TypeHandler(Update, admission_gate), group=-1)
+    
+    # Обработчики команд (время каждого - в bot_handler_seconds)
+    application.add_handler(CommandHandler("start", observed(start)))
+    application.add_handler(CommandHandler("addchannel", observed(add_channel_command)))
+    application.add_handler(CommandHandler("addprivatechannel", observed(add_private_channel_command)))
+    application.add_handler(CommandHandler("deletechannel", observed(delete_channel_command)))
+    application.add_handler(CommandHandler("deletemovie", observed(delete_movie_command)))
+    application.add_handler(CommandHandler("moviestats", observed(movie_stats_command)))
+    application.add_handler(CommandHandler("sqlprof", observed(sql_profile_command)))
+    application.add_handler(CommandHandler("perf", observed(perf_command)))
+    application.add_handler(CommandHandler("cprof", observed(cpu_profile_command)))
+    application.add_handler(CommandHandler("memprof", observed(memory_profile_command)))
+    application.add_handler(CommandHandler("broadcast", observed(broadcast_command)))
+    application.add_handler(CommandHandler("random", observed(random_command)))
+    application.add_handler(CommandHandler("stats", observed(stats_command)))
+    application.add_handler(CommandHandler("top", observed(top_command)))
+    application.add_handler(CommandHandler("search", observed(search_command)))
     
     # НОВЫЕ ОБРАБОТЧИКИ ДЛЯ ЗАЯВОК
-    application.add_handler(ChatJoinRequestHandler(handle_chat_join_request))
-    application.add_handler(ChatMemberHandler(handle_chat_member_update, ChatMemberHandler.CHAT_MEMBER))
+    application.add_handler(ChatJoinRequestHandler(observed(handle_chat_join_request)))
+    application.add_handler(ChatMemberHandler(observed(handle_chat_member_update), ChatMemberHandler.CHAT_MEMBER))
     
     # Обработчики сообщений
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_admin_message))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, observed(handle_message)))
     application.add_handler(MessageHandler(
         (filters.VIDEO | filters.Document.ALL) & filters.CAPTION,
-        handle_admin_video
+        observed(handle_admin_video)
     ))
     
     # Обработчики callback-кнопок
-    application.add_handler(CallbackQueryHandler(handle_callback, pattern="^.*$"))
+    application.add_handler(CallbackQueryHandler(observed(handle_callback), pattern="^.*$"))
     
     print("🤖 Bot ishga tushdi!")
     print("✅ Barcha funksiyalar ishga tushirildi:")
@@ -2848,7 +4854,19 @@ def main():
     print("   • 📨 Avtomatik so'rovlarni qayd etish")
     print("   • 👥 Foydalanuvchi statusini kuzatish")
     
-    application.run_polling()
+    print(f"   • ⚡ Parallel ishlov berish: {CONCURRENT_UPDATES} ta")
+    
+    if WEBHOOK_URL:
+        print(f"🌐 Webhook rejimi: {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET
+        )
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
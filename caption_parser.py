@@ -0,0 +1,259 @@
+"""Разбор подписи к видео: код, название, название для поиска и теги за один вызов.
+
+Все регулярные выражения компилируются один раз при импорте, поэтому разбор годится
+и для одиночной загрузки, и для массовой переиндексации.
+"""
+import re
+from collections import namedtuple
+
+# Первый хештег подписи - код фильма
+HASHTAG_RE = re.compile(r'#(\w+)')
+# #nomi_Название или #nazar_Название; nomi важнее nazar
+TITLE_TAG_RE = re.compile(r'#(nomi|nazar)[_:]?([^#\n]+)', re.IGNORECASE)
+NON_WORD_RE = re.compile(r'[^\w\s]')
+SPACES_RE = re.compile(r'\s+')
+CONTROL_RE = re.compile(r'[\n\r\t]')
+
+DEFAULT_TITLE = "Nomsiz film"
+DEFAULT_CLEAN_TITLE = "nomsiz film"
+TITLE_LIMIT = 100
+
+ParsedCaption = namedtuple("ParsedCaption", "code title clean_title tags")
+
+# Порядок категорий при нескольких совпадениях
+TAG_TYPES = ("genre", "country", "year", "quality", "language")
+# Короче этого значения ищутся только целым тегом или целым словом тега (UZ, 4K)
+MIN_PARTIAL_LENGTH = 4
+
+# Распространенные написания -> значение из словаря категорий
+TAG_ALIASES = {
+    "genre": {
+        "boevik": "Jangari", "jangovar": "Jangari", "action": "Jangari",
+        "komedia": "Komediya", "comedy": "Komediya", "kulgili": "Komediya",
+        "drama": "Drama", "melodrama": "Drama",
+        "sarguzashtli": "Sarguzasht", "adventure": "Sarguzasht",
+        "horror": "Qorqinchli", "qorqinchi": "Qorqinchli", "uzhas": "Qorqinchli",
+        "tarix": "Tarixiy", "historical": "Tarixiy",
+        "fantastik": "Fantastika", "scifi": "Fantastika",
+        "thriller": "Triller",
+        "detective": "Detektiv",
+        "hujjatli": "Hujjatli_film", "documentary": "Hujjatli_film",
+        "crime": "Kriminal", "kriminalniy": "Kriminal",
+        "fantasy": "Fentezi", "fentazi": "Fentezi",
+        "western": "Vester", "vestern": "Vester",
+        "musical": "Musiqiy", "myuzikl": "Musiqiy",
+    },
+    "country": {
+        "usa": "AQSH", "amerika": "AQSH", "amerikan": "AQSH",
+        "rossiya": "Rossiya", "russia": "Rossiya",
+        "turk": "Turkiya", "turkey": "Turkiya",
+        "china": "Xitoy", "xitoylik": "Xitoy",
+        "hind": "Hindiston", "india": "Hindiston",
+        "angliya": "Buyuk_britaniya", "britaniya": "Buyuk_britaniya",
+        "koreya": "Janubiy_koreya", "korea": "Janubiy_koreya",
+        "qozoq": "Qozogiston", "qozogiston": "Qozogiston",
+        "fransuz": "Fransiya", "france": "Fransiya",
+        "japan": "Yaponiya", "yapon": "Yaponiya",
+    },
+    "quality": {
+        "fullhd": "1080P", "fhd": "1080P", "hd": "720P", "uhd": "4K", "2160p": "4K",
+    },
+    "language": {
+        "uzbek": "UZ", "ozbek": "UZ", "ozbekcha": "UZ", "uzbekcha": "UZ",
+        "ruscha": "RU", "russian": "RU", "inglizcha": "EN", "english": "EN",
+        "turkcha": "TR", "koreyscha": "KR", "xitoycha": "CN",
+    },
+}
+
+
+def normalize_tag(tag):
+    """Ключ сравнения тегов: нижний регистр, без подчеркиваний и апострофов"""
+    return tag.lower().replace('_', '').replace("'", '')
+
+
+class KeywordAutomaton:
+    """Автомат Ахо-Корасик: все вхождения словаря в строку за один проход"""
+
+    def __init__(self, keywords):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        for keyword in keywords:
+            self._add(keyword)
+        self._build_links()
+
+    def _add(self, keyword):
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        self._output[state].append(keyword)
+
+    def _build_links(self):
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def find(self, text):
+        """Возвращает [(позиция начала, ключ)] в порядке окончания совпадений"""
+        matches = []
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for keyword in self._output[state]:
+                matches.append((index - len(keyword) + 1, keyword))
+        return matches
+
+
+class HashtagClassifier:
+    """Классификация хештега по словарю категорий без перебора словаря.
+
+    Порядок проверки:
+    1. весь тег целиком: точное значение или псевдоним;
+    2. слова тега через "_" (#uz_tilida -> UZ);
+    3. значение внутри тега (#dramalar -> Drama), значения короче MIN_PARTIAL_LENGTH не ищутся;
+    4. тег как начало значения (#fantast -> Fantastika), сам тег не короче MIN_PARTIAL_LENGTH.
+    При нескольких кандидатах на одном шаге побеждает категория раньше в TAG_TYPES,
+    затем более длинное совпадение, затем более раннее. Обратная проверка "тег внутри
+    значения" не делается: #film не становится Hujjatli_film.
+    """
+
+    def __init__(self, vocabulary, aliases=TAG_ALIASES):
+        self._years = frozenset()
+        self._exact = {}  # ключ -> (тип, значение)
+        self._prefixes = {}  # начало ключа -> (тип, значение)
+        rank = {tag_type: n for n, tag_type in enumerate(TAG_TYPES)}
+
+        for tag_type, values in vocabulary:
+            if tag_type == "year":
+                self._years = frozenset(values)
+                continue
+            for value in values:
+                self._put(self._exact, normalize_tag(value), (tag_type, value), rank)
+        for tag_type, table in aliases.items():
+            for alias, value in table.items():
+                self._put(self._exact, normalize_tag(alias), (tag_type, value), rank)
+
+        for key, found in list(self._exact.items()):
+            for length in range(MIN_PARTIAL_LENGTH, len(key)):
+                self._put(self._prefixes, key[:length], found, rank)
+
+        self._rank = rank
+        self._automaton = KeywordAutomaton(key for key in self._exact if len(key) >= MIN_PARTIAL_LENGTH)
+
+    @staticmethod
+    def _put(table, key, found, rank):
+        # Первой регистрируется категория с меньшим рангом - она и остается
+        current = table.get(key)
+        if current is None or rank[found[0]] < rank[current[0]]:
+            table[key] = found
+
+    def classify(self, tag):
+        """Возвращает (тип, значение) или None"""
+        if tag in self._years:
+            return "year", tag
+
+        key = normalize_tag(tag)
+        found = self._exact.get(key)
+        if found:
+            return found
+
+        words = [normalize_tag(word) for word in tag.split('_') if word]
+        if len(words) > 1:
+            candidates = [self._exact[word] for word in words if word in self._exact]
+            if candidates:
+                return min(candidates, key=lambda item: self._rank[item[0]])
+
+        matches = self._automaton.find(key)
+        if matches:
+            start, keyword = min(matches, key=lambda m: (self._rank[self._exact[m[1]][0]], -len(m[1]), m[0]))
+            return self._exact[keyword]
+
+        return self._prefixes.get(key)
+
+
+def normalize_title(text):
+    """Название для поиска: без знаков и эмодзи, одиночные пробелы, нижний регистр"""
+    return SPACES_RE.sub(' ', NON_WORD_RE.sub(' ', text)).strip().lower()[:TITLE_LIMIT]
+
+
+class CaptionParser:
+    """Разбирает подписи с заданным словарем категорий"""
+
+    def __init__(self, genres, countries, years, qualities, languages):
+        self.classifier = HashtagClassifier((
+            ("genre", genres),
+            ("country", countries),
+            ("year", years),
+            ("quality", qualities),
+            ("language", languages),
+        ))
+
+    def parse(self, caption, code=None):
+        """Возвращает ParsedCaption; code - известный код фильма для названия по умолчанию"""
+        if not caption:
+            return ParsedCaption(code, DEFAULT_TITLE, DEFAULT_CLEAN_TITLE, [])
+
+        hashtags = HASHTAG_RE.findall(caption)
+        if code is None and hashtags:
+            code = hashtags[0]
+
+        title = self._title_from_tags(caption)
+        if title is None:
+            title = self._title_from_lines(caption)
+        if title is not None:
+            clean_title = normalize_title(title)
+            title = CONTROL_RE.sub(' ', title)[:TITLE_LIMIT]
+        else:
+            title = f"Video #{code}" if code else DEFAULT_TITLE
+            clean_title = DEFAULT_CLEAN_TITLE
+
+        return ParsedCaption(code, title, clean_title, self.classify(hashtags))
+
+    @staticmethod
+    def _title_from_tags(caption):
+        nazar = None
+        for match in TITLE_TAG_RE.finditer(caption):
+            if match.group(1).lower() == "nomi":
+                return match.group(2).strip()
+            if nazar is None:
+                nazar = match.group(2).strip()
+        return nazar
+
+    @staticmethod
+    def _title_from_lines(caption):
+        """Первая строка длиннее 3 символов без хештегов"""
+        for line in caption.split('\n'):
+            clean_line = HASHTAG_RE.sub('', line).strip()
+            if len(clean_line) > 3:
+                return clean_line
+        return None
+
+    def classify(self, hashtags):
+        """Превращает хештеги в список (тип, значение) без повторов"""
+        tags = []
+        seen = set()
+        for tag in hashtags:
+            tag_lower = tag.lower()
+            if tag_lower.startswith('nomi') or tag_lower.startswith('nazar'):
+                continue
+
+            found = self.classifier.classify(tag)
+            if found and found not in seen:
+                seen.add(found)
+                tags.append(found)
+        return tags
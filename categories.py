@@ -0,0 +1,18 @@
+"""Словарь категорий: кнопки поиска по категориям и классификация хештегов"""
+
+GENRES = [
+    "Jangari", "Drama", "Komediya","Sarguzasht", 
+    "Qorqinchli", "Tarixiy", "Klassika", "Fantastika", "Hayotiy",
+    "Triller", "Detektiv", "Hujjatli_film", "Anime", "Kriminal",
+    "Fentezi", "Afsona", "Vester", "Musiqiy"
+]
+
+COUNTRIES = [
+    "Rossiya", "AQSH", "Turkiya", "Xitoy", "Hindiston", 
+    "Avstraliya", "Buyuk_britaniya", "Janubiy_koreya", "Ukraina",
+    "Qozogiston", "Fransiya", "Eron", "Yaponiya"
+]
+
+YEARS = [str(year) for year in range(2025, 2009, -1)]
+QUALITIES = ["1080P", "720P", "480P", "4K"]
+LANGUAGES = ["UZ", "RU", "EN", "TR", "KR", "CN"]
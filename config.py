@@ -18,3 +18,54 @@ REQUIRED_CHANNELS = {
 
 # Канал с кодами видео
 CODES_CHANNEL = "https://t.me/LifeFilm_uz"
+
+
+# Режим webhook (если WEBHOOK_URL не задан - используется polling)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", os.getenv("WEBHOOK_PORT", "8443")))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+# Сколько апдейтов обрабатывать параллельно
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "16"))
+
+# Адрес Bot API (например, локальный тестовый сервер tools/fake_bot_api.py)
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL")
+
+# Защита от флуда: скорость (сообщений в секунду) и запас токенов на пользователя
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "1.0"))
+FLOOD_BURST = int(os.getenv("FLOOD_BURST", "5"))
+# Повторное нажатие той же кнопки в течение окна (секунд) игнорируется
+DUPLICATE_CALLBACK_WINDOW = float(os.getenv("DUPLICATE_CALLBACK_WINDOW", "1.5"))
+# Лимиты очереди апдейтов: всего и на одного пользователя
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", "200"))
+# На пользователя - с запасом на несколько нажатий, пока идет медленная отправка видео
+MAX_PENDING_PER_USER = int(os.getenv("MAX_PENDING_PER_USER", "10"))
+
+# Не чаще одного раза в N секунд обновлять last_activity пользователя (счетчик запросов копится в памяти)
+ACTIVITY_COALESCE_SECONDS = int(os.getenv("ACTIVITY_COALESCE_SECONDS", "300"))
+
+# Хранилище состояния кнопок: сколько токенов держать в памяти и сколько секунд они действительны
+CALLBACK_STATE_CAPACITY = int(os.getenv("CALLBACK_STATE_CAPACITY", "20000"))
+CALLBACK_STATE_TTL = int(os.getenv("CALLBACK_STATE_TTL", str(30 * 24 * 3600)))
+# Как часто новые токены кнопок сохраняются в базу, чтобы падение бота не ломало кнопки
+CALLBACK_STATE_FLUSH_INTERVAL = int(os.getenv("CALLBACK_STATE_FLUSH_INTERVAL", "300"))
+
+# Пересчет "похожих фильмов": раз в N секунд (0 - только вручную через tools/build_recommendations.py)
+RECOMMENDATIONS_INTERVAL = int(os.getenv("RECOMMENDATIONS_INTERVAL", str(6 * 3600)))
+RECOMMENDATIONS_TOP_K = int(os.getenv("RECOMMENDATIONS_TOP_K", "20"))
+# Лента "Siz uchun" пересчитывается вместе с ними: только для активных за N дней, живет FEED_TTL секунд
+FEED_ACTIVE_DAYS = int(os.getenv("FEED_ACTIVE_DAYS", "7"))
+FEED_TTL = int(os.getenv("FEED_TTL", str(24 * 3600)))
+
+# Просмотры копятся в памяти и записываются пачкой раз в N секунд
+VIEWS_FLUSH_INTERVAL = int(os.getenv("VIEWS_FLUSH_INTERVAL", "30"))
+
+# Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics (порт 0 - выключено)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
+# Профилировщик SQL с самого запуска (иначе - командой /sqlprof on) и порог медленного запроса в мс
+SQL_PROFILE = os.getenv("SQL_PROFILE", "0") == "1"
+SQL_SLOW_MS = float(os.getenv("SQL_SLOW_MS", "100"))
@@ -0,0 +1,121 @@
+"""Похожие фильмы по содержанию: теги и слова названия.
+
+Фильм - разреженный вектор признаков: one-hot по тегам (genre:Drama, country:AQSH, ...)
+и слова clean_title. Вес признака = вес его типа × idf, сходство - косинус.
+Скалярные произведения считаются через инвертированный индекс (признак -> фильмы),
+то есть как умножение разреженной матрицы на вектор, только по фильмам с общими
+признаками. Новому фильму соседи считаются сразу при add_movie - ему не нужны
+просмотры и избранное, как рекомендациям по действиям пользователей.
+"""
+import heapq
+import math
+import re
+
+# Насколько тип признака важен для сходства
+FEATURE_WEIGHTS = {
+    "genre": 1.0,
+    "country": 0.6,
+    "title": 0.8,
+    "year": 0.4,
+    "language": 0.2,
+    "quality": 0.1,
+}
+# Частые признаки (жанр Drama у трети каталога) берутся только по последним фильмам:
+# это ограничивает стоимость одного пересчета
+MAX_POSTINGS = 5000
+MIN_TOKEN_LENGTH = 3
+TOKEN_RE = re.compile(r'\w+')
+
+
+def movie_features(clean_title, tags):
+    """Множество признаков фильма: (тип, значение)"""
+    features = {(tag_type, tag_value.lower()) for tag_type, tag_value in tags}
+    for token in TOKEN_RE.findall(clean_title or ""):
+        if len(token) >= MIN_TOKEN_LENGTH and not token.isdigit():
+            features.add(("title", token))
+    return features
+
+
+class ContentIndex:
+    def __init__(self):
+        self._features = {}  # code -> множество признаков
+        self._postings = {}  # признак -> [code] в порядке добавления
+        # Нормы векторов считаются один раз: idf от добавления одного фильма почти не меняется,
+        # а полный пересчет идет при следующем load
+        self._norms = {}
+        self.loaded = False
+
+    def load(self, movies, tags):
+        """movies - [(code, clean_title)] от старых к новым, tags - [(code, tag_type, tag_value)]"""
+        self.__init__()
+        movie_tags = {}
+        for code, tag_type, tag_value in tags:
+            movie_tags.setdefault(code, []).append((tag_type, tag_value))
+        for code, clean_title in movies:
+            self.add(code, clean_title, movie_tags.get(code, ()))
+        self.loaded = True
+        return len(self._features)
+
+    def add(self, code, clean_title, tags):
+        self.remove(code)
+        features = movie_features(clean_title, tags)
+        self._features[code] = features
+        for feature in features:
+            self._postings.setdefault(feature, []).append(code)
+
+    def remove(self, code):
+        features = self._features.pop(code, None)
+        self._norms.pop(code, None)
+        if features is None:
+            return False
+        for feature in features:
+            postings = self._postings.get(feature)
+            if postings is not None:
+                try:
+                    postings.remove(code)
+                except ValueError:
+                    pass
+        return True
+
+    def __len__(self):
+        return len(self._features)
+
+    def _weight(self, feature):
+        total = len(self._features) or 1
+        document_frequency = len(self._postings.get(feature, ())) or 1
+        return FEATURE_WEIGHTS.get(feature[0], 0.5) * (1.0 + math.log(total / document_frequency))
+
+    def _norm(self, code, weights):
+        norm = self._norms.get(code)
+        if norm is None:
+            total = 0.0
+            for feature in self._features[code]:
+                weight = weights.get(feature)
+                if weight is None:
+                    weight = weights[feature] = self._weight(feature)
+                total += weight * weight
+            norm = self._norms[code] = math.sqrt(total) or 1.0
+        return norm
+
+    def neighbors(self, code, top_k=10):
+        """[(code, сходство)] лучших соседей фильма"""
+        features = self._features.get(code)
+        if not features:
+            return []
+
+        weights = {}
+        scores = {}
+        for feature in features:
+            weight = weights.setdefault(feature, self._weight(feature))
+            for other in self._postings.get(feature, ())[-MAX_POSTINGS:]:
+                if other != code:
+                    scores[other] = scores.get(other, 0.0) + weight * weight
+
+        if not scores:
+            return []
+        norm = self._norm(code, weights)
+        result = [
+            (other, dot / (norm * self._norm(other, weights)))
+            for other, dot in scores.items() if other in self._features
+        ]
+        return heapq.nsmallest(top_k, result, key=lambda item: (-item[1], item[0]))
@@ -0,0 +1,134 @@
+"""Индекс фильтров по категориям в памяти.
+
+Каждому фильму присваивается плотный порядковый номер, каждому значению категории
+(genre=Drama, country=Turkiya, ...) - битовая маска по этим номерам (int Python).
+Пересечение и объединение фильтров - это & и | над масками, число фильмов - bit_count().
+Номера растут в порядке добавления, поэтому "сначала новые" - это обход битов сверху вниз.
+"""
+
+# Фильтр года "2020 и новее" хранится как значение ">=2020"
+RANGE_PREFIX = ">="
+
+
+class FacetIndex:
+    def __init__(self):
+        self._ordinals = {}  # code -> номер
+        self._codes = []  # номер -> code (None для удаленных)
+        self._views = []  # номер -> просмотры
+        self._alive = 0  # маска существующих фильмов
+        self._bitmaps = {}  # (tag_type, значение в нижнем регистре) -> маска
+        self._labels = {}  # (tag_type, значение в нижнем регистре) -> значение как в словаре
+        self._movie_tags = {}  # номер -> [(tag_type, ключ)]
+        self.loaded = False
+
+    def load(self, movies, tags):
+        """Строит индекс с нуля: movies - [(code, views)] от старых к новым, tags - [(code, tag_type, tag_value)]"""
+        self.__init__()
+        for code, views in movies:
+            self._assign(code, views)
+        for code, tag_type, tag_value in tags:
+            ordinal = self._ordinals.get(code)
+            if ordinal is not None:
+                self._tag(ordinal, tag_type, tag_value)
+        self.loaded = True
+        return len(self._ordinals)
+
+    def _assign(self, code, views=0):
+        ordinal = len(self._codes)
+        self._ordinals[code] = ordinal
+        self._codes.append(code)
+        self._views.append(views)
+        self._alive |= 1 << ordinal
+        return ordinal
+
+    def _tag(self, ordinal, tag_type, tag_value):
+        key = (tag_type, tag_value.lower())
+        self._bitmaps[key] = self._bitmaps.get(key, 0) | (1 << ordinal)
+        self._labels.setdefault(key, tag_value)
+        self._movie_tags.setdefault(ordinal, []).append(key)
+
+    def add(self, code, tags, views=0):
+        """Новый или перезаписанный фильм становится самым новым"""
+        self.remove(code)
+        ordinal = self._assign(code, views)
+        for tag_type, tag_value in tags:
+            self._tag(ordinal, tag_type, tag_value)
+
+    def remove(self, code):
+        ordinal = self._ordinals.pop(code, None)
+        if ordinal is None:
+            return False
+        bit = 1 << ordinal
+        self._alive &= ~bit
+        for key in self._movie_tags.pop(ordinal, ()):
+            self._bitmaps[key] &= ~bit
+        self._codes[ordinal] = None
+        return True
+
+    def __len__(self):
+        return len(self._ordinals)
+
+    def record_view(self, code):
+        ordinal = self._ordinals.get(code)
+        if ordinal is not None:
+            self._views[ordinal] += 1
+
+    def bitmap(self, tag_type, value):
+        """Маска одного значения; для ">=2020" - объединение всех годов от 2020"""
+        if value.startswith(RANGE_PREFIX):
+            low = value[len(RANGE_PREFIX):]
+            result = 0
+            for (key_type, key), bitmap in self._bitmaps.items():
+                if key_type == tag_type and key >= low:
+                    result |= bitmap
+            return result
+        return self._bitmaps.get((tag_type, value.lower()), 0)
+
+    def query(self, filters):
+        """filters - [(tag_type, value)]: значения одного типа через ИЛИ, разные типы через И"""
+        by_type = {}
+        for tag_type, value in filters:
+            by_type[tag_type] = by_type.get(tag_type, 0) | self.bitmap(tag_type, value)
+        result = self._alive
+        for bitmap in by_type.values():
+            result &= bitmap
+        return result
+
+    def values(self, tag_type, base=None):
+        """[(значение, число фильмов в base)] для кнопок уточнения, без пустых"""
+        if base is None:
+            base = self._alive
+        result = []
+        for (key_type, key), bitmap in self._bitmaps.items():
+            if key_type == tag_type:
+                count = (bitmap & base).bit_count()
+                if count:
+                    result.append((self._labels[(key_type, key)], count))
+        return result
+
+    def count(self, bitmap):
+        return bitmap.bit_count()
+
+    def page(self, bitmap, offset, limit, order="recent"):
+        """Коды фильмов страницы: order="recent" - сначала новые, "views" - по просмотрам"""
+        if order == "views":
+            ordinals = self._ordinals_desc(bitmap)
+            ordinals.sort(key=lambda ordinal: self._views[ordinal], reverse=True)
+            return [self._codes[ordinal] for ordinal in ordinals[offset:offset + limit]]
+
+        result = []
+        top = bitmap.bit_length() - 1
+        bits = bin(bitmap)[2:]
+        position = bits.find('1')
+        skipped = 0
+        while position != -1 and len(result) < limit:
+            if skipped < offset:
+                skipped += 1
+            else:
+                result.append(self._codes[top - position])
+            position = bits.find('1', position + 1)
+        return result
+
+    def _ordinals_desc(self, bitmap):
+        top = bitmap.bit_length() - 1
+        return [top - position for position, bit in enumerate(bin(bitmap)[2:]) if bit == '1']
@@ -0,0 +1,279 @@
+"""Метрики процесса: счетчики, gauge и гистограммы задержек в текстовом формате Prometheus.
+
+Горячий путь - одна операция над заранее созданным объектом. Метрика с метками создается
+один раз через labels() и кэшируется вызывающим кодом; бакеты гистограммы - список,
+выделенный при создании, observe находит бакет bisect'ом и увеличивает один элемент.
+Уже существующие счетчики (Counter в памяти) отдаются через collect() - функция
+вызывается только при чтении /metrics.
+"""
+import asyncio
+import functools
+import inspect
+import time
+from bisect import bisect_left
+
+# Границы бакетов задержки в секундах: от 1 мс до 10 с
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class CounterValue:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class GaugeValue:
+    __slots__ = ("value", "function")
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, function):
+        """Значение считается при чтении метрик"""
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class HistogramValue:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # последний - +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля по бакетам (верхняя граница бакета), None если наблюдений нет"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for n, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.bounds[n] if n < len(self.bounds) else float("inf")
+        return float("inf")
+
+
+class LatencyWindow:
+    """Последние size длительностей в кольцевом буфере - для скользящих перцентилей"""
+    __slots__ = ("_samples", "_next", "_filled")
+
+    def __init__(self, size=2048):
+        self._samples = [0.0] * size
+        self._next = 0
+        self._filled = 0
+
+    def __len__(self):
+        return self._filled
+
+    def observe(self, value):
+        self._samples[self._next] = value
+        self._next = (self._next + 1) % len(self._samples)
+        if self._filled < len(self._samples):
+            self._filled += 1
+
+    def percentiles(self, *quantiles):
+        """Значения квантилей по текущему окну; None, если наблюдений нет"""
+        if not self._filled:
+            return [None] * len(quantiles)
+        ordered = sorted(self._samples[:self._filled])
+        return [ordered[min(self._filled - 1, int(q * self._filled))] for q in quantiles]
+
+
+class RateWindow:
+    """Число событий по секундам за последние seconds секунд (кольцо счетчиков)"""
+    __slots__ = ("_counts", "_seconds")
+
+    def __init__(self, seconds=60):
+        self._counts = [0] * seconds
+        self._seconds = [0] * seconds  # секунда, к которой относится счетчик
+
+    def add(self, amount=1):
+        second = int(time.monotonic())
+        slot = second % len(self._counts)
+        if self._seconds[slot] != second:
+            self._seconds[slot] = second
+            self._counts[slot] = 0
+        self._counts[slot] += amount
+
+    def total(self):
+        now = int(time.monotonic())
+        size = len(self._counts)
+        return sum(count for count, second in zip(self._counts, self._seconds) if now - second < size)
+
+    def rate(self):
+        """Событий в секунду в среднем по окну"""
+        return self.total() / len(self._counts)
+
+
+class Family:
+    """Метрика с именем и набором меток; дочерние значения создаются по одному на набор меток"""
+
+    def __init__(self, name, documentation, metric_type, labelnames, factory):
+        self.name = name
+        self.documentation = documentation
+        self.type = metric_type
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self._factory = factory
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name}: ожидаются метки {self.labelnames}")
+            child = self.children[values] = self._factory()
+        return child
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        f'{name}="' + str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') + '"'
+        for name, value in pairs
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self):
+        self._families = {}
+        self._collectors = []
+
+    def _family(self, name, documentation, metric_type, labelnames, factory):
+        if name in self._families:
+            raise ValueError(f"Метрика {name} уже зарегистрирована")
+        family = self._families[name] = Family(name, documentation, metric_type, labelnames, factory)
+        return family if labelnames else family.labels()
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._family(name, documentation, "counter", labelnames, CounterValue)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._family(name, documentation, "gauge", labelnames, GaugeValue)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        bounds = tuple(sorted(buckets))
+        return self._family(name, documentation, "histogram", labelnames, lambda: HistogramValue(bounds))
+
+    def get(self, name):
+        return self._families.get(name)
+
+    def collect(self, name, documentation, metric_type, labelnames, function):
+        """Метрика из существующих данных: function() -> [(значения меток, число)]"""
+        self._collectors.append((name, documentation, metric_type, tuple(labelnames), function))
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus 0.0.4"""
+        lines = []
+        for family in self._families.values():
+            lines.append(f"# HELP {family.name} {family.documentation}")
+            lines.append(f"# TYPE {family.name} {family.type}")
+            for values, child in list(family.children.items()):
+                if family.type == "histogram":
+                    cumulative = 0
+                    for n, count in enumerate(child.counts):
+                        cumulative += count
+                        bound = child.bounds[n] if n < len(child.bounds) else float("inf")
+                        labels = _format_labels(family.labelnames, values, [("le", _format_value(bound))])
+                        lines.append(f"{family.name}_bucket{labels} {cumulative}")
+                    labels = _format_labels(family.labelnames, values)
+                    lines.append(f"{family.name}_sum{labels} {_format_value(child.sum)}")
+                    lines.append(f"{family.name}_count{labels} {child.count}")
+                else:
+                    value = child.get() if family.type == "gauge" else child.value
+                    lines.append(f"{family.name}{_format_labels(family.labelnames, values)} {_format_value(value)}")
+        for name, documentation, metric_type, labelnames, function in self._collectors:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for values, value in function():
+                lines.append(f"{name}{_format_labels(labelnames, values)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def instrument_methods(cls, histogram, skip=()):
+    """Оборачивает публичные методы класса замером времени в histogram.labels(имя метода).
+
+    Генераторы и contextmanager (у них есть __wrapped__) не трогаются: их время
+    не равно времени вызова.
+    """
+    for name, func in list(vars(cls).items()):
+        if name.startswith("_") or name in skip or not inspect.isfunction(func):
+            continue
+        if hasattr(func, "__wrapped__") or inspect.isgeneratorfunction(func) or inspect.iscoroutinefunction(func):
+            continue
+        setattr(cls, name, _timed(func, histogram.labels(name)))
+
+
+def _timed(func, child):
+    perf_counter = time.perf_counter
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            child.observe(perf_counter() - started)
+    return wrapper
+
+
+async def serve(host, port, registry=registry):
+    """HTTP-сервер только для GET /metrics; возвращает asyncio.Server"""
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+            method, path = request.split(b" ", 2)[:2]
+            if method == b"GET" and path.split(b"?")[0] == b"/metrics":
+                status, content_type, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", registry.render()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain; charset=utf-8", "not found\n"
+            payload = body.encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,234 @@
+"""Похожие фильмы по совместным действиям пользователей (item-item) и лента "Siz uchun".
+
+Матрица пользователь × фильм строится из избранного, оценок и просмотров, сходство
+фильмов - косинус между их столбцами. Для каждого фильма top-K соседей хранятся одной
+строкой в movie_neighbors, поэтому выдача - одно чтение по первичному ключу.
+Лента пользователя собирается из соседей его фильмов и популярных фильмов любимых
+жанров и так же хранится одной строкой в user_feeds со сроком годности.
+
+С NumPy/SciPy расчет векторный (X^T X на разреженной матрице); без них работает
+запасной вариант на чистом Python с тем же результатом, но медленнее.
+"""
+import heapq
+import math
+import sqlite3
+import time
+from array import array
+from collections import defaultdict
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = None
+    sparse = None
+
+FAVORITE_WEIGHT = 3.0
+WATCH_WEIGHT = 1.0
+# Низкие оценки не говорят о сходстве с остальными фильмами пользователя
+RATING_WEIGHTS = {5: 3.0, 4: 2.0, 3: 1.0}
+# Пользователи с большим числом фильмов (боты, обход каталога) пропускаются:
+# они дают квадратичное число пар и почти не несут сигнала
+MAX_ITEMS_PER_USER = 200
+DEFAULT_TOP_K = 20
+# Лента: сколько фильмов пользователя брать за основу, сколько популярных держать на жанр
+# и насколько жанровые кандидаты слабее соседей
+FEED_MAX_SEEDS = 50
+FEED_GENRE_POOL = 200
+FEED_GENRE_WEIGHT = 0.5
+
+
+def load_interactions(conn):
+    """(user_id, code, вес) из избранного, оценок и просмотров; повторы складываются позже"""
+    for user_id, code in conn.execute('SELECT user_id, movie_code FROM favorites'):
+        yield user_id, code, FAVORITE_WEIGHT
+    for user_id, code, rating in conn.execute('SELECT user_id, movie_code, rating FROM ratings WHERE rating >= 3'):
+        yield user_id, code, RATING_WEIGHTS[rating]
+    for user_id, code in conn.execute("SELECT user_id, details FROM user_activity_logs WHERE action = 'watch_movie'"):
+        yield user_id, code, WATCH_WEIGHT
+
+
+def _top_k(candidates, top_k):
+    """Лучшие соседи с детерминированным порядком при равных оценках"""
+    return heapq.nsmallest(top_k, candidates, key=lambda item: (-item[1], item[0]))
+
+
+def neighbors_numpy(users, items, weights, n_users, n_items, top_k):
+    matrix = sparse.coo_matrix(
+        (np.asarray(weights, dtype=np.float32), (np.asarray(users, dtype=np.int64), np.asarray(items, dtype=np.int64))),
+        shape=(n_users, n_items)
+    ).tocsr()
+    matrix.sum_duplicates()
+    matrix.data = np.log1p(matrix.data)
+    matrix = matrix[np.diff(matrix.indptr) <= MAX_ITEMS_PER_USER]
+
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0)).ravel())
+    norms[norms == 0] = 1.0
+    matrix = matrix @ sparse.diags(1.0 / norms)
+    similarity = (matrix.T @ matrix).tocsr()
+    similarity.setdiag(0)
+    similarity.eliminate_zeros()
+
+    result = {}
+    for item in range(n_items):
+        start, end = similarity.indptr[item], similarity.indptr[item + 1]
+        if start == end:
+            continue
+        scores = similarity.data[start:end]
+        columns = similarity.indices[start:end]
+        if len(scores) > top_k * 2:
+            best = np.argpartition(-scores, top_k * 2)[:top_k * 2]
+            scores, columns = scores[best], columns[best]
+        result[item] = _top_k(zip(columns.tolist(), scores.tolist()), top_k)
+    return result
+
+
+def neighbors_python(users, items, weights, n_users, n_items, top_k):
+    per_user = defaultdict(dict)
+    for user, item, weight in zip(users, items, weights):
+        row = per_user[user]
+        row[item] = row.get(item, 0.0) + weight
+
+    norms = [0.0] * n_items
+    baskets = []
+    for row in per_user.values():
+        if len(row) > MAX_ITEMS_PER_USER:
+            continue
+        basket = [(item, math.log1p(weight)) for item, weight in row.items()]
+        for item, weight in basket:
+            norms[item] += weight * weight
+        baskets.append(basket)
+    norms = [math.sqrt(value) or 1.0 for value in norms]
+
+    co_occurrence = defaultdict(dict)
+    for basket in baskets:
+        for item, weight in basket:
+            row = co_occurrence[item]
+            for other, other_weight in basket:
+                if other != item:
+                    row[other] = row.get(other, 0.0) + weight * other_weight
+
+    return {
+        item: _top_k(((other, value / (norms[item] * norms[other])) for other, value in row.items()), top_k)
+        for item, row in co_occurrence.items()
+    }
+
+
+def build_item_neighbors(db_path, top_k=DEFAULT_TOP_K):
+    """Пересчитывает movie_neighbors.neighbors для всех фильмов; возвращает статистику"""
+    started = time.perf_counter()
+    conn = sqlite3.connect(db_path, timeout=30)
+    code_index = {code: n for n, (code,) in enumerate(conn.execute('SELECT code FROM movies'))}
+    codes = list(code_index)
+    user_index = {}
+    # Компактные массивы вместо списков: при 50M действий это сотни МБ, а не гигабайты объектов
+    users, items, weights = array('l'), array('l'), array('f')
+    for user_id, code, weight in load_interactions(conn):
+        item = code_index.get(code)
+        if item is None:
+            continue
+        users.append(user_index.setdefault(user_id, len(user_index)))
+        items.append(item)
+        weights.append(weight)
+
+    engine = neighbors_numpy if np is not None and sparse is not None else neighbors_python
+    neighbors = engine(users, items, weights, len(user_index), len(codes), top_k) if users else {}
+
+    now = int(time.time())
+    rows = [
+        (codes[item], ",".join(codes[other] for other, _ in found), now)
+        for item, found in neighbors.items()
+    ]
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute('UPDATE movie_neighbors SET neighbors = NULL')
+    conn.executemany('''
+        INSERT INTO movie_neighbors (code, neighbors, computed_at) VALUES (?, ?, ?)
+        ON CONFLICT(code) DO UPDATE SET neighbors = excluded.neighbors, computed_at = excluded.computed_at
+    ''', rows)
+    conn.commit()
+    conn.close()
+
+    return {
+        "engine": "numpy" if engine is neighbors_numpy else "python",
+        "movies": len(codes),
+        "users": len(user_index),
+        "interactions": len(users),
+        "with_neighbors": len(rows),
+        "seconds": time.perf_counter() - started,
+    }
+
+
+def _user_seeds(conn, user_id):
+    """{code: вес} лучших фильмов пользователя и множество всего, что он уже видел"""
+    seeds = defaultdict(float)
+    for (code,) in conn.execute('SELECT movie_code FROM favorites WHERE user_id = ?', (user_id,)):
+        seeds[code] += FAVORITE_WEIGHT
+    for code, rating in conn.execute('SELECT movie_code, rating FROM ratings WHERE user_id = ?', (user_id,)):
+        seeds[code] += RATING_WEIGHTS.get(rating, 0.0)
+    for (code,) in conn.execute(
+        "SELECT details FROM user_activity_logs WHERE user_id = ? AND action = 'watch_movie'", (user_id,)
+    ):
+        seeds[code] += WATCH_WEIGHT
+    best = heapq.nlargest(FEED_MAX_SEEDS, ((weight, code) for code, weight in seeds.items() if weight > 0))
+    return {code: weight for weight, code in best}, set(seeds)
+
+
+def build_user_feeds(db_path, active_days=7, size=DEFAULT_TOP_K, ttl=24 * 3600):
+    """Пересчитывает user_feeds для пользователей, активных за active_days дней; возвращает статистику"""
+    started = time.perf_counter()
+    conn = sqlite3.connect(db_path, timeout=30)
+    neighbors = {}
+    for code, collaborative, content in conn.execute('SELECT code, neighbors, content_neighbors FROM movie_neighbors'):
+        found = [other for other in f"{collaborative or ''},{content or ''}".split(",") if other]
+        neighbors[code] = list(dict.fromkeys(found))
+    genres = defaultdict(list)
+    for code, genre in conn.execute("SELECT code, tag_value FROM movie_tags WHERE tag_type = 'genre'"):
+        genres[code].append(genre.lower())
+    popular = defaultdict(list)
+    for code, genre in conn.execute('''
+        SELECT m.code, LOWER(mt.tag_value) FROM movies m
+        JOIN movie_tags mt ON mt.code = m.code AND mt.tag_type = 'genre'
+        WHERE m.views > 0
+        ORDER BY m.views DESC
+    '''):
+        if len(popular[genre]) < FEED_GENRE_POOL:
+            popular[genre].append(code)
+    users = [row[0] for row in conn.execute(
+        "SELECT user_id FROM users WHERE is_active = TRUE AND last_activity >= datetime('now', ?)",
+        (f"-{int(active_days)} days",)
+    )]
+
+    now = int(time.time())
+    rows = []
+    for user_id in users:
+        seeds, seen = _user_seeds(conn, user_id)
+        if not seeds:
+            continue
+        scores = defaultdict(float)
+        genre_weights = defaultdict(float)
+        for code, weight in seeds.items():
+            for rank, other in enumerate(neighbors.get(code, ())):
+                scores[other] += weight / (rank + 1)
+            for genre in genres.get(code, ()):
+                genre_weights[genre] += weight
+        # Популярные фильмы трех любимых жанров добирают ленту, если соседей мало
+        total_genre_weight = sum(genre_weights.values()) or 1.0
+        for genre, weight in heapq.nlargest(3, genre_weights.items(), key=lambda item: item[1]):
+            share = FEED_GENRE_WEIGHT * weight / total_genre_weight
+            for rank, other in enumerate(popular.get(genre, ())):
+                scores[other] += share / (rank + 1)
+        feed = _top_k(((code, score) for code, score in scores.items() if code not in seen), size)
+        if feed:
+            rows.append((user_id, ",".join(code for code, _ in feed), now + ttl))
+
+    conn.execute('BEGIN IMMEDIATE')
+    conn.executemany('INSERT OR REPLACE INTO user_feeds (user_id, codes, expires_at) VALUES (?, ?, ?)', rows)
+    conn.execute('DELETE FROM user_feeds WHERE expires_at <= ?', (now,))
+    conn.commit()
+    conn.close()
+
+    return {
+        "active_users": len(users),
+        "feeds": len(rows),
+        "seconds": time.perf_counter() - started,
+    }
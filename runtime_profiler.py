@@ -0,0 +1,141 @@
+"""Профилирование работающего бота по команде админа: cProfile и снимки tracemalloc.
+
+cProfile включается на потоке event loop и снимает все, что там выполняется, пока идет
+замер: обработчики, фоновые задачи, работу с базой. Работа в asyncio.to_thread и в
+процессе рекомендаций в профиль не попадает. Замер заканчивается после N апдейтов,
+начатых после включения, или через T секунд - не дольше MAX_SECONDS в любом случае.
+Пока профилирование выключено, sys.setprofile не установлен и tracemalloc не запущен -
+на горячем пути остается только проверка флага active.
+"""
+import asyncio
+import cProfile
+import io
+import marshal
+import pstats
+import time
+import tracemalloc
+
+# Ограничения одного замера, чтобы забытый профилировщик не тормозил бота
+MAX_UPDATES = 10000
+MAX_SECONDS = 600
+SORT_KEYS = ("cumulative", "tottime", "calls")
+# Аллокации самого tracemalloc и импорта не интересны
+MEMORY_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+)
+
+
+class CpuProfiler:
+    def __init__(self):
+        self.active = False
+        self.finished = None  # asyncio.Event окончания текущего замера
+        self.updates = 0
+        self.started_at = None
+        self.elapsed = 0.0
+        self.stats = None  # pstats.Stats последнего замера
+        self._profile = None
+        self._started = 0.0
+        self._remaining = None
+
+    def start(self, updates=None):
+        """Начинает замер до updates апдейтов (None - пока не вызван stop)"""
+        if self.active:
+            return False
+        self.finished = asyncio.Event()
+        self.updates = 0
+        self.started_at = time.time()
+        self._remaining = min(updates, MAX_UPDATES) if updates else None
+        self._started = time.perf_counter()
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        self.active = True
+        return True
+
+    def update_done(self, started):
+        """Апдейт закончен; True, если на нем замер завершился. started - perf_counter начала апдейта"""
+        if not self.active or started < self._started:
+            return False
+        self.updates += 1
+        if self._remaining is not None:
+            self._remaining -= 1
+            if self._remaining <= 0:
+                return self.stop()
+        return False
+
+    def stop(self):
+        if not self.active:
+            return False
+        self._profile.disable()
+        self.active = False
+        self.elapsed = time.perf_counter() - self._started
+        self._profile.create_stats()
+        self.stats = pstats.Stats(self._profile)
+        self._profile = None
+        self.finished.set()
+        return True
+
+    async def wait(self, seconds=None):
+        """Ждет конца замера, но не дольше seconds (и MAX_SECONDS); по таймауту останавливает его"""
+        timeout = min(seconds, MAX_SECONDS) if seconds else MAX_SECONDS
+        try:
+            await asyncio.wait_for(self.finished.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.stop()
+
+    def report(self, limit=25, sort="cumulative"):
+        """Текст top-N функций последнего замера; None, если замера не было"""
+        if self.stats is None:
+            return None
+        stream = io.StringIO()
+        # Копия без каталогов в путях: в сообщении важны файл и функция, а dump хранит полные пути
+        stats = pstats.Stats(stream=stream)
+        stats.add(self.stats)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        # Заголовок pstats с путем к файлу и пустыми строками не нужен
+        lines = [line for line in stream.getvalue().splitlines() if line.strip()]
+        return "\n".join(lines)
+
+    def dump(self):
+        """Содержимое файла .pstats (формат pstats.Stats.dump_stats)"""
+        if self.stats is None:
+            return None
+        return marshal.dumps(self.stats.stats)
+
+
+class MemoryProfiler:
+    def __init__(self):
+        self.baseline = None
+        self.baseline_at = None
+
+    @property
+    def active(self):
+        return tracemalloc.is_tracing()
+
+    def start(self, frames=1):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.reset()
+
+    def reset(self):
+        self.baseline = self._snapshot()
+        self.baseline_at = time.time()
+
+    def stop(self):
+        self.baseline = None
+        self.baseline_at = None
+        tracemalloc.stop()
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(MEMORY_FILTERS)
+
+    def traced(self):
+        """(текущий, пиковый) объем памяти под наблюдением, байты"""
+        return tracemalloc.get_traced_memory()
+
+    def diff(self, limit=15, key="lineno"):
+        """[StatisticDiff] мест с наибольшим ростом памяти с момента baseline"""
+        if self.baseline is None:
+            return None
+        return self._snapshot().compare_to(self.baseline, key)[:limit]
@@ -0,0 +1,248 @@
+"""Профилировщик SQL для Database: время, число вызовов и строк по каждому запросу.
+
+Включенный профилировщик подменяет класс соединения (sqlite3.connect(factory=...)), и
+курсор замеряет execute/executemany и выборку строк. Запросы сводятся к нормализованному
+виду: литералы и списки IN (...) заменяются на ?, поэтому "WHERE code = '12'" и
+"WHERE code = '15'" - одна строка отчета. Запросы дольше порога пишутся в лог вместе с
+EXPLAIN QUERY PLAN. Выключенный профилировщик ничего не стоит: соединения обычные.
+"""
+import logging
+import re
+import sqlite3
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+IN_LIST_RE = re.compile(r"\bIN\s*\((?:\s*\?\s*,)*\s*\?\s*\)", re.IGNORECASE)
+SPACES_RE = re.compile(r"\s+")
+# Сколько последних длительностей запроса хранить для p99
+SAMPLES = 256
+# План медленного запроса пишется в лог не чаще раза в EXPLAIN_INTERVAL секунд
+EXPLAIN_INTERVAL = 300
+
+
+def normalize_sql(sql):
+    sql = STRING_RE.sub("?", sql)
+    sql = NUMBER_RE.sub("?", sql)
+    sql = IN_LIST_RE.sub("IN (...)", sql)
+    return SPACES_RE.sub(" ", sql).strip()
+
+
+class StatementStats:
+    __slots__ = ("count", "total", "max", "rows", "samples", "_next")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.samples = []
+        self._next = 0
+
+    def add_call(self, elapsed):
+        self.count += 1
+        self.add_time(elapsed)
+
+    def add_time(self, elapsed):
+        self.total += elapsed
+
+    def close_call(self, elapsed):
+        """Полное время вызова (execute + выборка) - в максимум и выборку для p99"""
+        if elapsed > self.max:
+            self.max = elapsed
+        if len(self.samples) < SAMPLES:
+            self.samples.append(elapsed)
+        else:
+            self.samples[self._next] = elapsed
+            self._next = (self._next + 1) % SAMPLES
+
+    @property
+    def avg(self):
+        return self.total / self.count if self.count else 0.0
+
+    @property
+    def p99(self):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+
+
+class SqlProfiler:
+    def __init__(self, db_path, slow_threshold=0.1):
+        self.db_path = db_path
+        self.slow_threshold = slow_threshold
+        self.enabled = False
+        self.started_at = None
+        self.stats = {}  # нормализованный SQL -> StatementStats
+        self.slow_log = deque(maxlen=50)  # (время, мс, SQL, план)
+        self._normalized = {}  # исходный SQL -> нормализованный
+        self._explained_at = {}
+
+    def enable(self):
+        self.enabled = True
+        self.started_at = time.time()
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.stats.clear()
+        self.slow_log.clear()
+        self._explained_at.clear()
+        self.started_at = time.time()
+
+    def statement(self, sql):
+        normalized = self._normalized.get(sql)
+        if normalized is None:
+            if len(self._normalized) > 10000:
+                self._normalized.clear()
+            normalized = self._normalized[sql] = normalize_sql(sql)
+        entry = self.stats.get(normalized)
+        if entry is None:
+            entry = self.stats[normalized] = StatementStats()
+        return normalized, entry
+
+    def explain(self, sql, params):
+        """Строки EXPLAIN QUERY PLAN на отдельном соединении только для чтения"""
+        try:
+            conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+            try:
+                rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            return [f"(plan yo'q: {e})"]
+        return [row[-1] for row in rows]
+
+    def report_slow(self, normalized, sql, params, elapsed):
+        now = time.time()
+        plan = []
+        if now - self._explained_at.get(normalized, 0) >= EXPLAIN_INTERVAL:
+            self._explained_at[normalized] = now
+            plan = self.explain(sql, params)
+        self.slow_log.append((now, elapsed * 1000, normalized, plan))
+        logger.warning(
+            f"Sekin SQL {elapsed * 1000:.1f} ms: {normalized}" + "".join(f"\n    {line}" for line in plan)
+        )
+
+    def top(self, limit=10, key="total"):
+        return sorted(self.stats.items(), key=lambda item: getattr(item[1], key), reverse=True)[:limit]
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, factory=ProfiledConnection)
+        conn.profiler = self
+        return conn
+
+
+class ProfiledConnection(sqlite3.Connection):
+    profiler = None
+
+    def cursor(self, factory=None):
+        cursor = super().cursor(factory or ProfiledCursor)
+        cursor.profiler = self.profiler
+        # Запрос, из которого прочитали не все строки (обычно fetchone), завершается при close
+        if not hasattr(self, "_cursors"):
+            self._cursors = []
+        self._cursors.append(cursor)
+        return cursor
+
+    def close(self):
+        for cursor in getattr(self, "_cursors", ()):
+            cursor._finish()
+        self._cursors = []
+        super().close()
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Время execute и последующей выборки строк относится к одному вызову запроса"""
+    profiler = None
+    _entry = None
+
+    def _begin(self, sql, params, elapsed, rows=0):
+        self._finish()
+        self._normalized, self._entry = self.profiler.statement(sql)
+        self._sql, self._params = sql, params
+        self._elapsed = elapsed
+        self._entry.add_call(elapsed)
+        self._entry.rows += rows
+
+    def _more(self, elapsed, rows):
+        entry = self._entry
+        if entry is not None:
+            entry.add_time(elapsed)
+            entry.rows += rows
+            self._elapsed += elapsed
+
+    def _finish(self):
+        entry = self._entry
+        if entry is None:
+            return
+        self._entry = None
+        entry.close_call(self._elapsed)
+        if self._elapsed >= self.profiler.slow_threshold:
+            self.profiler.report_slow(self._normalized, self._sql, self._params, self._elapsed)
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        result = super().execute(sql, parameters)
+        self._begin(sql, parameters, time.perf_counter() - started)
+        return result
+
+    def executemany(self, sql, parameters):
+        parameters = list(parameters)
+        started = time.perf_counter()
+        result = super().executemany(sql, parameters)
+        self._begin(sql, parameters[0] if parameters else (), time.perf_counter() - started, self.rowcount)
+        self._finish()
+        return result
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._more(time.perf_counter() - started, row is not None)
+        if row is None:
+            self._finish()
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._more(time.perf_counter() - started, len(rows))
+        if not rows:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._more(time.perf_counter() - started, len(rows))
+        self._finish()
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._more(time.perf_counter() - started, 0)
+            self._finish()
+            raise
+        self._more(time.perf_counter() - started, 1)
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
@@ -0,0 +1,72 @@
+"""Векторный (NumPy/SciPy) и запасной (чистый Python) расчет соседей должны совпадать"""
+import os
+import random
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import recommendations  # noqa: E402
+
+pytest.importorskip("numpy")
+pytest.importorskip("scipy")
+
+
+def make_db(path, movies=30, users=60, seed=7):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE movies (code TEXT PRIMARY KEY);
+        CREATE TABLE favorites (user_id INTEGER, movie_code TEXT, PRIMARY KEY (user_id, movie_code));
+        CREATE TABLE ratings (user_id INTEGER, movie_code TEXT, rating INTEGER, PRIMARY KEY (user_id, movie_code));
+        CREATE TABLE user_activity_logs (id INTEGER PRIMARY KEY, user_id INTEGER, action TEXT, details TEXT);
+        CREATE TABLE movie_neighbors (code TEXT PRIMARY KEY, neighbors TEXT, content_neighbors TEXT, computed_at INTEGER);
+    ''')
+    codes = [str(n) for n in range(1, movies + 1)]
+    conn.executemany('INSERT INTO movies (code) VALUES (?)', [(code,) for code in codes])
+    for user_id in range(users):
+        # Пользователь смотрит фильмы из "своей" группы - у соседей есть явный сигнал
+        group = codes[user_id % 3 * 10:user_id % 3 * 10 + 10]
+        for code in rng.sample(group, 4) + rng.sample(codes, 2):
+            conn.execute("INSERT INTO user_activity_logs (user_id, action, details) VALUES (?, 'watch_movie', ?)", (user_id, code))
+        conn.execute('INSERT OR IGNORE INTO favorites VALUES (?, ?)', (user_id, rng.choice(group)))
+        conn.execute('INSERT OR IGNORE INTO ratings VALUES (?, ?, ?)', (user_id, rng.choice(codes), rng.randint(1, 5)))
+    conn.commit()
+    conn.close()
+
+
+def read_neighbors(path):
+    conn = sqlite3.connect(path)
+    rows = dict(conn.execute('SELECT code, neighbors FROM movie_neighbors WHERE neighbors IS NOT NULL'))
+    conn.close()
+    return rows
+
+
+def test_engines_return_same_scores():
+    rng = random.Random(1)
+    users = [rng.randrange(40) for _ in range(400)]
+    items = [rng.randrange(25) for _ in range(400)]
+    weights = [rng.choice((1.0, 2.0, 3.0)) for _ in range(400)]
+    top_k = 25
+    fast = recommendations.neighbors_numpy(users, items, weights, 40, 25, top_k)
+    slow = recommendations.neighbors_python(users, items, weights, 40, 25, top_k)
+    assert fast.keys() == slow.keys()
+    for item in slow:
+        assert dict(fast[item]) == pytest.approx(dict(slow[item]), rel=1e-5)
+
+
+def test_build_item_neighbors_same_for_both_engines(tmp_path, monkeypatch):
+    numpy_db = tmp_path / "numpy.db"
+    python_db = tmp_path / "python.db"
+    make_db(str(numpy_db))
+    make_db(str(python_db))
+
+    stats = recommendations.build_item_neighbors(str(numpy_db), top_k=5)
+    assert stats["engine"] == "numpy"
+    monkeypatch.setattr(recommendations, "np", None)
+    stats = recommendations.build_item_neighbors(str(python_db), top_k=5)
+    assert stats["engine"] == "python"
+
+    assert read_neighbors(str(numpy_db)) == read_neighbors(str(python_db))
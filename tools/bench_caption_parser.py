@@ -0,0 +1,88 @@
+"""Бенчмарк разбора подписей на корпусе: реальные подписи из базы + синтетические.
+
+Запуск:
+    python tools/bench_caption_parser.py --db movies.db --synthetic 100000 --repeat 5
+
+Показывает скорость разбора (подписей в секунду, мкс на подпись) и сколько тегов
+каждого типа нашлось - по этим цифрам видно, во сколько обойдется переиндексация.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from caption_parser import CaptionParser  # noqa: E402
+from categories import GENRES, COUNTRIES, YEARS, QUALITIES, LANGUAGES  # noqa: E402
+
+TITLES = [
+    "Avatar 2: Suv yo'li", "Tezlik", "Зеленая миля", "O'rgimchak odam", "Интерстеллар",
+    "Qasoskorlar: Final", "Shrek 🎬", "Titanik (1997)", "Джентльмены", "Yulduzlararo",
+]
+NOISE_TAGS = ["film", "kino", "tarjima", "yangi", "premyera", "uzbek_tilida", "top", "serial"]
+
+
+def synthetic_captions(count, vocabulary, seed=42):
+    rng = random.Random(seed)
+    genres, countries, years, qualities, languages = vocabulary
+    for n in range(count):
+        lines = [f"#{n + 1}"]
+        title = rng.choice(TITLES)
+        if rng.random() < 0.5:
+            lines.append(f"#nomi_{title}" if rng.random() < 0.7 else f"#nazar_{title}")
+        else:
+            lines.insert(0, f"🎬 {title}")
+        tags = rng.sample(genres, rng.randint(1, 3)) + [rng.choice(countries), rng.choice(years)]
+        tags += [rng.choice(qualities), rng.choice(languages)] + rng.sample(NOISE_TAGS, 2)
+        rng.shuffle(tags)
+        lines.append(" ".join(f"#{tag}" for tag in tags))
+        lines.append("📥 Yuklab olish uchun kodni botga yuboring")
+        yield "\n".join(lines)
+
+
+def load_corpus(db_path, synthetic, vocabulary):
+    captions = []
+    if db_path and os.path.exists(db_path):
+        conn = sqlite3.connect(db_path)
+        captions = [row[0] for row in conn.execute('SELECT caption FROM movies WHERE caption IS NOT NULL')]
+        conn.close()
+    captions.extend(synthetic_captions(synthetic, vocabulary))
+    return captions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Caption parser benchmark")
+    parser.add_argument("--db", default=os.path.join(ROOT, "movies.db"), help="База с реальными подписями")
+    parser.add_argument("--synthetic", type=int, default=50000, help="Сколько синтетических подписей добавить")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    vocabulary = (GENRES, COUNTRIES, YEARS, QUALITIES, LANGUAGES)
+    caption_parser = CaptionParser(*vocabulary)
+    captions = load_corpus(args.db, args.synthetic, vocabulary)
+    if not captions:
+        print("❌ Korpus bo'sh")
+        return 1
+
+    best = None
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        for caption in captions:
+            caption_parser.parse(caption)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    tag_types = Counter(tag_type for caption in captions for tag_type, _ in caption_parser.parse(caption).tags)
+    print(f"📚 Korpus: {len(captions)} ta izoh")
+    print(f"⚡ {len(captions) / best:,.0f} izoh/s ({best / len(captions) * 1e6:.1f} mks/izoh, eng yaxshi {args.repeat} dan)")
+    print("🏷 Teglar: " + ", ".join(f"{tag_type}={count}" for tag_type, count in tag_types.most_common()))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
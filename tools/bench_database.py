@@ -0,0 +1,399 @@
+"""Микробенчмарк публичных методов Database на синтетической базе: задержки и планы запросов.
+
+Запуск:
+    python tools/bench_database.py --data bench_data --scale 0.01
+    python tools/bench_database.py --data bench_data --compare bench_data/baseline.json --out new.json
+
+Если в --data нет movies.db, она создается tools/synthetic_db.py с указанным --scale.
+Каждый метод вызывается до --calls раз (но не дольше --max-seconds) на аргументах из
+выборки реальных кодов, пользователей, тегов и поисковых строк; первый вызов - прогрев,
+на нем же снимаются SQL-запросы метода и их EXPLAIN QUERY PLAN. Результат - JSON с
+распределением задержек (p50/p90/p99/max) и планами по каждому методу. --compare
+сравнивает его с прошлым baseline: рост p50 или p99 больше --threshold раз - регрессия,
+и скрипт возвращает 1.
+
+Записи идут от имени служебных пользователей (id от BENCH_USER_BASE), фильмов bench*
+и канала BENCH_CHANNEL - в конце они удаляются, и база остается пригодной для
+следующего запуска. Бот нужно импортировать из каталога с базой: модуль создает
+db = Database() с путем movies.db.
+"""
+import argparse
+import datetime
+import importlib
+import inspect
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from categories import YEARS  # noqa: E402
+from sql_profiler import SqlProfiler, normalize_sql  # noqa: E402
+from synthetic_db import generate  # noqa: E402
+
+BENCH_USER_BASE = 9_000_000_000
+BENCH_CHANNEL = -1009999999999
+BENCH_SETTING = "bench_setting"
+SAMPLE_SIZE = 500
+# Методы схемы и служебные - не бенчмаркаются
+NOT_BENCHMARKED = {"init_db", "migrate", "update_database", "unit_of_work"}
+
+
+class Case:
+    """Метод и аргументы n-го вызова; calls - свой предел для тяжелых методов"""
+
+    def __init__(self, name, args=lambda n: (), calls=None, call=None, limit_by=None, method=None):
+        self.name = name
+        self.method = method or name  # один метод может быть в нескольких случаях
+        self.args = args
+        self.calls = calls
+        self.call = call  # свой способ вызова (например, первая пачка генератора)
+        self.limit_by = limit_by  # не больше вызовов, чем успел сделать этот метод
+
+
+class Sample:
+    """Аргументы из самой базы: чтобы запросы попадали и в популярные, и в редкие строки"""
+
+    def __init__(self, db_path, seed):
+        self.rng = random.Random(seed)
+        conn = sqlite3.connect(db_path)
+        rng = self.rng
+        max_rowid = conn.execute('SELECT MAX(rowid) FROM movies').fetchone()[0] or 0
+        popular = [row[0] for row in conn.execute('SELECT code FROM movies ORDER BY views DESC LIMIT 50')]
+        rowids = [rng.randint(1, max_rowid) for _ in range(SAMPLE_SIZE)] if max_rowid else []
+        self.codes = popular + self._column(conn, 'SELECT code FROM movies WHERE rowid = ?', rowids)
+        self.titles = self._column(conn, 'SELECT clean_title FROM movies WHERE rowid = ?', rowids[:100])
+
+        low, high = conn.execute('SELECT MIN(user_id), MAX(user_id) FROM users WHERE user_id < ?', (BENCH_USER_BASE,)).fetchone()
+        self.users = self._column(
+            conn, 'SELECT user_id FROM users WHERE user_id >= ? ORDER BY user_id LIMIT 1',
+            [rng.randint(low, high) for _ in range(SAMPLE_SIZE // 2)] if low is not None else []
+        )
+        max_favorite = conn.execute('SELECT MAX(rowid) FROM favorites').fetchone()[0] or 0
+        self.users += self._column(
+            conn, 'SELECT user_id FROM favorites WHERE rowid = ?',
+            [rng.randint(1, max_favorite) for _ in range(SAMPLE_SIZE // 2)] if max_favorite else []
+        )
+        self.tags = conn.execute('SELECT DISTINCT tag_type, tag_value FROM movie_tags').fetchall()
+        self.channels = [row[0] for row in conn.execute('SELECT channel_id FROM channels')]
+        self.reports = [row[0] for row in conn.execute("SELECT id FROM reports WHERE status = 'pending' LIMIT 200")]
+        conn.close()
+
+        words = [title.split(" ")[0] for title in self.titles if title]
+        self.queries = (
+            words + [word[:3] for word in words] + self.titles[:20]
+            + self.codes[:20] + ["zzzqqq", "nomsiz"]
+        )
+
+    @staticmethod
+    def _column(conn, sql, params):
+        values = []
+        for param in params:
+            row = conn.execute(sql, (param,)).fetchone()
+            if row is not None and row[0] is not None:
+                values.append(row[0])
+        return values
+
+    def pick(self, values, n):
+        return values[n % len(values)] if values else None
+
+    def code(self, n):
+        return self.pick(self.codes, n * 7919)
+
+    def user(self, n):
+        return self.pick(self.users, n * 104729)
+
+    def tag(self, n, tag_type=None):
+        tags = [tag for tag in self.tags if tag_type is None or tag[0] == tag_type]
+        return self.pick(tags, n * 31)
+
+    def filters(self, n):
+        """Один-два фильтра разных категорий, как в меню категорий"""
+        first = self.tag(n)
+        second = self.tag(n * 3 + 1)
+        if first is None:
+            return []
+        return [first] if second is None or second[0] == first[0] or n % 2 else [first, second]
+
+
+def cases(sample):
+    bench_user = lambda n: BENCH_USER_BASE + n  # noqa: E731
+    bench_code = lambda n: f"bench{n}"  # noqa: E731
+    genre = lambda n: (sample.tag(n, "genre") or ("genre", "Drama"))[1]  # noqa: E731
+    years = lambda n: YEARS[n % (len(YEARS) - 2):n % (len(YEARS) - 2) + 3]  # noqa: E731
+    return [
+        # Чтение
+        Case("get_movie", lambda n: (sample.code(n),)),
+        Case("get_movie_card", lambda n: (sample.code(n), sample.user(n))),
+        Case("get_movies_by_codes", lambda n: ([sample.code(n + k) for k in range(10)],)),
+        Case("search_movies", lambda n: (sample.pick(sample.queries, n),)),
+        Case("search_movies_by_title", lambda n: (sample.pick(sample.queries, n),)),
+        Case("browse_movies", lambda n: (sample.filters(n), 5, (n % 5) * 5, ("recent", "popular")[n % 2])),
+        Case("get_facet_counts", lambda n: (("genre", "country", "year")[n % 3], sample.filters(n)[:1])),
+        Case("get_recent_movies_by_years", lambda n: (years(n), 10, (n % 3) * 10)),
+        Case("get_recent_movies_count_by_years", lambda n: (years(n),)),
+        Case("get_similar_movies", lambda n: (sample.code(n),)),
+        Case("get_user_feed", lambda n: (sample.user(n),)),
+        Case("get_trending_movies", lambda n: (("today", "week", "all")[n % 3], 10, (n % 3) * 10)),
+        Case("get_popular_movies"),
+        Case("get_random_movie"),
+        Case("get_all_movies", lambda n: (50, (n % 10) * 50)),
+        Case("get_all_movies_count"),
+        Case("get_movie_rating", lambda n: (sample.code(n),)),
+        Case("get_user_rating", lambda n: (sample.user(n), sample.code(n))),
+        Case("get_movie_daily_views", lambda n: (sample.code(n),)),
+        Case("get_favorites", lambda n: (sample.user(n), 10, 0)),
+        Case("get_favorites_count", lambda n: (sample.user(n),)),
+        Case("is_favorite", lambda n: (sample.user(n), sample.code(n))),
+        Case("get_user_stats", lambda n: (sample.user(n),)),
+        Case("get_channel_request", lambda n: (sample.user(n), sample.pick(sample.channels, n))),
+        Case("get_user_channel_requests", lambda n: (sample.user(n),)),
+        Case("get_pending_requests_count", lambda n: (sample.pick(sample.channels, n) if n % 2 else None,)),
+        Case("get_all_channels"),
+        Case("get_setting", lambda n: ("archive_channel",)),
+        Case("get_callback_state", lambda n: (f"token{n}",)),
+        Case("get_users_count"),
+        Case("get_users_health_counts", calls=10),
+        Case("get_reports_count", calls=20),
+        Case("get_pending_reports", calls=10),
+        Case("get_daily_active_users", calls=5),
+        Case("count_audience", lambda n: [("all",), ("active", 7), ("premium",), ("favorite", sample.code(n))][n % 4], calls=20),
+        Case("count_audience_genre", lambda n: ("genre", genre(n)), calls=3, method="count_audience"),
+        Case("iter_audience_ids", lambda n: ("all",), call=lambda db, *args: next(db.iter_audience_ids(*args), None)),
+        Case("get_all_users", calls=3),
+        # Загрузка кэшей и фоновые пачки
+        Case("warm_known_users", calls=3),
+        Case("warm_channels", calls=10),
+        Case("warm_facets", calls=3),
+        Case("warm_content", calls=3),
+        Case("warm_trending", calls=3),
+        Case("backfill_movies", calls=5),
+        Case("backfill_content_neighbors", lambda n: (100,), calls=5),
+        # Запись - от служебных пользователей, фильмов и канала
+        Case("add_user", lambda n: (bench_user(n), "bench", "Bench", None)),
+        Case("update_user_activity", lambda n: (bench_user(n),)),
+        Case("flush_user_activity"),
+        Case("log_user_activity", lambda n: (bench_user(n), "message", sample.pick(sample.queries, n))),
+        Case("record_movie_view", lambda n: (bench_user(n), sample.code(n))),
+        Case("increment_views", lambda n: (sample.code(n),)),
+        Case(
+            "flush_views", lambda n: ([sample.code(n * 20 + k) for k in range(20)],), calls=20,
+            call=lambda db, codes: ([db.increment_views(code) for code in codes], db.flush_views())
+        ),
+        Case("add_to_favorites", lambda n: (bench_user(n), sample.code(n))),
+        Case("remove_from_favorites", lambda n: (bench_user(n), sample.code(n))),
+        Case("add_rating", lambda n: (bench_user(n), sample.code(n), n % 5 + 1)),
+        Case("add_report", lambda n: (bench_user(n), sample.code(n), "quality")),
+        Case("resolve_report", lambda n: (sample.pick(sample.reports, n) or 0, BENCH_USER_BASE)),
+        Case("add_channel_request", lambda n: (bench_user(n), BENCH_CHANNEL)),
+        Case("update_channel_request_status", lambda n: (bench_user(n), BENCH_CHANNEL, "approved")),
+        Case("delete_channel_request", lambda n: (bench_user(n), BENCH_CHANNEL)),
+        Case("add_channel", lambda n: (BENCH_CHANNEL, "@bench", "Bench", None, False), calls=20),
+        Case("delete_channel", lambda n: (BENCH_CHANNEL,), calls=20),
+        Case("update_setting", lambda n: (BENCH_SETTING, str(n))),
+        Case("save_callback_states", lambda n: ([(f"bench{n}-{k}", "bench", "[]", int(time.time()) + 60) for k in range(50)],)),
+        Case("mark_users_inactive", lambda n: ([bench_user(n * 10 + k) for k in range(10)],), calls=20),
+        Case("mark_user_inactive", lambda n: (bench_user(n),)),
+        Case("add_movie", lambda n: (bench_code(n), f"BENCHFILE{n}", f"#{bench_code(n)}\n#nomi_Bench film {n}\n#Drama #AQSH #2024", 5400, 1 << 30)),
+        Case("delete_movie", lambda n: (bench_code(n),), limit_by="add_movie"),
+    ]
+
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def trace_queries(db, function, args, explainer):
+    """Вызывает метод один раз и возвращает [{sql, plan}] всех его запросов"""
+    statements = []
+    open_connection = db._open
+
+    def traced_open():
+        conn = open_connection()
+        # Трассировка получает SQL с подставленными параметрами - его можно сразу объяснить
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    db._open = traced_open
+    try:
+        function(*args)
+    finally:
+        del db._open
+
+    queries = {}
+    for sql in statements:
+        if sql.split(None, 1)[0].upper() in ("BEGIN", "COMMIT", "ROLLBACK"):
+            continue
+        normalized = normalize_sql(sql)
+        if normalized not in queries:
+            queries[normalized] = explainer.explain(sql, ())
+    return [{"sql": sql, "plan": plan} for sql, plan in queries.items()]
+
+
+def run_case(db, case, calls, max_seconds, explainer):
+    function = (lambda *args: case.call(db, *args)) if case.call else getattr(db, case.method)
+
+    queries = trace_queries(db, function, case.args(0), explainer)
+    timings = []
+    deadline = time.perf_counter() + max_seconds
+    for n in range(1, calls + 1):
+        args = case.args(n)
+        started = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - started)
+        if time.perf_counter() > deadline and len(timings) >= 3:
+            break
+
+    ordered = sorted(timings)
+    return {
+        "method": case.method,
+        "calls": len(timings),
+        "mean_ms": sum(timings) / len(timings) * 1000,
+        "min_ms": ordered[0] * 1000,
+        "p50_ms": percentile(ordered, 0.5) * 1000,
+        "p90_ms": percentile(ordered, 0.9) * 1000,
+        "p99_ms": percentile(ordered, 0.99) * 1000,
+        "max_ms": ordered[-1] * 1000,
+        "queries": queries,
+    }
+
+
+def cleanup(db_path):
+    """Удаляет все, что записал бенчмарк"""
+    conn = sqlite3.connect(db_path, timeout=30)
+    for table, column in (
+        ("favorites", "user_id"), ("ratings", "user_id"), ("reports", "user_id"),
+        ("channel_requests", "user_id"), ("user_activity_logs", "user_id"), ("users", "user_id"),
+    ):
+        conn.execute(f'DELETE FROM {table} WHERE {column} >= ?', (BENCH_USER_BASE,))
+    for table in ("movie_tags", "movie_neighbors", "movie_views_daily", "movies"):
+        conn.execute(f"DELETE FROM {table} WHERE code LIKE 'bench%'")
+    conn.execute("DELETE FROM callback_state WHERE tag = 'bench'")
+    conn.execute('DELETE FROM channels WHERE channel_id = ?', (BENCH_CHANNEL,))
+    conn.execute('DELETE FROM channel_requests WHERE channel_id = ?', (BENCH_CHANNEL,))
+    conn.execute('DELETE FROM bot_settings WHERE key = ?', (BENCH_SETTING,))
+    conn.execute("UPDATE reports SET status = 'pending', resolved_at = NULL, resolved_by = NULL WHERE resolved_by = ?", (BENCH_USER_BASE,))
+    conn.commit()
+    conn.close()
+
+
+def dataset_info(db_path):
+    conn = sqlite3.connect(db_path)
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+    counts = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0] for table in tables}
+    conn.close()
+    return {"size_mb": round(os.path.getsize(db_path) / 1024 / 1024, 1), "tables": counts}
+
+
+def compare(result, baseline, threshold):
+    """Печатает изменения относительно baseline; возвращает число регрессий"""
+    regressions = 0
+    print(f"\n📊 Taqqoslash (chegara x{threshold}):")
+    for name, new in result["methods"].items():
+        old = baseline.get("methods", {}).get(name)
+        if old is None:
+            print(f"  {name:34} yangi")
+            continue
+        marks = []
+        for key in ("p50_ms", "p99_ms"):
+            ratio = new[key] / old[key] if old[key] else 1.0
+            # Доли миллисекунды - шум таймера, а не регрессия
+            if ratio > threshold and new[key] - old[key] > 0.05:
+                marks.append(f"{key[:-3]} x{ratio:.2f}")
+        plans_changed = [q["plan"] for q in new["queries"]] != [q["plan"] for q in old.get("queries", [])]
+        if marks:
+            regressions += 1
+        if marks or plans_changed:
+            print(
+                f"  {'⚠️' if marks else 'ℹ️'} {name:32} p50 {old['p50_ms']:.3f} -> {new['p50_ms']:.3f} ms, "
+                f"p99 {old['p99_ms']:.3f} -> {new['p99_ms']:.3f} ms"
+                + (f" ({', '.join(marks)})" if marks else "") + (" | reja o'zgardi" if plans_changed else "")
+            )
+    print(f"{'❌' if regressions else '✅'} Regressiyalar: {regressions}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Database micro-benchmarks on a synthetic catalog")
+    parser.add_argument("--data", default=os.path.join(ROOT, "bench_data"), help="Каталог с movies.db")
+    parser.add_argument("--scale", type=float, default=0.01, help="Масштаб, если базу нужно сгенерировать")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--calls", type=int, default=200, help="Вызовов на метод")
+    parser.add_argument("--max-seconds", type=float, default=10.0, help="Не дольше на метод")
+    parser.add_argument("--only", help="Только эти методы, через запятую")
+    parser.add_argument("--out", help="JSON с результатом (по умолчанию <data>/bench-<время>.json)")
+    parser.add_argument("--compare", help="Прошлый JSON для сравнения")
+    parser.add_argument("--threshold", type=float, default=1.25)
+    args = parser.parse_args()
+
+    data = os.path.abspath(args.data)
+    out = os.path.abspath(args.out) if args.out else None
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+    os.makedirs(data, exist_ok=True)
+    db_path = os.path.join(data, "movies.db")
+    if not os.path.exists(db_path):
+        generate(db_path, args.scale, args.seed)
+
+    os.chdir(data)
+    bot = importlib.import_module("bot")
+    db = bot.db
+    cleanup(db_path)
+    sample = Sample(db_path, args.seed)
+    explainer = SqlProfiler(db_path)
+
+    selected = set(args.only.split(",")) if args.only else None
+    all_cases = [case for case in cases(sample) if selected is None or case.name in selected]
+    benchmarked = {case.method for case in cases(sample)}
+    public = {
+        name for name, value in vars(bot.Database).items()
+        if not name.startswith("_") and inspect.isfunction(value)
+    }
+    missing = sorted(public - benchmarked - NOT_BENCHMARKED)
+    if missing:
+        print("⚠️ Benchmarksiz metodlar: " + ", ".join(missing))
+
+    result = {
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "machine": platform.machine(),
+        "dataset": dataset_info(db_path),
+        "calls": args.calls,
+        "methods": {},
+        "not_benchmarked": missing,
+    }
+    print(f"📦 {db_path}: " + ", ".join(f"{table}={count:,}" for table, count in result["dataset"]["tables"].items() if count))
+    print(f"{'metod':34} {'chaqiruv':>8} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9} ms")
+    try:
+        for case in all_cases:
+            calls = min(args.calls, case.calls or args.calls)
+            if case.limit_by in result["methods"]:
+                calls = min(calls, result["methods"][case.limit_by]["calls"])
+            stats = run_case(db, case, calls, args.max_seconds, explainer)
+            result["methods"][case.name] = stats
+            print(
+                f"{case.name:34} {stats['calls']:>8} {stats['p50_ms']:>9.3f} {stats['p90_ms']:>9.3f} "
+                f"{stats['p99_ms']:>9.3f} {stats['max_ms']:>9.3f}"
+            )
+    finally:
+        cleanup(db_path)
+
+    out = out or os.path.join(data, f"bench-{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=1)
+    print(f"💾 {out}")
+
+    if baseline_path:
+        with open(baseline_path, encoding="utf-8") as f:
+            baseline = json.load(f)
+        return 1 if compare(result, baseline, args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,35 @@
+"""Пересчет похожих фильмов (movie_neighbors) и лент "Siz uchun" (user_feeds) вручную, без бота.
+
+Запуск:
+    python tools/build_recommendations.py --db movies.db --top-k 20 --active-days 7
+"""
+import argparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from recommendations import DEFAULT_TOP_K, build_item_neighbors, build_user_feeds  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build item-item movie neighbors")
+    parser.add_argument("--db", default=os.path.join(ROOT, "movies.db"))
+    parser.add_argument("--top-k", type=int, default=DEFAULT_TOP_K)
+    parser.add_argument("--active-days", type=int, default=7, help="Ленты только для активных за N дней")
+    parser.add_argument("--feed-ttl", type=int, default=24 * 3600, help="Срок годности ленты в секундах")
+    args = parser.parse_args()
+
+    stats = build_item_neighbors(args.db, args.top_k)
+    print(
+        f"✅ {stats['with_neighbors']}/{stats['movies']} film uchun o'xshashlar ({stats['engine']}): "
+        f"{stats['users']} foydalanuvchi, {stats['interactions']} harakat, {stats['seconds']:.2f} s"
+    )
+    stats = build_user_feeds(args.db, args.active_days, args.top_k, args.feed_ttl)
+    print(f"✅ {stats['feeds']}/{stats['active_users']} faol foydalanuvchi uchun lenta, {stats['seconds']:.2f} s")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
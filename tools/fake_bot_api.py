@@ -0,0 +1,218 @@
+"""Локальный фейковый Bot API для проверки webhook/polling режима и параллельной обработки.
+
+Запуск:
+    python tools/fake_bot_api.py --port 8081 --users 20 --messages 5 --slow sendMessage=0.3
+
+Затем в другом терминале:
+    BOT_TOKEN=123:TEST BOT_API_BASE_URL=http://127.0.0.1:8081 python bot.py
+
+Для webhook режима бот запускается с WEBHOOK_URL=http://127.0.0.1:8443, а харнесс -
+с --webhook http://127.0.0.1:8443/telegram: апдейты отправляются прямо на webhook.
+
+Харнесс отправляет каждому пользователю текстовые сообщения probe-<user>-<n>, ждет ответов
+и проверяет, что ответы одного пользователя пришли в порядке отправки, а также показывает,
+сколько запросов к API выполнялось одновременно.
+"""
+import argparse
+import itertools
+import json
+import re
+import threading
+import time
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BOT_USER = {"id": 1000000, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+PROBE_RE = re.compile(r"probe-(\d+)-(\d+)")
+
+
+class FakeBotAPI:
+    """Отвечает на методы Bot API заготовками и записывает все вызовы"""
+
+    def __init__(self, slow_methods=None):
+        self.slow_methods = slow_methods or {}
+        self.calls = []
+        self.pending_updates = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+
+    def push_update(self, update):
+        with self._lock:
+            update["update_id"] = next(self._update_ids)
+            self.pending_updates.append(update)
+        return update
+
+    def _message(self, params):
+        chat_id = int(params.get("chat_id", 0))
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": params.get("text", ""),
+        }
+
+    def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        deadline = time.monotonic() + min(float(params.get("timeout") or 0), 1.0)
+        while True:
+            with self._lock:
+                self.pending_updates = [u for u in self.pending_updates if u["update_id"] >= offset]
+                if self.pending_updates or time.monotonic() >= deadline:
+                    return list(self.pending_updates)
+            time.sleep(0.05)
+
+    def handle(self, method, params):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.slow_methods.get(method, 0))
+            with self._lock:
+                self.calls.append((time.monotonic(), method, params))
+
+            if method == "getMe":
+                return BOT_USER
+            if method == "getUpdates":
+                return self._get_updates(params)
+            if method == "getChatMember":
+                return {"status": "member", "user": {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "U"}}
+            if method in ("sendMessage", "sendVideo", "sendDocument", "editMessageText"):
+                return self._message(params)
+            if method == "copyMessage":
+                return {"message_id": next(self._message_ids)}
+            return True
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def replies_by_chat(self):
+        """Возвращает номера probe-сообщений в порядке ответов бота для каждого чата"""
+        replies = {}
+        for _, method, params in sorted(self.calls, key=lambda call: call[0]):
+            if method != "sendMessage":
+                continue
+            match = PROBE_RE.search(params.get("text", ""))
+            if match:
+                replies.setdefault(int(match.group(1)), []).append(int(match.group(2)))
+        return replies
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length).decode() if length else ""
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                params = json.loads(body or "{}")
+            else:
+                params = {k: v[0] for k, v in urllib.parse.parse_qs(body).items()}
+
+            method = self.path.rstrip("/").rsplit("/", 1)[-1]
+            payload = json.dumps({"ok": True, "result": api.handle(method, params)}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        do_GET = do_POST
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def text_update(user_id, text):
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+    return {
+        "message": {
+            "message_id": user_id * 1000 + int(time.time() * 1000) % 1000,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "text": text,
+        }
+    }
+
+
+def post_webhook(url, update, secret=None):
+    request = urllib.request.Request(url, data=json.dumps(update).encode(), method="POST")
+    request.add_header("Content-Type", "application/json")
+    if secret:
+        request.add_header("X-Telegram-Bot-Api-Secret-Token", secret)
+    urllib.request.urlopen(request, timeout=10).read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API harness")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=5)
+    parser.add_argument("--webhook", help="URL webhook бота; без него апдейты отдаются через getUpdates")
+    parser.add_argument("--secret", help="WEBHOOK_SECRET бота")
+    parser.add_argument("--slow", action="append", default=[], help="Задержка метода, например sendMessage=0.3")
+    parser.add_argument("--wait", type=float, default=30.0, help="Сколько ждать ответов, секунд")
+    parser.add_argument("--first-user-id", type=int, default=500000)
+    args = parser.parse_args()
+
+    slow_methods = {}
+    for item in args.slow:
+        method, _, delay = item.partition("=")
+        slow_methods[method] = float(delay)
+
+    api = FakeBotAPI(slow_methods)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(api))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"🧪 Fake Bot API: http://127.0.0.1:{args.port}")
+
+    # Ждем, пока бот подключится: setWebhook в webhook режиме, getUpdates - в polling
+    ready_method = "setWebhook" if args.webhook else "getUpdates"
+    while not any(method == ready_method for _, method, _ in list(api.calls)):
+        time.sleep(0.2)
+
+    user_ids = range(args.first_user_id, args.first_user_id + args.users)
+    started = time.monotonic()
+    if args.webhook:
+        # Как и Telegram, сообщения одного пользователя доставляются по очереди,
+        # а разные пользователи - параллельно
+        def send_user_updates(user_id):
+            for n in range(args.messages):
+                update = text_update(user_id, f"probe-{user_id}-{n}")
+                update["update_id"] = user_id * args.messages + n
+                post_webhook(args.webhook, update, args.secret)
+
+        for user_id in user_ids:
+            threading.Thread(target=send_user_updates, args=(user_id,), daemon=True).start()
+    else:
+        for n in range(args.messages):
+            for user_id in user_ids:
+                api.push_update(text_update(user_id, f"probe-{user_id}-{n}"))
+
+    expected = args.users * args.messages
+    while time.monotonic() - started < args.wait:
+        if sum(len(v) for v in api.replies_by_chat().values()) >= expected:
+            break
+        time.sleep(0.1)
+    elapsed = time.monotonic() - started
+
+    replies = api.replies_by_chat()
+    received = sum(len(v) for v in replies.values())
+    out_of_order = [user_id for user_id, seq in replies.items() if seq != sorted(seq)]
+
+    print(f"📨 Javoblar: {received}/{expected} ({elapsed:.2f} s, {received / elapsed:.1f} upd/s)")
+    print(f"⚡ Bir vaqtda API so'rovlari (max): {api.max_in_flight}")
+    if out_of_order:
+        print(f"❌ Tartib buzilgan foydalanuvchilar: {out_of_order}")
+    else:
+        print("✅ Har bir foydalanuvchi javoblari tartib bilan keldi")
+    server.shutdown()
+    return 0 if received == expected and not out_of_order else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
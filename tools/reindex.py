@@ -0,0 +1,191 @@
+"""Переиндексация фильмов: заново разбирает все подписи и переписывает title, clean_title и movie_tags.
+
+Запуск (бот может продолжать работать):
+    python tools/reindex.py --db movies.db --workers 4 --batch 2000
+
+Подписи читаются потоком, разбираются в пуле процессов и пачками пишутся в теневые
+таблицы. В конце одна короткая транзакция подменяет movie_tags теневой таблицей и
+обновляет названия в movies - бот все время видит либо старый, либо новый индекс.
+Фильмы, добавленные ботом во время переиндексации, уже разобраны новым парсером и
+сохраняются как есть; удаленные за это время в новый индекс не попадают. Фильмы, чью
+подпись перезаписали после разбора, перед подменой разбираются заново.
+
+Фильтры (facets) и похожие по содержанию (content) бот держит в памяти и строит при
+запуске - после переиндексации бота нужно перезапустить, иначе они останутся старыми.
+Рейтинг популярных от подписей не зависит.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from caption_parser import CaptionParser  # noqa: E402
+from categories import GENRES, COUNTRIES, YEARS, QUALITIES, LANGUAGES  # noqa: E402
+
+SHADOW_TAGS = "movie_tags_reindex"
+SHADOW_TITLES = "movie_titles_reindex"
+
+_parser = None
+
+
+def _init_worker():
+    global _parser
+    _parser = CaptionParser(GENRES, COUNTRIES, YEARS, QUALITIES, LANGUAGES)
+
+
+def parse_batch(rows):
+    """Разбирает пачку (code, caption) в процессе пула (для catch_up - в основном процессе)"""
+    result = []
+    for code, caption in rows:
+        parsed = _parser.parse(caption, code)
+        result.append((code, caption, parsed.title, parsed.clean_title, parsed.tags))
+    return result
+
+
+def iter_batches(db_path, batch_size):
+    """Читает подписи пачками по rowid, не держа открытой транзакцию между пачками"""
+    last_rowid = 0
+    while True:
+        conn = sqlite3.connect(db_path)
+        rows = conn.execute(
+            'SELECT rowid, code, caption FROM movies WHERE rowid > ? ORDER BY rowid LIMIT ?',
+            (last_rowid, batch_size)
+        ).fetchall()
+        conn.close()
+        if not rows:
+            return
+        last_rowid = rows[-1][0]
+        yield [(code, caption) for _, code, caption in rows]
+
+
+def create_shadow_tables(conn):
+    conn.execute(f'DROP TABLE IF EXISTS {SHADOW_TAGS}')
+    conn.execute(f'DROP TABLE IF EXISTS {SHADOW_TITLES}')
+    conn.execute(f'''
+        CREATE TABLE {SHADOW_TAGS} (
+            code TEXT,
+            tag_type TEXT,
+            tag_value TEXT,
+            FOREIGN KEY (code) REFERENCES movies (code),
+            PRIMARY KEY (code, tag_type, tag_value)
+        )
+    ''')
+    # caption - подпись, которую разбирали: по ней видно, что фильм перезаписали после разбора
+    conn.execute(f'CREATE TABLE {SHADOW_TITLES} (code TEXT PRIMARY KEY, caption TEXT, title TEXT, clean_title TEXT)')
+    conn.commit()
+
+
+def write_batch(conn, parsed_rows, commit=True):
+    conn.executemany(
+        f'INSERT OR REPLACE INTO {SHADOW_TITLES} (code, caption, title, clean_title) VALUES (?, ?, ?, ?)',
+        [(code, caption, title, clean_title) for code, caption, title, clean_title, _ in parsed_rows]
+    )
+    conn.executemany(
+        f'INSERT OR IGNORE INTO {SHADOW_TAGS} (code, tag_type, tag_value) VALUES (?, ?, ?)',
+        [(code, tag_type, tag_value) for code, _, _, _, tags in parsed_rows for tag_type, tag_value in tags]
+    )
+    if commit:
+        conn.commit()
+    return len(parsed_rows)
+
+
+def catch_up(conn, commit=True):
+    """Заново разбирает фильмы, чья подпись изменилась после разбора; возвращает их число"""
+    rows = conn.execute(f'''
+        SELECT m.code, m.caption FROM movies m
+        JOIN {SHADOW_TITLES} s ON s.code = m.code
+        WHERE m.caption IS NOT s.caption
+    ''').fetchall()
+    if not rows:
+        return 0
+    conn.executemany(f'DELETE FROM {SHADOW_TAGS} WHERE code = ?', [(code,) for code, _ in rows])
+    return write_batch(conn, parse_batch(rows), commit)
+
+
+def report_progress(done, total, started):
+    elapsed = time.perf_counter() - started
+    print(f"\r🔄 {done}/{total} ({done / max(elapsed, 1e-9):,.0f} film/s)", end="", flush=True)
+
+
+def swap(conn):
+    """Подменяет индекс одной транзакцией"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # Подписи, перезаписанные после основного catch_up, - уже под блокировкой записи
+        catch_up(conn, commit=False)
+        # Фильмы, появившиеся после начала переиндексации, - со своими текущими тегами
+        conn.execute(f'''
+            INSERT OR IGNORE INTO {SHADOW_TAGS} (code, tag_type, tag_value)
+            SELECT code, tag_type, tag_value FROM movie_tags
+            WHERE code NOT IN (SELECT code FROM {SHADOW_TITLES})
+        ''')
+        conn.execute(f'DELETE FROM {SHADOW_TAGS} WHERE code NOT IN (SELECT code FROM movies)')
+        conn.execute(f'''
+            UPDATE movies SET
+                title = (SELECT title FROM {SHADOW_TITLES} s WHERE s.code = movies.code),
+                clean_title = (SELECT clean_title FROM {SHADOW_TITLES} s WHERE s.code = movies.code)
+            WHERE code IN (SELECT code FROM {SHADOW_TITLES})
+        ''')
+        conn.execute('DROP TABLE movie_tags')
+        conn.execute(f'ALTER TABLE {SHADOW_TAGS} RENAME TO movie_tags')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_movie_tags_value ON movie_tags (tag_type, tag_value)')
+        conn.execute(f'DROP TABLE {SHADOW_TITLES}')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-index movie titles and tags")
+    parser.add_argument("--db", default=os.path.join(ROOT, "movies.db"))
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--batch", type=int, default=2000, help="Фильмов в одной пачке разбора и записи")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db, timeout=30)
+    if conn.execute('PRAGMA user_version').fetchone()[0] < 1:
+        print("❌ Baza eski sxemada - avval botni ishga tushiring, u migratsiyani bajaradi")
+        return 1
+    total = conn.execute('SELECT COUNT(*) FROM movies').fetchone()[0]
+    create_shadow_tables(conn)
+
+    started = time.perf_counter()
+    done = 0
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker) as pool:
+        # В работе не больше двух пачек на процесс - подписи не читаются в память целиком
+        in_flight = deque()
+        batches = iter_batches(args.db, args.batch)
+        for rows in batches:
+            in_flight.append(pool.submit(parse_batch, rows))
+            if len(in_flight) < args.workers * 2:
+                continue
+            done += write_batch(conn, in_flight.popleft().result())
+            report_progress(done, total, started)
+        while in_flight:
+            done += write_batch(conn, in_flight.popleft().result())
+            report_progress(done, total, started)
+    print()
+
+    # Основная часть изменившихся подписей разбирается до подмены, не держа блокировку записи
+    _init_worker()
+    changed = catch_up(conn)
+    if changed:
+        print(f"🔁 Imzosi o'zgargan {changed} ta film qayta tahlil qilindi")
+    swap(conn)
+    conn.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"✅ Qayta indekslandi: {done} ta film, {elapsed:.2f} s ({done / max(elapsed, 1e-9):,.0f} film/s)")
+    print("ℹ️ Filtrlar va o'xshash filmlar bot xotirasida - ularni yangilash uchun botni qayta ishga tushiring")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
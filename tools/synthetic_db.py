@@ -0,0 +1,375 @@
+"""Синтетическая база большого каталога для бенчмарков: фильмы, пользователи, действия, избранное.
+
+Запуск:
+    python tools/synthetic_db.py --out bench_data --scale 0.01
+    python tools/synthetic_db.py --out bench_data --scale 1 --recommendations
+
+При --scale 1 это 100k фильмов с подписями в стиле канала (название, хештеги категорий),
+1M пользователей и 50M записей user_activity_logs за последние 90 дней. Популярность
+фильмов и активность пользователей распределены по Ципфу: немного очень популярных,
+длинный хвост редких. Схема создается самим Database, индексы снимаются на время
+загрузки и строятся заново в конце; ANALYZE не запускается - в рабочей базе его тоже
+нет. movies.views и movie_views_daily считаются из сгенерированных просмотров, поэтому
+сходятся с логами, как в живой базе.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from caption_parser import CaptionParser  # noqa: E402
+from categories import GENRES, COUNTRIES, YEARS, QUALITIES, LANGUAGES  # noqa: E402
+
+# Объем при --scale 1
+SIZES = {
+    "movies": 100_000,
+    "users": 1_000_000,
+    "logs": 50_000_000,
+    "favorites": 2_000_000,
+    "ratings": 1_000_000,
+    "reports": 20_000,
+    "channel_requests": 300_000,
+}
+CHANNELS = 5
+BATCH = 100_000
+LOG_DAYS = 90
+CATALOG_DAYS = 3 * 365
+
+TITLE_WORDS = [
+    "Sevgi", "Yo'l", "Qasos", "Tun", "Shahar", "Oxirgi", "Qora", "Oltin", "Bahor", "Yulduz",
+    "Dengiz", "Sirli", "Jang", "Qal'a", "Bo'ri", "Ota", "Ona", "Do'st", "Orol", "Tog'",
+    "Sahro", "Olov", "Muz", "Qirol", "Malika", "Soya", "Ruh", "Vaqt", "Kelajak", "O'tmish",
+    "Osmon", "Daryo", "Bog'", "Mehr", "Umid", "Taqdir", "Sir", "Qahramon", "Ov", "Chegara",
+    "Тень", "Город", "Ночь", "Любовь", "Последний", "Война", "Дом", "Море", "Зеленая", "миля",
+    "Dark", "Night", "Lost", "King", "City", "Fire", "Shadow", "Avatar", "Legend", "Storm",
+]
+SEQUELS = ["2", "3", ": Qaytish", ": Final", ": Boshlanishi", " (1997)", " 🎬"]
+NOISE_TAGS = ["film", "kino", "tarjima", "yangi", "premyera", "uzbek_tilida", "top", "serial"]
+FOOTERS = ["📥 Yuklab olish uchun kodni botga yuboring", "🍿 Yoqimli tomosha!", ""]
+# Доли действий в user_activity_logs
+ACTIONS = [("watch_movie", 40), ("callback", 30), ("message", 25), ("start_command", 3), ("subscription_check", 2)]
+REPORT_TYPES = ["wrong", "offensive", "copyright", "adult", "quality"]
+REQUEST_STATUSES = [("approved", 70), ("pending", 20), ("rejected", 7), ("cancelled", 3)]
+
+
+def zipf_cum_weights(count, exponent):
+    """Накопленные веса для random.choices: элемент n (с нуля) имеет вес 1 / (n + 1) ** exponent"""
+    total = 0.0
+    cumulative = []
+    for n in range(count):
+        total += 1.0 / (n + 1) ** exponent
+        cumulative.append(total)
+    return cumulative
+
+
+def movie_title(rng):
+    title = " ".join(rng.sample(TITLE_WORDS, rng.randint(1, 3)))
+    if rng.random() < 0.15:
+        title += rng.choice(SEQUELS)
+    return title
+
+
+def movie_caption(rng, code):
+    title = movie_title(rng)
+    lines = [f"#{code}"]
+    if rng.random() < 0.6:
+        lines.append(f"#nomi_{title}" if rng.random() < 0.8 else f"#nazar_{title}")
+    else:
+        lines.insert(0, f"🎬 {title}")
+    tags = rng.sample(GENRES, rng.randint(1, 3)) + [rng.choice(COUNTRIES), rng.choice(YEARS)]
+    tags += [rng.choice(QUALITIES), rng.choice(LANGUAGES)] + rng.sample(NOISE_TAGS, rng.randint(0, 3))
+    rng.shuffle(tags)
+    lines.append(" ".join(f"#{tag}" for tag in tags))
+    lines.append(rng.choice(FOOTERS))
+    return "\n".join(lines).strip()
+
+
+class Generator:
+    def __init__(self, conn, scale, seed, now=None, progress=print):
+        self.conn = conn
+        self.rng = random.Random(seed)
+        self.now = int(time.time() if now is None else now)
+        self.sizes = {name: max(1, int(size * scale)) for name, size in SIZES.items()}
+        self.progress = progress
+        self.codes = []
+        self.titles = []
+        self.user_ids = []
+        self._movie_ranks = self._movie_weights = None
+        self._user_ranks = self._user_weights = None
+
+    def _report(self, name, count, started):
+        self.progress(f"  {name}: {count:,} ({time.perf_counter() - started:.1f} s)")
+
+    def _popular_movies(self, k):
+        # Популярность не связана с возрастом фильма: ранги перемешаны
+        return self.rng.choices(self._movie_ranks, cum_weights=self._movie_weights, k=k)
+
+    def _active_users(self, k):
+        return self.rng.choices(self._user_ranks, cum_weights=self._user_weights, k=k)
+
+    def movies(self):
+        started = time.perf_counter()
+        rng = self.rng
+        parser = CaptionParser(GENRES, COUNTRIES, YEARS, QUALITIES, LANGUAGES)
+        count = self.sizes["movies"]
+        first_added = self.now - CATALOG_DAYS * 86400
+        movies, tags = [], []
+        for n in range(count):
+            code = str(n + 1)
+            caption = movie_caption(rng, code)
+            parsed = parser.parse(caption, code)
+            added = first_added + (self.now - first_added) * n // count
+            file_id = "BAACAgIAAxkBAA" + "%030x" % rng.getrandbits(120)
+            movies.append((
+                code, file_id, caption, parsed.title, parsed.clean_title, added,
+                rng.randint(600, 9000), rng.randint(200, 4000) * 1024 * 1024
+            ))
+            tags.extend((code, tag_type, tag_value) for tag_type, tag_value in parsed.tags)
+            self.codes.append(code)
+            self.titles.append(parsed.clean_title)
+        self.conn.executemany('''
+            INSERT INTO movies (code, file_id, caption, title, clean_title, added_date, duration, file_size)
+            VALUES (?, ?, ?, ?, ?, datetime(?, 'unixepoch'), ?, ?)
+        ''', movies)
+        self.conn.executemany('INSERT OR IGNORE INTO movie_tags (code, tag_type, tag_value) VALUES (?, ?, ?)', tags)
+        self.conn.commit()
+        self._movie_ranks = self.codes[:]
+        rng.shuffle(self._movie_ranks)
+        self._movie_weights = zipf_cum_weights(count, 1.0)
+        self._report("movies", count, started)
+
+    def users(self):
+        started = time.perf_counter()
+        rng = self.rng
+        count = self.sizes["users"]
+        self.user_ids = sorted(rng.sample(range(100_000_000, 8_000_000_000), count))
+        first_joined = self.now - CATALOG_DAYS * 86400
+        for start in range(0, count, BATCH):
+            rows = []
+            for user_id in self.user_ids[start:start + BATCH]:
+                joined = rng.randint(first_joined, self.now)
+                last_activity = rng.randint(joined, self.now)
+                is_active = rng.random() < 0.9
+                rows.append((
+                    user_id, f"user{user_id % 10_000_000}" if rng.random() < 0.6 else None,
+                    rng.choice(TITLE_WORDS), None, joined, last_activity,
+                    int(rng.paretovariate(1.2)), rng.random() < 0.05, is_active,
+                    None if is_active else rng.randint(last_activity, self.now)
+                ))
+            self.conn.executemany('''
+                INSERT INTO users (user_id, username, first_name, last_name, joined_at, last_activity,
+                                   total_requests, is_premium, is_active, blocked_at)
+                VALUES (?, ?, ?, ?, datetime(?, 'unixepoch'), datetime(?, 'unixepoch'), ?, ?, ?,
+                        datetime(?, 'unixepoch'))
+            ''', rows)
+        self.conn.commit()
+        self._user_ranks = self.user_ids[:]
+        rng.shuffle(self._user_ranks)
+        self._user_weights = zipf_cum_weights(count, 0.8)
+        self._report("users", count, started)
+
+    def logs(self):
+        """Действия по времени от старых к новым: id растет вместе с created_at, как в живой базе"""
+        started = time.perf_counter()
+        rng = self.rng
+        count = self.sizes["logs"]
+        actions = rng.choices
+        action_names = [action for action, _ in ACTIONS]
+        action_weights = [weight for _, weight in ACTIONS]
+        first = self.now - LOG_DAYS * 86400
+        span = self.now - first
+        for start in range(0, count, BATCH):
+            size = min(BATCH, count - start)
+            low = first + span * start // count
+            high = first + span * (start + size) // count
+            times = sorted(low + int(rng.random() * (high - low)) for _ in range(size))
+            users = self._active_users(size)
+            movies = self._popular_movies(size)
+            rows = []
+            for at, user_id, code, action in zip(times, users, movies, actions(action_names, action_weights, k=size)):
+                if action == "watch_movie":
+                    details = code
+                elif action == "callback":
+                    details = f"movie_{code}"
+                elif action == "message":
+                    details = self.titles[int(code) - 1].split(" ")[0] if rng.random() < 0.7 else code
+                else:
+                    details = None
+                rows.append((user_id, action, details, at))
+            self.conn.executemany('''
+                INSERT INTO user_activity_logs (user_id, action, details, created_at)
+                VALUES (?, ?, ?, datetime(?, 'unixepoch'))
+            ''', rows)
+            self.conn.commit()
+            if start and start % (BATCH * 50) == 0:
+                self._report("logs", start, started)
+        self._report("logs", count, started)
+
+    def views(self):
+        """movie_views_daily и movies.views из просмотров в логах; старые просмотры - сверху по популярности"""
+        started = time.perf_counter()
+        self.conn.execute('''
+            INSERT INTO movie_views_daily (code, day, count)
+            SELECT details, date(created_at), COUNT(*) FROM user_activity_logs
+            WHERE action = 'watch_movie' GROUP BY details, date(created_at)
+        ''')
+        self.conn.execute('''
+            UPDATE movies SET views = (SELECT COALESCE(SUM(count), 0) FROM movie_views_daily d WHERE d.code = movies.code)
+        ''')
+        older = {code: 0 for code in self.codes}
+        for code in self._popular_movies(self.sizes["logs"] // 4):
+            older[code] += 1
+        self.conn.executemany('UPDATE movies SET views = views + ? WHERE code = ?', [
+            (count, code) for code, count in older.items() if count
+        ])
+        self.conn.commit()
+        self._report("views", len(self.codes), started)
+
+    def favorites_and_ratings(self):
+        started = time.perf_counter()
+        rng = self.rng
+        for table, count in (("favorites", self.sizes["favorites"]), ("ratings", self.sizes["ratings"])):
+            for start in range(0, count, BATCH):
+                size = min(BATCH, count - start)
+                pairs = zip(self._active_users(size), self._popular_movies(size))
+                times = [rng.randint(self.now - CATALOG_DAYS * 86400, self.now) for _ in range(size)]
+                if table == "favorites":
+                    self.conn.executemany('''
+                        INSERT OR IGNORE INTO favorites (user_id, movie_code, added_date)
+                        VALUES (?, ?, datetime(?, 'unixepoch'))
+                    ''', [(user_id, code, at) for (user_id, code), at in zip(pairs, times)])
+                else:
+                    self.conn.executemany('''
+                        INSERT OR IGNORE INTO ratings (user_id, movie_code, rating, review, created_at)
+                        VALUES (?, ?, ?, ?, datetime(?, 'unixepoch'))
+                    ''', [
+                        (user_id, code, rng.choices((1, 2, 3, 4, 5), (5, 5, 15, 35, 40))[0],
+                         movie_title(rng) if rng.random() < 0.05 else None, at)
+                        for (user_id, code), at in zip(pairs, times)
+                    ])
+            self.conn.commit()
+            self._report(table, count, started)
+
+    def reports(self):
+        started = time.perf_counter()
+        rng = self.rng
+        count = self.sizes["reports"]
+        rows = []
+        for user_id, code in zip(self._active_users(count), self._popular_movies(count)):
+            pending = rng.random() < 0.3
+            created = rng.randint(self.now - LOG_DAYS * 86400, self.now)
+            rows.append((
+                user_id, code, rng.choice(REPORT_TYPES), None, "pending" if pending else "resolved", created,
+                None if pending else rng.randint(created, self.now), None if pending else 6531897948
+            ))
+        self.conn.executemany('''
+            INSERT INTO reports (user_id, movie_code, report_type, description, status, created_at, resolved_at, resolved_by)
+            VALUES (?, ?, ?, ?, ?, datetime(?, 'unixepoch'), datetime(?, 'unixepoch'), ?)
+        ''', rows)
+        self.conn.commit()
+        self._report("reports", count, started)
+
+    def channels(self):
+        started = time.perf_counter()
+        rng = self.rng
+        channel_ids = [-1001000000000 - n for n in range(CHANNELS)]
+        self.conn.executemany('''
+            INSERT OR REPLACE INTO channels (channel_id, username, title, invite_link, is_active, is_private)
+            VALUES (?, ?, ?, ?, TRUE, ?)
+        ''', [
+            (channel_id, f"@kino_kanal_{n}", f"Kino kanal {n}", f"https://t.me/+bench{n}", n % 2 == 1)
+            for n, channel_id in enumerate(channel_ids)
+        ])
+        count = self.sizes["channel_requests"]
+        statuses = [status for status, _ in REQUEST_STATUSES]
+        weights = [weight for _, weight in REQUEST_STATUSES]
+        rows = []
+        for user_id in rng.sample(self.user_ids, min(count, len(self.user_ids))):
+            created = rng.randint(self.now - LOG_DAYS * 86400, self.now)
+            rows.append((user_id, rng.choice(channel_ids), rng.choices(statuses, weights)[0], created, created))
+        self.conn.executemany('''
+            INSERT OR IGNORE INTO channel_requests (user_id, channel_id, status, created_at, updated_at)
+            VALUES (?, ?, ?, datetime(?, 'unixepoch'), datetime(?, 'unixepoch'))
+        ''', rows)
+        self.conn.commit()
+        self._report("channel_requests", len(rows), started)
+
+
+def generate(db_path, scale=1.0, seed=42, recommendations=False, progress=print):
+    """Создает базу db_path со схемой Database и заполняет ее; возвращает число строк по таблицам"""
+    if os.path.exists(db_path):
+        raise FileExistsError(f"{db_path} allaqachon bor")
+    started = time.perf_counter()
+    # Схему создает бот, чтобы база совпадала с рабочей версией
+    directory = os.path.dirname(os.path.abspath(db_path))
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        from bot import Database
+        Database(os.path.basename(db_path))
+    finally:
+        os.chdir(cwd)
+
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA cache_size = -262144')
+    # Индексы строятся один раз после загрузки - так в разы быстрее, чем поддерживать их на каждой вставке
+    indexes = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL").fetchall()
+    for name, _ in indexes:
+        conn.execute(f'DROP INDEX {name}')
+
+    generator = Generator(conn, scale, seed, progress=progress)
+    progress(f"📦 {db_path}: " + ", ".join(f"{name}={size:,}" for name, size in generator.sizes.items()))
+    generator.movies()
+    generator.users()
+    generator.channels()
+    generator.logs()
+    generator.views()
+    generator.favorites_and_ratings()
+    generator.reports()
+
+    index_started = time.perf_counter()
+    for _, sql in indexes:
+        conn.execute(sql)
+    conn.commit()
+    progress(f"  indexes: {len(indexes)} ({time.perf_counter() - index_started:.1f} s)")
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+    counts = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0] for table in tables}
+    conn.close()
+
+    if recommendations:
+        from recommendations import build_item_neighbors, build_user_feeds
+        stats = build_item_neighbors(db_path)
+        progress(f"  movie_neighbors: {stats['with_neighbors']:,} ({stats['seconds']:.1f} s)")
+        stats = build_user_feeds(db_path)
+        progress(f"  user_feeds: {stats['feeds']:,} ({stats['seconds']:.1f} s)")
+
+    progress(f"✅ {time.perf_counter() - started:.1f} s, {os.path.getsize(db_path) / 1024 / 1024:,.0f} MB")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic large-catalog database")
+    parser.add_argument("--out", default=os.path.join(ROOT, "bench_data"), help="Каталог; база - <out>/movies.db")
+    parser.add_argument("--scale", type=float, default=1.0, help="Доля от 100k фильмов / 1M пользователей / 50M логов")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--recommendations", action="store_true", help="Посчитать movie_neighbors и user_feeds")
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    db_path = os.path.join(args.out, "movies.db")
+    if os.path.exists(db_path):
+        print(f"❌ {db_path} allaqachon bor - avval o'chiring")
+        return 1
+    generate(db_path, args.scale, args.seed, args.recommendations)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
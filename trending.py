@@ -0,0 +1,116 @@
+"""Рейтинг популярных фильмов с затуханием: "сегодня", "за неделю" и "за все время".
+
+Просмотр в момент t добавляет фильму exp(rate * (t - epoch)) вместо exp(-rate * (now - t)).
+Все оценки затухают с одной скоростью, поэтому порядок фильмов со временем не меняется и
+меняется только при новых просмотрах - рейтинг хранится отсортированным, а страница
+это срез списка. Текущее значение (примерно "просмотров за период") - stored * exp(-rate * (now - epoch)).
+Когда показатель степени становится большим, epoch сдвигается и все оценки масштабируются.
+"""
+import math
+import time
+from bisect import bisect_left, bisect_right, insort
+
+# Период полураспада оценок в секундах; "all" - обычный счетчик просмотров
+HALF_LIVES = {"today": 6 * 3600, "week": 2 * 24 * 3600}
+PERIODS = ("today", "week", "all")
+# Фильмы с текущей оценкой ниже порога (меньше одного недавнего просмотра) в рейтинг не попадают
+MIN_SCORE = 0.5
+# exp(60) ~ 1e26: еще далеко до переполнения float, но пора сдвигать epoch
+MAX_EXPONENT = 60.0
+
+
+class Leaderboard:
+    """Оценки фильмов и список (-оценка, code), отсортированный по убыванию оценки"""
+
+    def __init__(self):
+        self._scores = {}
+        self._order = []
+
+    def load(self, scores):
+        self._scores = dict(scores)
+        self._order = sorted((-score, code) for code, score in self._scores.items())
+
+    def add(self, code, amount):
+        old = self._scores.get(code)
+        if old is not None:
+            del self._order[bisect_left(self._order, (-old, code))]
+        score = (old or 0.0) + amount
+        self._scores[code] = score
+        insort(self._order, (-score, code))
+
+    def remove(self, code):
+        score = self._scores.pop(code, None)
+        if score is None:
+            return False
+        del self._order[bisect_left(self._order, (-score, code))]
+        return True
+
+    def scale(self, factor, drop_below=0.0):
+        """Умножает все оценки на factor > 0 и отбрасывает те, что стали меньше drop_below"""
+        self._order = [(score * factor, code) for score, code in self._order if -score * factor >= drop_below]
+        self._scores = {code: -score for score, code in self._order}
+
+    def count_at_least(self, score):
+        return bisect_right(self._order, (-score, "\uffff"))
+
+    def page(self, offset, limit):
+        return [(code, -score) for score, code in self._order[offset:offset + limit]]
+
+    def __len__(self):
+        return len(self._order)
+
+
+class TrendingBoard:
+    def __init__(self, half_lives=HALF_LIVES, now=None):
+        now = time.time() if now is None else now
+        self.half_lives = dict(half_lives)
+        self._rates = {period: math.log(2) / half_life for period, half_life in half_lives.items()}
+        self._epochs = {period: now for period in half_lives}
+        self.boards = {period: Leaderboard() for period in PERIODS}
+        self.loaded = False
+
+    def load(self, views, buckets, now=None):
+        """views - [(code, просмотры)], buckets - [(code, начало часа в unix-времени, просмотры)]"""
+        now = time.time() if now is None else now
+        self.__init__(self.half_lives, now)
+        self.boards["all"].load((code, count) for code, count in views if count)
+        for period, rate in self._rates.items():
+            scores = {}
+            for code, started_at, count in buckets:
+                scores[code] = scores.get(code, 0.0) + count * math.exp(rate * (started_at - now))
+            self.boards[period].load(scores)
+        self.loaded = True
+        return len(self.boards["all"])
+
+    def record(self, code, count=1, at=None):
+        at = time.time() if at is None else at
+        for period, rate in self._rates.items():
+            exponent = rate * (at - self._epochs[period])
+            if exponent > MAX_EXPONENT:
+                # Сразу после сдвига хранимая оценка равна текущей - совсем старые фильмы выбрасываются
+                self.boards[period].scale(math.exp(-exponent), MIN_SCORE * 1e-6)
+                self._epochs[period] = at
+                exponent = 0.0
+            self.boards[period].add(code, count * math.exp(exponent))
+        self.boards["all"].add(code, count)
+
+    def remove(self, code):
+        for board in self.boards.values():
+            board.remove(code)
+
+    def _factor(self, period, now):
+        """Множитель от хранимой оценки к текущей"""
+        if period == "all":
+            return 1.0
+        return math.exp(-self._rates[period] * (now - self._epochs[period]))
+
+    def count(self, period, now=None):
+        factor = self._factor(period, time.time() if now is None else now)
+        return self.boards[period].count_at_least(MIN_SCORE / factor)
+
+    def page(self, period, offset, limit, now=None):
+        """[(code, текущая оценка)] страницы рейтинга"""
+        now = time.time() if now is None else now
+        factor = self._factor(period, now)
+        limit = max(0, min(limit, self.count(period, now) - offset))
+        return [(code, score * factor) for code, score in self.boards[period].page(offset, limit)]